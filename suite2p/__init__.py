@@ -1,5 +1,6 @@
 from .run_s2p import run_s2p, default_ops
 from .detection import ROI
+from .online import OnlinePipeline
 from .version import version
 
 
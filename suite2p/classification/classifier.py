@@ -2,6 +2,8 @@ import numpy as np
 from scipy.ndimage import gaussian_filter
 from sklearn.linear_model  import LogisticRegression
 
+from ..detection.roitable import ROITable
+
 
 class Classifier:
     """ ROI classifier model that uses logistic regression
@@ -71,11 +73,14 @@ class Classifier:
         Parameters
         ----------
         
-        stat : list of dicts
+        stat : list of dicts or ROITable
             needs self.keys keys
 
         """
-        test_stats = np.array([stat[j][k] for j in range(len(stat)) for k in self.keys]).reshape(len(stat), -1)
+        if isinstance(stat, ROITable):
+            test_stats = stat.features(self.keys)
+        else:
+            test_stats = np.array([stat[j][k] for j in range(len(stat)) for k in self.keys]).reshape(len(stat), -1)
         logp = self._get_logp(test_stats)
         y_pred = self.model.predict_proba(logp)[:, 1]
         return y_pred
@@ -2,17 +2,18 @@ import numpy as np
 from pathlib import Path
 from typing import Union, Sequence
 from .classifier import Classifier
+from ..detection.roitable import ROITable
 
 builtin_classfile = Path(__file__).joinpath('../../classifiers/classifier.npy').resolve()
 user_classfile = Path.home().joinpath('.suite2p/classifiers/classifier_user.npy')
 
 
-def classify(stat: np.ndarray,
+def classify(stat: Union[np.ndarray, ROITable],
              classfile: Union[str, Path],
              keys: Sequence[str] = ('npix_norm', 'compact', 'skew'),
              ):
-    """Returns array of classifier output from classification process."""
-    keys = list(set(keys).intersection(set(stat[0])))
+    """Returns array of classifier output from classification process (stat are stat dicts or a ROITable)."""
+    keys = list(set(keys).intersection(set(stat.roi if isinstance(stat, ROITable) else stat[0])))
     print(keys)
     iscell = Classifier(classfile, keys=keys).run(stat)
     return iscell
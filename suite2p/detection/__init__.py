@@ -1,2 +1,3 @@
 from .detect import detect
-from .stats import roi_stats, ROI
\ No newline at end of file
+from .stats import roi_stats, ROI
+from .roitable import ROITable, save_stat, load_stat
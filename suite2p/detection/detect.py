@@ -31,7 +31,8 @@ def detect(ops, classfile=None):
     t0 = time.time()
     bin_size = int(max(1, ops['nframes'] // ops['nbinned'], np.round(ops['tau'] * ops['fs'])))
     print('Binning movie in chunks of length %2.2d' % bin_size)
-    with BinaryFile(read_filename=ops['reg_file'], Ly=ops['Ly'], Lx=ops['Lx']) as f:
+    with BinaryFile(read_filename=ops['reg_file'], Ly=ops['Ly'], Lx=ops['Lx'],
+                    use_memmap=ops.get('use_memmap', False)) as f:
         mov = f.bin_movie(
             bin_size=bin_size,
             bad_frames=ops.get('badframes'),
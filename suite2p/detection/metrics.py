@@ -72,7 +72,8 @@ def extend_anatomical(img_anat, masks_anat, mov=None, ops=None, reg_file=None):
 
         bin_size = int(max(1, ops['nframes'] // ops['nbinned'], np.round(ops['tau'] * ops['fs'])))
         t0 = time.time()
-        with BinaryFile(read_filename=reg_file, Ly=ops['Ly'], Lx=ops['Lx']) as f:
+        with BinaryFile(read_filename=reg_file, Ly=ops['Ly'], Lx=ops['Lx'],
+                        use_memmap=ops.get('use_memmap', False)) as f:
             mov = f.bin_movie(
                                 bin_size=bin_size,
                                 bad_frames=ops.get('badframes'),
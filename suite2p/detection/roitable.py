@@ -0,0 +1,199 @@
+"""
+Columnar storage of ROI statistics.
+
+stat.npy holds an object array of dicts (one per ROI) that has to be unpickled and walked in
+Python loops. ROITable holds the same data as columns: the per-pixel arrays ('ypix', 'xpix',
+'lam', 'overlap', 'soma_crop', ...) of all ROIs concatenated, with the first pixel of each ROI
+in 'offsets', and the per-ROI values ('npix', 'compact', 'med', ...) as one array each.
+Selections, concatenation and feature extraction are array operations; indexing with an integer
+(or iterating, or to_stat) gives the legacy dicts.
+
+Tables are saved next to stat.npy as STAT_TABLE (see save_stat and load_stat).
+"""
+import json
+import os
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+STAT_TABLE = 'stat.npz'
+# always stored per pixel
+PIXEL_KEYS = ('ypix', 'xpix', 'lam', 'overlap', 'soma_crop')
+
+
+class ROITable:
+
+    def __init__(self, offsets: np.ndarray, pixel: Dict[str, np.ndarray], roi: Dict[str, np.ndarray],
+                 keys: Optional[List[str]] = None):
+        """
+        ROI statistics as columns.
+
+        Parameters
+        ----------
+        offsets: int64 array of size nrois + 1
+            pixels of ROI i are offsets[i]:offsets[i+1] of the pixel columns
+        pixel: dict of arrays
+            per-pixel columns (length offsets[-1])
+        roi: dict of arrays
+            per-ROI columns (length nrois), numeric or object arrays
+        keys: list of str (optional)
+            order of the keys in the legacy dicts
+        """
+        self.offsets = np.asarray(offsets, np.int64)
+        self.pixel = pixel
+        self.roi = roi
+        self.keys = list(keys) if keys is not None else list(pixel) + list(roi)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    @property
+    def npix(self) -> np.ndarray:
+        """number of pixels of each ROI."""
+        return np.diff(self.offsets)
+
+    def roi_index(self) -> np.ndarray:
+        """index of the ROI of each pixel."""
+        return np.repeat(np.arange(len(self)), self.npix)
+
+    def split(self, values: np.ndarray) -> List[np.ndarray]:
+        """splits a per-pixel array into one array per ROI."""
+        return np.split(values, self.offsets[1:-1])
+
+    @classmethod
+    def from_stat(cls, stat: Sequence[dict]) -> 'ROITable':
+        """converts a list (or object array) of stat dicts."""
+        keys = []
+        for s in stat:
+            keys.extend(k for k in s if k not in keys)
+        npix = np.array([len(s['ypix']) for s in stat], np.int64) if 'ypix' in keys else np.zeros(len(stat), np.int64)
+        offsets = np.concatenate(([0], np.cumsum(npix)))
+        pixel, roi = {}, {}
+        for key in keys:
+            values = [s.get(key) for s in stat]
+            if _is_pixel_column(key, values, npix):
+                pixel[key] = np.concatenate([np.asarray(v).ravel() for v in values]) if len(values) else np.zeros(0)
+            else:
+                roi[key] = _roi_column(values)
+        return cls(offsets, pixel, roi, keys)
+
+    def to_stat(self) -> np.ndarray:
+        """returns the legacy object array of stat dicts (pixel arrays are views of the table)."""
+        stat = np.empty(len(self), dtype=object)
+        for i in range(len(self)):
+            stat[i] = self[i]
+        return stat
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, index):
+        """an integer gives the stat dict of one ROI; an index array, boolean mask or slice gives a table."""
+        if isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += len(self)
+            i0, i1 = self.offsets[index], self.offsets[index + 1]
+            s = {}
+            for key in self.keys:
+                if key in self.pixel:
+                    s[key] = self.pixel[key][i0:i1]
+                elif self.roi[key].dtype != object or self.roi[key][index] is not None:
+                    s[key] = self.roi[key][index]
+            return s
+        index = np.arange(len(self))[index]
+        npix = self.npix[index]
+        offsets = np.concatenate(([0], np.cumsum(npix)))
+        ipix = np.repeat(self.offsets[:-1][index] - offsets[:-1], npix) + np.arange(offsets[-1])
+        return ROITable(offsets, {key: val[ipix] for key, val in self.pixel.items()},
+                        {key: val[index] for key, val in self.roi.items()}, self.keys)
+
+    def features(self, keys: Sequence[str]) -> np.ndarray:
+        """returns the per-ROI columns keys as an nrois x len(keys) float array."""
+        return np.stack([self.roi[key].astype(np.float64) for key in keys], axis=1) if len(keys) \
+            else np.zeros((len(self), 0))
+
+    @staticmethod
+    def concatenate(tables: Sequence['ROITable']) -> 'ROITable':
+        """concatenates tables with the same columns (else through the stat dicts)."""
+        tables = list(tables)
+        columns = [(sorted(t.pixel), sorted(t.roi)) for t in tables]
+        roi_shapes = [{key: val.shape[1:] for key, val in t.roi.items()} for t in tables]
+        if any(c != columns[0] for c in columns) or any(s != roi_shapes[0] for s in roi_shapes):
+            return ROITable.from_stat([s for t in tables for s in t])
+        offsets = np.concatenate([[0]] + [t.offsets[1:] + n for t, n in
+                                          zip(tables, np.cumsum([0] + [t.offsets[-1] for t in tables[:-1]]))])
+        return ROITable(offsets, {key: np.concatenate([t.pixel[key] for t in tables]) for key in tables[0].pixel},
+                        {key: np.concatenate([t.roi[key] for t in tables]) for key in tables[0].roi}, tables[0].keys)
+
+    def save(self, filename: str) -> None:
+        """saves the table as an npz file (object columns are pickled)."""
+        arrays = {'pix_' + key: val for key, val in self.pixel.items()}
+        arrays.update({'roi_' + key: val for key, val in self.roi.items()})
+        with open(filename, 'wb') as f:
+            np.savez(f, offsets=self.offsets, keys=json.dumps(self.keys), **arrays)
+
+    @classmethod
+    def load(cls, filename: str) -> 'ROITable':
+        with np.load(filename, allow_pickle=True) as f:
+            pixel = {key[4:]: f[key] for key in f.files if key.startswith('pix_')}
+            roi = {key[4:]: f[key] for key in f.files if key.startswith('roi_')}
+            return cls(f['offsets'], pixel, roi, json.loads(str(f['keys'])))
+
+
+def _is_pixel_column(key: str, values: list, npix: np.ndarray) -> bool:
+    """PIXEL_KEYS and other 1D arrays with one value per pixel (if that is not a coincidence of equal sizes)."""
+    if key in PIXEL_KEYS:
+        return all(v is not None and np.size(v) == n for v, n in zip(values, npix))
+    return len(values) > 0 and npix.min() != npix.max() and \
+        all(isinstance(v, np.ndarray) and v.ndim == 1 and v.size == n for v, n in zip(values, npix))
+
+
+def _roi_column(values: list) -> np.ndarray:
+    """stacks per-ROI values into a numeric array if they all have the same shape, else an object array."""
+    if all(v is not None for v in values):
+        try:
+            column = np.array(values)
+            if column.dtype != object and column.dtype.kind in 'biuf' and column.shape[0] == len(values):
+                return column
+        except ValueError:
+            pass
+    column = np.empty(len(values), dtype=object)
+    for i, v in enumerate(values):
+        column[i] = v
+    return column
+
+
+def save_stat(fpath: str, stat, table: Optional[ROITable] = None) -> ROITable:
+    """
+    Saves stat (dicts or ROITable) as stat.npy and as the table STAT_TABLE in folder fpath.
+
+    Returns the table (table, if the caller already has stat as a table).
+    """
+    if isinstance(stat, ROITable):
+        stat, table = stat.to_stat(), stat
+    elif table is None:
+        table = ROITable.from_stat(stat)
+    np.save(os.path.join(fpath, 'stat.npy'), stat)
+    table.save(os.path.join(fpath, STAT_TABLE))
+    return table
+
+
+def load_stat(fpath: str, as_table: bool = False):
+    """
+    Loads the ROI statistics saved in folder fpath.
+
+    The table STAT_TABLE is used if it is at least as new as stat.npy (which e.g. the GUI rewrites
+    without the table), else stat.npy.
+
+    Returns
+    -------
+    stat: ROITable if as_table, else object array of stat dicts
+    """
+    npy_file, table_file = os.path.join(fpath, 'stat.npy'), os.path.join(fpath, STAT_TABLE)
+    if os.path.isfile(table_file) and (not os.path.isfile(npy_file) or
+                                       os.path.getmtime(table_file) >= os.path.getmtime(npy_file)):
+        table = ROITable.load(table_file)
+        return table if as_table else table.to_stat()
+    stat = np.load(npy_file, allow_pickle=True)
+    return ROITable.from_stat(stat) if as_table else stat
@@ -2,6 +2,7 @@ from __future__ import annotations
 
 from typing import Tuple, Optional, NamedTuple, Sequence, List, Dict, Any
 from dataclasses import dataclass, field
+from functools import cached_property
 from warnings import warn
 
 import numpy as np
@@ -110,7 +111,7 @@ class ROI:
     def get_overlap_image(self, overlap_count_image: np.ndarray) -> np.ndarray:
         return overlap_count_image[self.ypix, self.xpix] > 1
 
-    @property 
+    @cached_property
     def soma_crop(self) -> np.ndarray:
         if self.do_crop and self.ypix.size > 10:
             dists = ((self.ypix - self.med[0])**2 + (self.xpix - self.med[1])**2)**0.5
@@ -292,10 +293,10 @@ def fitMVGaus(y, x, lam0, dy, dx, thres=2.5, npts: int = 100) -> EllipseData:
     return EllipseData(mu=mu, cov=cov, radii=radii, ellipse=ellipse, dy=dy, dx=dx)
 
 def count_overlaps(Ly: int, Lx: int, ypixs, xpixs) -> np.ndarray:
-    overlap = np.zeros((Ly, Lx))
-    for xpix, ypix in zip(xpixs, ypixs):
-        overlap[ypix, xpix] += 1
-    return overlap
+    if len(ypixs) == 0:
+        return np.zeros((Ly, Lx))
+    ipix = np.ravel_multi_index((np.concatenate(ypixs), np.concatenate(xpixs)), (Ly, Lx))
+    return np.bincount(ipix, minlength=Ly * Lx).reshape(Ly, Lx).astype(np.float64)
 
 def filter_overlappers(ypixs, xpixs, overlap_image: np.ndarray, max_overlap: float) -> List[bool]:
     """returns ROI indices that remain after removing those that overlap more than fraction max_overlap from overlap_img."""
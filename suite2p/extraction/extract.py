@@ -80,7 +80,8 @@ def extract_traces(ops, cell_masks, neuropil_masks, reg_file):
         neuropil_ipix = None
 
     ix = 0
-    for k, (_, data) in enumerate(reg_file.iter_frames(batch_size=ops['batch_size'])):
+    for k, (_, data) in enumerate(reg_file.iter_frames(batch_size=ops['batch_size'], dtype=None,
+                                                       prefetch=ops.get('prefetch_batches', 0))):
         nimg = data.shape[0]
         if nimg == 0:
             break
@@ -128,11 +129,11 @@ def extract_traces_from_masks(ops, cell_masks, neuropil_masks):
     """
     F_chan2, Fneu_chan2 = [], []
     with BinaryFile(Ly=ops['Ly'], Lx=ops['Lx'],
-                    read_filename=ops['reg_file']) as f:    
+                    read_filename=ops['reg_file'], use_memmap=ops.get('use_memmap', False)) as f:
         F, Fneu, ops = extract_traces(ops, cell_masks, neuropil_masks, f)
     if 'reg_file_chan2' in ops:
         with BinaryFile(Ly=ops['Ly'], Lx=ops['Lx'],
-                        read_filename=ops['reg_file_chan2']) as f:    
+                        read_filename=ops['reg_file_chan2'], use_memmap=ops.get('use_memmap', False)) as f:
             F_chan2, Fneu_chan2, _ = extract_traces(ops.copy(), cell_masks, neuropil_masks, f)
     return F, Fneu, F_chan2, Fneu_chan2, ops
 
@@ -1,21 +1,22 @@
-from typing import List, Tuple, Dict, Any
+from typing import List, Tuple, Dict, Any, Union
 from itertools import count
 import numpy as np
 from scipy.ndimage import percentile_filter
 
 from ..detection.sparsedetect import extendROI
+from ..detection.roitable import ROITable
 
 
-def create_masks(ops: Dict[str, Any], stats: List[Dict[str, Any]]):
-    """ create cell and neuropil masks """
-
-    cell_pix = create_cell_pix(stats, Ly=ops['Ly'], Lx=ops['Lx'], 
+def create_masks(ops: Dict[str, Any], stats: Union[List[Dict[str, Any]], ROITable]):
+    """ create cell and neuropil masks (stats are stat dicts or a ROITable) """
+    table = stats if isinstance(stats, ROITable) else ROITable.from_stat(stats)
+    cell_pix = create_cell_pix(table, Ly=ops['Ly'], Lx=ops['Lx'], 
                                lam_percentile=ops.get('lam_percentile', 50.0))
-    cell_masks = [create_cell_mask(stat, Ly=ops['Ly'], Lx=ops['Lx'], allow_overlap=ops['allow_overlap']) for stat in stats]
+    cell_masks = create_cell_masks(table, Ly=ops['Ly'], Lx=ops['Lx'], allow_overlap=ops['allow_overlap'])
     if ops.get('neuropil_extract', True):
         neuropil_masks = create_neuropil_masks(
-            ypixs=[stat['ypix'] for stat in stats],
-            xpixs=[stat['xpix'] for stat in stats],
+            ypixs=table.split(table.pixel['ypix']),
+            xpixs=table.split(table.pixel['xpix']),
             cell_pix=cell_pix,
             inner_neuropil_radius=ops['inner_neuropil_radius'],
             min_neuropil_pixels=ops['min_neuropil_pixels'],
@@ -25,7 +26,7 @@ def create_masks(ops: Dict[str, Any], stats: List[Dict[str, Any]]):
         neuropil_masks = None
     return cell_masks, neuropil_masks
 
-def create_cell_pix(stats: List[Dict[str, Any]], Ly: int, Lx: int, 
+def create_cell_pix(stats: Union[List[Dict[str, Any]], ROITable], Ly: int, Lx: int, 
                     lam_percentile: float = 50.0) -> np.ndarray:
     """Returns Ly x Lx array of whether pixel contains a cell (1) or not (0).
     
@@ -33,16 +34,10 @@ def create_cell_pix(stats: List[Dict[str, Any]], Ly: int, Lx: int,
     disable with lam_percentile=0.0
 
     """
-    cell_pix = np.zeros((Ly, Lx))
+    table = stats if isinstance(stats, ROITable) else ROITable.from_stat(stats)
     lammap = np.zeros((Ly, Lx))
-    radii = np.zeros(len(stats))
-    for ni,stat in enumerate(stats):
-        radii[ni] = stat['radius']
-        ypix = stat['ypix']
-        xpix = stat['xpix']
-        lam = stat['lam']
-        lammap[ypix, xpix] = np.maximum(lammap[ypix, xpix], lam)
-    radius = np.median(radii)
+    np.maximum.at(lammap, (table.pixel['ypix'], table.pixel['xpix']), table.pixel['lam'])
+    radius = np.median(table.roi['radius'])
     if lam_percentile > 0.0:
         filt = percentile_filter(lammap, percentile=lam_percentile, size=int(radius*5))
         cell_pix = ~np.logical_or(lammap < filt, lammap==0)
@@ -78,6 +73,27 @@ def create_cell_mask(stat: Dict[str, Any], Ly: int, Lx: int, allow_overlap: bool
     return cell_mask, lam_normed
 
 
+def create_cell_masks(table: ROITable, Ly: int, Lx: int, allow_overlap: bool = False) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    create_cell_mask for all ROIs of a ROITable at once
+
+    Returns
+    -------
+
+    cell_masks : len ncells, each has tuple of pixels belonging to each cell and normalized weights
+    """
+    ipix = np.ravel_multi_index((table.pixel['ypix'], table.pixel['xpix']), (Ly, Lx))
+    lam = table.pixel['lam']
+    roi = table.roi_index()
+    if not allow_overlap:
+        keep = ~table.pixel['overlap'].astype(bool)
+        ipix, lam, roi = ipix[keep], lam[keep], roi[keep]
+    lam_sum = np.bincount(roi, weights=lam, minlength=len(table))
+    lam_normed = (lam / lam_sum[roi]).astype(lam.dtype)
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(roi, minlength=len(table)))))
+    return [(ipix[i0:i1], lam_normed[i0:i1]) for i0, i1 in zip(offsets[:-1], offsets[1:])]
+
+
 
 def create_neuropil_masks(ypixs, xpixs, cell_pix, inner_neuropil_radius, min_neuropil_pixels, circular=False):
     """ creates surround neuropil masks for ROIs in stat by EXTENDING ROI (slower if circular)
@@ -265,7 +265,7 @@ def load_files(name):
                   "(spks.npy)")
             goodfolder = False
         try:
-            ops = np.load(basename + "/ops.npy", allow_pickle=True).item()
+            ops = io.load_ops(basename + "/ops.npy")
         except (ValueError, OSError, RuntimeError, TypeError, NameError):
             print("ERROR: there is no ops file in this folder (ops.npy)")
             goodfolder = False
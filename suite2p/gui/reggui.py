@@ -14,6 +14,7 @@ from tifffile import imread
 from . import masks, views, graphics, traces, classgui, utils
 from .. import registration
 from ..io.save import compute_dydx
+from ..io.opsfile import load_ops
 
 
 class BinaryPlayer(QMainWindow):
@@ -363,7 +364,7 @@ class BinaryPlayer(QMainWindow):
     def openCombined(self, save_folder):
         try:
             plane_folders = natsorted([ f.path for f in os.scandir(save_folder) if f.is_dir() and f.name[:5]=='plane'])
-            ops1 = [np.load(os.path.join(f, 'ops.npy'), allow_pickle=True).item() for f in plane_folders]
+            ops1 = [load_ops(os.path.join(f, 'ops.npy')) for f in plane_folders]
             self.LY = 0
             self.LX = 0
             self.reg_loc = []
@@ -412,7 +413,7 @@ class BinaryPlayer(QMainWindow):
 
     def openFile(self, filename, fromgui):
         try:
-            ops = np.load(filename, allow_pickle=True).item()
+            ops = load_ops(filename)
             self.LY = ops['Ly']
             self.LX = ops['Lx']
             self.Ly = [ops['Ly']]
@@ -975,7 +976,7 @@ class PCViewer(QMainWindow):
 
     def openFile(self, filename):
         try:
-            ops = np.load(filename, allow_pickle=True).item()
+            ops = load_ops(filename)
             self.PC = ops['regPC']
             self.PC = np.clip(self.PC, np.percentile(self.PC, 1), 
                                 np.percentile(self.PC, 99))
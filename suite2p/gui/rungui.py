@@ -7,6 +7,7 @@ from PyQt5.QtWidgets import QDialog, QLineEdit, QLabel, QPushButton, QWidget, QG
 
 from . import io
 from .. import default_ops
+from ..io.opsfile import load_ops, OPS_META
 
 
 ### ---- this file contains helper functions for GUI and the RUN window ---- ###
@@ -71,7 +72,7 @@ class RunWindow(QDialog):
         self.create_buttons()
 
     def reset_ops(self):
-        self.ops = np.load(self.opsfile, allow_pickle=True).item()
+        self.ops = load_ops(self.opsfile)
         ops0 = default_ops()
         self.ops = {**ops0, **self.ops}
         if hasattr(self, 'editlist'):
@@ -475,7 +476,10 @@ class RunWindow(QDialog):
             ext = os.path.splitext(name)[1]
             try:
                 if ext == '.npy':
-                    ops = np.load(name, allow_pickle=True).item()
+                    ops = load_ops(name)
+                elif os.path.basename(name) == OPS_META:
+                    # ops saved by a run, with array sidecars
+                    ops = load_ops(os.path.join(os.path.dirname(name), 'ops.npy'))
                 elif ext == '.json':
                     with open(name, 'r') as f:
                         ops = json.load(f)
@@ -1,7 +1,13 @@
 from .h5 import h5py_to_binary
-from .nwb import save_nwb, read_nwb, nwb_to_binary
+from .nwb import save_nwb, read_nwb, nwb_to_binary, nwb_to_virtual
 from .save import combined, compute_dydx, save_mat
 from .sbx import sbx_to_binary
 from .tiff import mesoscan_to_binary, ome_to_binary, tiff_to_binary, generate_tiff_filename, save_tiff
 from .binary import BinaryFile, BinaryFileCombined
+from .chunked import ChunkedFile, open_binary, file_nbytes
+from .manifest import load_manifest
+from .opsfile import save_ops, load_ops
+from .results import save_results, load_results, Results
+from .virtual import VirtualTiffFile, VirtualH5File, tiff_to_virtual
 from .server import send_jobs
+from ..detection.roitable import ROITable, save_stat, load_stat
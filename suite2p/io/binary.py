@@ -1,12 +1,20 @@
+import os
+import queue
+import threading
 from typing import Optional, Tuple, Sequence
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
+from .chunked import ChunkedFile, open_binary, is_chunked
+from .virtual import VirtualFile, is_virtual
+
 
 class BinaryFile:
 
-    def __init__(self, Ly: int, Lx: int, read_filename: str, write_filename: Optional[str] = None):
+    def __init__(self, Ly: int, Lx: int, read_filename: str, write_filename: Optional[str] = None,
+                 use_memmap: bool = False, write_behind: bool = False, compression: Optional[str] = None):
         """
         Creates/Opens a Suite2p BinaryFile for reading and writing image data
 
@@ -20,27 +28,64 @@ class BinaryFile:
             The filename of the file to read from
         write_filename: str
             The filename to write to, if different from the read_filename (optional)
+        use_memmap: bool, default False
+            Access the file(s) through np.memmap: slices, crops and strided indices are returned
+            as int16 views without copying, and writes go through the same map
+        write_behind: bool, default False
+            Hand written frames to a background thread that writes them with os.pwrite, so that
+            the caller can continue with the next batch (ignored with use_memmap)
+        compression: str (optional, default None)
+            Write write_filename as a chunked compressed container ('zstd', 'blosc' or 'zlib', see
+            io.chunked); compressed files are detected when reading and are rewritten in place
+            in their own format
         """
         self.Ly = Ly
         self.Lx = Lx
         self.read_filename = read_filename
         self.write_filename = write_filename
-
-        if read_filename == write_filename:
-            self.read_file = open(read_filename, mode='r+b')
+        if use_memmap and (compression or is_chunked(read_filename) or is_virtual(read_filename)):
+            print('NOTE: compressed or virtual binary files cannot be memory-mapped, use_memmap ignored')
+            use_memmap = False
+        self.use_memmap = use_memmap
+        # frames per chunk when creating compressed files
+        chunk_bytes = int(self.nbytesread) * max(1, int(2 ** 22 // self.nbytesread))
+
+        if use_memmap:
+            n_frames = int(os.path.getsize(read_filename) // (2 * Ly * Lx))
+            if read_filename == write_filename:
+                self.read_file = np.memmap(read_filename, mode='r+', dtype=np.int16, shape=(n_frames, Ly, Lx))
+                self.write_file = self.read_file
+            elif read_filename and not write_filename:
+                self.read_file = np.memmap(read_filename, mode='r', dtype=np.int16, shape=(n_frames, Ly, Lx))
+                self.write_file = write_filename
+            elif read_filename and write_filename and read_filename != write_filename:
+                self.read_file = np.memmap(read_filename, mode='r', dtype=np.int16, shape=(n_frames, Ly, Lx))
+                self.write_file = np.memmap(write_filename, mode='w+', dtype=np.int16, shape=(n_frames, Ly, Lx))
+            else:
+                raise IOError("Invalid combination of read_file and write_file")
+        elif read_filename == write_filename:
+            self.read_file = open_binary(read_filename, mode='r+b')
             self.write_file = self.read_file
         elif read_filename and not write_filename:
-            self.read_file = open(read_filename, mode='rb')
+            self.read_file = open_binary(read_filename, mode='rb')
             self.write_file = write_filename
         elif read_filename and write_filename and read_filename != write_filename:
-            self.read_file = open(read_filename, mode='rb')
-            self.write_file = open(write_filename, mode='wb')
+            self.read_file = open_binary(read_filename, mode='rb')
+            self.write_file = open_binary(write_filename, mode='wb', compression=compression, chunk_bytes=chunk_bytes)
         else:
             raise IOError("Invalid combination of read_file and write_file")
 
         self._index = 0
+        self._write_index = 0
         self._can_read = True
 
+        # compressed containers and virtual binaries are read through their own pread
+        self.compressed = isinstance(self.read_file, (ChunkedFile, VirtualFile)) or isinstance(self.write_file, ChunkedFile)
+        self.write_behind = write_behind and not use_memmap and not self.compressed and hasattr(os, 'pwrite')
+        self._write_queue = None
+        self._write_thread = None
+        self._write_error = None
+
     @staticmethod
     def convert_numpy_file_to_suite2p_binary(from_filename: str, to_filename: str) -> None:
         """
@@ -63,6 +108,8 @@ class BinaryFile:
     @property
     def nbytes(self):
         """total number of bytes in the read_file."""
+        if self.use_memmap:
+            return self.read_file.nbytes
         with temporary_pointer(self.read_file) as f:
             f.seek(0, 2)
             return f.tell()
@@ -103,6 +150,11 @@ class BinaryFile:
         """
         Closes the file.
         """
+        if self.use_memmap:
+            if self.write_file is not None and not isinstance(self.write_file, str):
+                self.write_file.flush()
+            return
+        self._flush_writes()
         self.read_file.close()
         if self.write_file:
             self.write_file.close()
@@ -113,15 +165,22 @@ class BinaryFile:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
 
-    def __getitem__(self, *items):
+    def __getitem__(self, items):
+        if not isinstance(items, tuple):
+            items = (items,)
         frame_indices, *crop = items
+        if self.use_memmap:
+            # integer, slice and crop indexing returns int16 views into the memmap
+            if isinstance(frame_indices, (int, np.integer)):
+                frame_indices = slice(frame_indices, frame_indices + 1)
+            return self.read_file[(frame_indices,) + tuple(crop)]
         if isinstance(frame_indices, int):
             frames = self.ix(indices=[frame_indices], is_slice=False)
         elif isinstance(frame_indices, slice):
             frames = self.ix(indices=from_slice(frame_indices), is_slice=True)
         else:
             frames = self.ix(indices=frame_indices)
-        return frames[(slice(None),) + crop] if crop else frames
+        return frames[(slice(None),) + tuple(crop)] if crop else frames
 
     def sampled_mean(self) -> float:
         """
@@ -130,10 +189,98 @@ class BinaryFile:
         n_frames = self.n_frames
         nsamps = min(n_frames, 1000)
         inds = np.linspace(0, n_frames, 1+nsamps).astype(np.int64)[:-1]
-        frames = self.ix(indices=inds).astype(np.float32)
+        frames = self.sample_frames(indices=inds).astype(np.float32)
         return frames.mean(axis=0)
 
-    def iter_frames(self, batch_size: int = 1, dtype=np.float32):
+    def sample_frames(self, indices: Sequence[int], max_gap: int = 8, n_workers: int = 4,
+                      max_run_nbytes: int = 2**28) -> np.ndarray:
+        """
+        Returns the frames at scattered index values "indices" using coalesced positional reads.
+
+        Indices are sorted and merged into runs (frames less than max_gap apart are read in the
+        same request, the frames in between are discarded), and the runs are read with os.preadv
+        from a small thread pool straight into the output array. The file pointer is not moved.
+
+        Parameters
+        ----------
+        indices: int array
+            The frame indices to get, in any order and possibly repeated
+        max_gap: int, default 8
+            Maximum number of unrequested frames read through to merge two requested frames
+        n_workers: int, default 4
+            Number of threads issuing reads
+        max_run_nbytes: int, default 256 MB
+            Maximum number of bytes spanned by one request (at least one frame)
+
+        Returns
+        -------
+        frames: len(indices) x Ly x Lx
+            The requested frames, int16, in the order of "indices"
+        """
+        indices = np.asarray(indices, dtype=np.int64).ravel()
+        frames = np.empty((len(indices), self.Ly, self.Lx), np.int16)
+        if len(indices) == 0:
+            return frames
+        if indices.min() < 0 or indices.max() >= self.n_frames:
+            raise IndexError("frame indices out of range for file with %d frames" % self.n_frames)
+        if self.use_memmap:
+            frames[:] = self.read_file[indices]
+            return frames
+        self._flush_writes()
+        if self.compressed or not hasattr(os, 'preadv'):
+            with temporary_pointer(self.read_file) as f:
+                for frame, ixx in zip(frames, indices):
+                    f.seek(self.nbytesread * ixx)
+                    frame[:] = np.frombuffer(f.read(self.nbytesread), dtype=np.int16).reshape(self.Ly, self.Lx)
+            return frames
+
+        uinds, inverse = np.unique(indices, return_inverse=True)
+        in_order = len(uinds) == len(indices)
+        out = frames if in_order else np.empty((len(uinds), self.Ly, self.Lx), np.int16)
+        nbytes = int(self.nbytesread)
+
+        # split sorted indices into runs of nearby frames, capped so that each request
+        # stays below the iovec limit and spans at most max_run_nbytes
+        breaks = np.nonzero(np.diff(uinds) > max_gap + 1)[0] + 1
+        max_span = max(1, max_run_nbytes // nbytes)
+        runs = []
+        for run in np.split(np.arange(len(uinds)), breaks):
+            while len(run) > 0:
+                n = min(256, int(np.searchsorted(uinds[run], uinds[run[0]] + max_span)))
+                runs.append(run[:n])
+                run = run[n:]
+
+        self.read_file.flush()
+        fd = self.read_file.fileno()
+
+        def read_run(run):
+            scratch = np.empty(max_gap * nbytes, np.uint8)
+            buffers = []
+            for k, ixx in enumerate(uinds[run]):
+                if k > 0 and ixx - uinds[run[k - 1]] > 1:
+                    buffers.append(scratch[:(ixx - uinds[run[k - 1]] - 1) * nbytes])
+                buffers.append(out[run[k]].reshape(-1).view(np.uint8))
+            offset = nbytes * int(uinds[run[0]])
+            # preadv may return fewer bytes than requested (e.g. ~2 GB per call on Linux)
+            while buffers:
+                nread = os.preadv(fd, buffers, offset)
+                if nread == 0:
+                    raise IOError("short read from %s at byte %d" % (self.read_filename, offset))
+                offset += nread
+                while buffers and nread >= len(buffers[0]):
+                    nread -= len(buffers[0])
+                    buffers.pop(0)
+                if nread > 0:
+                    buffers[0] = buffers[0][nread:]
+
+        with ThreadPoolExecutor(max_workers=min(n_workers, len(runs))) as executor:
+            list(executor.map(read_run, runs))
+
+        if not in_order:
+            frames[:] = out[inverse]
+        return frames
+
+    def iter_frames(self, batch_size: int = 1, dtype=np.float32, prefetch: int = 0):
         """
         Iterates through each set of frames, depending on batch_size, yielding both the frame index and frame data.
 
@@ -143,6 +290,9 @@ class BinaryFile:
             The number of frames to get at a time
         dtype: np.dtype
             The nympy data type that the data should return as
+        prefetch: int, default 0
+            Number of batches read ahead on a background thread while the current batch is
+            processed (0 reads each batch when it is requested)
 
         Yields
         ------
@@ -151,6 +301,9 @@ class BinaryFile:
         data: batch_size x Ly x Lx
             The frames
         """
+        if prefetch > 0 and (self.use_memmap or self.compressed or hasattr(os, 'pread')):
+            yield from self._iter_frames_prefetch(batch_size=batch_size, dtype=dtype, prefetch=prefetch)
+            return
         while True:
             results = self.read(batch_size=batch_size, dtype=dtype)
             if results is None:
@@ -158,6 +311,76 @@ class BinaryFile:
             indices, data = results
             yield indices, data
 
+    def _read_at(self, i0: int, batch_size: int, dtype=np.float32) -> Optional[np.ndarray]:
+        """reads batch_size frames starting at frame i0 without using the file pointer."""
+        if self.use_memmap:
+            data = self.read_file[i0 : i0 + batch_size]
+            if dtype is not None:
+                data = data.astype(dtype)
+        else:
+            if isinstance(self.read_file, (ChunkedFile, VirtualFile)):
+                buff = self.read_file.pread(int(self.nbytesread) * batch_size, int(self.nbytesread) * i0)
+            else:
+                buff = os.pread(self.read_file.fileno(), int(self.nbytesread) * batch_size, int(self.nbytesread) * i0)
+            data = np.frombuffer(buff, dtype=np.int16, offset=0).reshape(-1, self.Ly, self.Lx)
+            data = data.astype(np.int16 if dtype is None else dtype)
+        return data if data.size > 0 else None
+
+    def _iter_frames_prefetch(self, batch_size: int, dtype, prefetch: int):
+        """
+        iter_frames with a reader thread filling a bounded queue of batches.
+
+        Batches are read with positional reads ahead of the current position; when reading and
+        writing the same file, the batches read ahead never overlap the batch that is written
+        back, so the in-place read/write order of iter_frames is kept.
+        """
+        batches = queue.Queue(maxsize=prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def reader(i0):
+            try:
+                while not stop.is_set():
+                    data = self._read_at(i0, batch_size, dtype)
+                    put(data)
+                    if data is None:
+                        return
+                    i0 += data.shape[0]
+            except Exception as e:
+                put(e)
+
+        if not self.use_memmap:
+            self.read_file.flush()
+        thread = threading.Thread(target=reader, args=(self._index,), daemon=True)
+        thread.start()
+        try:
+            while True:
+                if not self._can_read:
+                    raise IOError("BinaryFile needs to write before it can read again.")
+                data = batches.get()
+                if isinstance(data, Exception):
+                    raise data
+                if data is None:
+                    break
+                indices = np.arange(self._index, self._index + data.shape[0])
+                self._index += data.shape[0]
+                if self.read_file is self.write_file:
+                    self._can_read = False
+                yield indices, data
+        finally:
+            stop.set()
+            thread.join()
+            # keep the file pointer in step with _index for subsequent calls to read()
+            if not self.use_memmap and not self.read_file.closed:
+                self.read_file.seek(self.nbytesread * self._index)
+
     def ix(self, indices: Sequence[int], is_slice=False):
         """
         Returns the frames at index values "indices".
@@ -175,22 +398,16 @@ class BinaryFile:
         frames: len(indices) x Ly x Lx
             The requested frames
         """
+        if self.use_memmap:
+            return self.read_file[indices]
         if not is_slice:
-            frames = np.empty((len(indices), self.Ly, self.Lx), np.int16)
-            # load and bin data
-            with temporary_pointer(self.read_file) as f:
-                for frame, ixx in zip(frames, indices):
-                    if ixx!=self._index:
-                        f.seek(self.nbytesread * ixx)
-                    buff = f.read(self.nbytesread)
-                    data = np.frombuffer(buff, dtype=np.int16, offset=0)
-                    frame[:] = np.reshape(data, (self.Ly, self.Lx))
-                    self._index = ixx+1
+            frames = self.sample_frames(indices=indices)
         else:
+            self._flush_writes()
             i0 = indices[0]
             batch_size = len(indices)
             if self._index != i0:
-                f.seek(self.nbytesread * i0)
+                self.read_file.seek(self.nbytesread * i0)
             _, frames = self.read(batch_size=batch_size, dtype=np.int16)
             self._index = i0 + batch_size
         
@@ -206,7 +423,13 @@ class BinaryFile:
         frames: nImg x Ly x Lx
             The frame data
         """
+        if self.use_memmap:
+            return self.read_file
+        self._flush_writes()
         with temporary_pointer(self.read_file) as f:
+            if isinstance(f, (ChunkedFile, VirtualFile)):
+                f.seek(0)
+                return np.frombuffer(f.read(), np.int16).reshape(-1, self.Ly, self.Lx)
             return np.fromfile(f, np.int16).reshape(-1, self.Ly, self.Lx)
 
     def read(self, batch_size=1, dtype=np.float32) -> Optional[Tuple[np.ndarray, np.ndarray]]:
@@ -217,14 +440,23 @@ class BinaryFile:
         ----------
         batch_size: int
             The number of frames to read at once.
+        dtype: np.dtype
+            The data type to convert the frames to; if None (or int16 with use_memmap)
+            the int16 frames are returned without conversion
         frames: batch_size x Ly x Lx
             The frame data
         """
         if not self._can_read:
             raise IOError("BinaryFile needs to write before it can read again.")
-        nbytes = self.nbytesread * batch_size
-        buff = self.read_file.read(nbytes)
-        data = np.frombuffer(buff, dtype=np.int16, offset=0).reshape(-1, self.Ly, self.Lx).astype(dtype)
+        if self.use_memmap:
+            data = self.read_file[self._index : self._index + batch_size]
+            if dtype is not None:
+                data = data.astype(dtype, copy=False)
+        else:
+            nbytes = self.nbytesread * batch_size
+            buff = self.read_file.read(nbytes)
+            data = np.frombuffer(buff, dtype=np.int16, offset=0).reshape(-1, self.Ly, self.Lx)
+            data = data.astype(np.int16 if dtype is None else dtype)
         if data.size == 0:
             return None
         indices = np.arange(self._index, self._index + data.shape[0])
@@ -244,12 +476,80 @@ class BinaryFile:
         """
         if self._can_read and self.read_file is self.write_file:
             raise IOError("BinaryFile needs to read before it can write again.")
-        if not self.write_file:
+        if self.write_file is None or isinstance(self.write_file, str):
             raise IOError("No write_file specified, writing not possible.")
+        if self.use_memmap:
+            data = data.reshape(-1, self.Ly, self.Lx)
+            if self.read_file is self.write_file:
+                # write back to the frames that were last read
+                i0 = self._index - data.shape[0]
+                self._can_read = True
+            else:
+                i0 = self._write_index
+            # skip the copy only when data is exactly the view of the frames being written (data that
+            # merely overlaps them, e.g. shifted by a frame, is copied)
+            target = self.write_file[i0 : i0 + data.shape[0]]
+            if not (data.dtype == target.dtype and data.shape == target.shape and data.strides == target.strides
+                    and data.__array_interface__['data'][0] == target.__array_interface__['data'][0]):
+                target[:] = np.minimum(data, 2 ** 15 - 2)
+            self._write_index = i0 + data.shape[0]
+            return
+        data = np.minimum(data, 2 ** 15 - 2).astype('int16')
+        n_frames = data.size // (self.Ly * self.Lx)
         if self.read_file is self.write_file:
-            self.write_file.seek(-2 * data.size, 1)
+            # write back to the frames that were last read
+            i0 = self._index - n_frames
             self._can_read = True
-        self.write_file.write(bytearray(np.minimum(data, 2 ** 15 - 2).astype('int16')))
+        else:
+            i0 = self._write_index
+        self._write_index = i0 + n_frames
+        if self.write_behind:
+            self._queue_write(self.nbytesread * i0, data)
+            return
+        if self.read_file is self.write_file:
+            self.write_file.seek(self.nbytesread * i0)
+        self.write_file.write(bytearray(data))
+
+    def _queue_write(self, offset: int, data: np.ndarray) -> None:
+        """hands data to the write-behind thread, starting it if needed."""
+        if self._write_error is not None:
+            self._flush_writes()
+        if self._write_thread is None:
+            self.write_file.flush()
+            self._write_queue = queue.Queue(maxsize=2)
+            self._write_thread = threading.Thread(target=self._writer, daemon=True)
+            self._write_thread.start()
+        self._write_queue.put((int(offset), data))
+
+    def _writer(self) -> None:
+        """write-behind thread: writes queued buffers at their offsets until it receives None."""
+        fd = self.write_file.fileno()
+        while True:
+            item = self._write_queue.get()
+            if item is None:
+                return
+            if self._write_error is not None:
+                continue
+            offset, data = item
+            try:
+                buff = memoryview(data).cast('B')
+                while len(buff):
+                    n = os.pwrite(fd, buff, offset)
+                    buff, offset = buff[n:], offset + n
+            except OSError as e:
+                self._write_error = e
+
+    def _flush_writes(self) -> None:
+        """waits for the write-behind thread to finish all queued writes."""
+        if self._write_thread is not None:
+            self._write_queue.put(None)
+            self._write_thread.join()
+            self._write_thread = None
+            # drops any read buffer that may predate the positional writes
+            self.write_file.flush()
+        if self._write_error is not None:
+            error, self._write_error = self._write_error, None
+            raise IOError("write-behind failed for %s" % self.write_filename) from error
 
     def bin_movie(self, bin_size: int, x_range: Optional[Tuple[int, int]] = None, y_range: Optional[Tuple[int, int]] = None,
                   bad_frames: Optional[np.ndarray] = None, reject_threshold: float = 0.5) -> np.ndarray:
@@ -281,7 +581,7 @@ class BinaryFile:
         print("Batch size: %2f" % batch_size)
         print("bin size: %2f" % bin_size)
         batches = []
-        for indices, data in self.iter_frames(batch_size=batch_size):
+        for indices, data in self.iter_frames(batch_size=batch_size, dtype=None):
             print("  Indices: ", indices)
             print("  Data shape: ", data.shape)
             if len(data) != batch_size:
@@ -324,7 +624,7 @@ def temporary_pointer(file):
 class BinaryFileCombined:
 
     def __init__(self, LY: int, LX: int, Ly: np.ndarray, Lx: np.ndarray, 
-                 dy: np.ndarray, dx: np.ndarray, read_filenames: str):
+                 dy: np.ndarray, dx: np.ndarray, read_filenames: str, use_memmap: bool = False):
         """
         Creates/Opens a Suite2p BinaryFile for reading image data across planes
 
@@ -344,6 +644,8 @@ class BinaryFileCombined:
             The x-positions of each frame
         read_filenames: array of str
             The filenames of the files to read from
+        use_memmap: bool, default False
+            Access the files through np.memmap instead of buffered reads
         """
         self.LY = LY
         self.LX = LX
@@ -352,8 +654,13 @@ class BinaryFileCombined:
         self.dy = dy
         self.dx = dx
         self.read_filenames = read_filenames
-        
-        self.read_files = [open(read_filename, mode='rb') for read_filename in self.read_filenames]
+        self.use_memmap = use_memmap
+
+        if use_memmap:
+            self.read_files = [np.memmap(read_filename, mode='r', dtype=np.int16).reshape(-1, Ly[n], Lx[n])
+                               for n, read_filename in enumerate(self.read_filenames)]
+        else:
+            self.read_files = [open_binary(read_filename, mode='rb') for read_filename in self.read_filenames]
         self._index = 0
         self._can_read = True
 
@@ -367,6 +674,8 @@ class BinaryFileCombined:
         """
         Closes the file.
         """
+        if self.use_memmap:
+            return
         for n in range(len(self.read_files)):
             self.read_files[n].close()
 
@@ -380,6 +689,9 @@ class BinaryFileCombined:
         """total number of bytes in the read_file."""
         nbytes = np.zeros(len(self.read_files), np.int64)
         for i,read_file in enumerate(self.read_files):
+            if self.use_memmap:
+                nbytes[i] = read_file.nbytes
+                continue
             with temporary_pointer(read_file) as f:
                 f.seek(0, 2)
                 nbytes[i] = f.tell()
@@ -406,9 +718,13 @@ class BinaryFileCombined:
             raise IOError("BinaryFile needs to write before it can read again.")
 
         for n, (nbytesr, read_file) in enumerate(zip(self.nbytesread, self.read_files)):
-            nbytes = nbytesr * batch_size
-            buff = read_file.read(nbytes)
-            data = np.frombuffer(buff, dtype=np.int16, offset=0).reshape(-1, self.Ly[n], self.Lx[n]).astype(dtype)
+            if self.use_memmap:
+                # int16 view, copied once into the stitched frame below
+                data = read_file[self._index : self._index + batch_size]
+            else:
+                nbytes = nbytesr * batch_size
+                buff = read_file.read(nbytes)
+                data = np.frombuffer(buff, dtype=np.int16, offset=0).reshape(-1, self.Ly[n], self.Lx[n])
             if data.size == 0:
                 return None
             if n==0:
@@ -0,0 +1,332 @@
+"""
+Chunked, losslessly compressed container for int16 movies, used as a drop-in for raw binary files.
+
+The logical content of a container is the same byte stream as a raw suite2p binary (int16 frames),
+split into chunks of a fixed number of bytes that are filtered (delta of neighbouring pixels and
+byte shuffle) and compressed independently, so that any frame can be read without decoding the
+whole file.
+
+Layout::
+
+    header   MAGIC | version (u4) | codec (u4) | chunk_bytes (u8) | reserved (u8)
+    chunks   compressed nbytes (u8) | logical nbytes (u8) | compressed data, repeated
+    index    file offset, compressed nbytes, logical nbytes (u8 each) per chunk
+    trailer  index offset (u8) | number of chunks (u8) | logical nbytes (u8) | MAGIC
+
+The index and trailer are written on close; if they are missing (interrupted write),
+the chunk headers are scanned to rebuild the index.
+"""
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+try:
+    import zstandard
+    HAS_ZSTD = True
+except ImportError:
+    HAS_ZSTD = False
+
+try:
+    import blosc
+    HAS_BLOSC = True
+except ImportError:
+    HAS_BLOSC = False
+
+from .virtual import open_virtual, is_virtual
+
+MAGIC = b'S2PCHNK1'
+VERSION = 1
+HEADER_BYTES = 32
+TRAILER_BYTES = 32
+CODECS = {'zlib': 0, 'zstd': 1, 'blosc': 2}
+DEFAULT_CHUNK_BYTES = 2 ** 22
+
+
+def is_chunked(filename) -> bool:
+    """Returns True if filename is a chunked compressed container."""
+    try:
+        with open(filename, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except (FileNotFoundError, IsADirectoryError):
+        return False
+
+
+def open_binary(filename, mode: str = 'rb', compression: Optional[str] = None,
+                chunk_bytes: Optional[int] = None):
+    """
+    Opens a binary file for frames, returning a ChunkedFile for compressed containers and a
+    virtual.VirtualFile for virtual tiff- or HDF5-backed binaries (read-only).
+
+    Parameters
+    ----------
+    filename: str
+        The file to open
+    mode: str
+        'rb', 'r+b' or 'wb'; for reading, compressed containers are detected from their header
+    compression: str (optional, default None)
+        'zstd', 'blosc' or 'zlib' to create a compressed container in 'wb' mode, else raw int16
+    chunk_bytes: int (optional)
+        The uncompressed size of each chunk when creating a container
+
+    Returns
+    -------
+    file: file object, ChunkedFile or virtual.VirtualFile
+    """
+    if mode == 'wb':
+        if compression:
+            return ChunkedFile(filename, mode, compression=compression, chunk_bytes=chunk_bytes)
+        return open(filename, mode)
+    if is_virtual(filename):
+        if mode != 'rb':
+            raise IOError("%s is a virtual binary and cannot be written in place" % filename)
+        return open_virtual(filename)
+    if is_chunked(filename):
+        return ChunkedFile(filename, mode)
+    return open(filename, mode)
+
+
+def file_nbytes(filename) -> int:
+    """Returns the number of bytes of frame data in a raw binary, compressed container or virtual binary."""
+    if is_chunked(filename):
+        with ChunkedFile(filename, 'rb') as f:
+            return f.nbytes
+    if is_virtual(filename):
+        with open_virtual(filename) as f:
+            return f.nbytes
+    return os.path.getsize(filename)
+
+
+def _compress(buff: bytes, codec: int) -> bytes:
+    data = np.frombuffer(buff, np.uint16)
+    # delta of neighbouring pixels (with int16 wrap-around) and byte shuffle
+    delta = np.empty_like(data)
+    delta[:1] = data[:1]
+    np.subtract(data[1:], data[:-1], out=delta[1:])
+    if codec == CODECS['blosc']:
+        return blosc.compress(delta.tobytes(), typesize=2, shuffle=blosc.SHUFFLE, cname='zstd', clevel=3)
+    shuffled = delta.view(np.uint8).reshape(-1, 2).T.tobytes()
+    if codec == CODECS['zstd']:
+        return zstandard.ZstdCompressor(level=3).compress(shuffled)
+    return zlib.compress(shuffled, 1)
+
+
+def _decompress(buff: bytes, codec: int, nbytes: int) -> np.ndarray:
+    if codec == CODECS['blosc']:
+        delta = np.frombuffer(blosc.decompress(buff), np.uint16)
+    else:
+        if codec == CODECS['zstd']:
+            shuffled = zstandard.ZstdDecompressor().decompress(buff, max_output_size=nbytes)
+        else:
+            shuffled = zlib.decompress(buff)
+        delta = np.frombuffer(shuffled, np.uint8).reshape(2, -1).T.copy().view(np.uint16).ravel()
+    return np.cumsum(delta, dtype=np.uint16).view(np.uint8)
+
+
+class ChunkedFile:
+
+    def __init__(self, filename: str, mode: str = 'rb', compression: Optional[str] = None,
+                 chunk_bytes: Optional[int] = None, n_cached: int = 4):
+        """
+        File-like access to the logical (uncompressed) bytes of a chunked container.
+
+        'rb' supports random access with read/seek/pread; 'wb' supports sequential writes;
+        'r+b' reads from the container and writes sequentially into a new container that
+        replaces it on close (frames that were not rewritten are copied over), as needed
+        for the in-place read/write of BinaryFile.
+
+        Parameters
+        ----------
+        filename: str
+            The container file
+        mode: str
+            'rb', 'r+b' or 'wb'
+        compression: str (optional, default None)
+            codec for 'wb': 'zstd' (if installed), 'blosc' (if installed) or 'zlib'
+        chunk_bytes: int (optional)
+            uncompressed chunk size for 'wb' (rounded to an even number of bytes)
+        n_cached: int, default 4
+            number of decoded chunks kept in memory
+        """
+        self.filename = filename
+        self.mode = mode
+        self.closed = False
+        self._pos = 0
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._n_cached = n_cached
+        self._writer = None
+
+        if mode == 'wb':
+            codec = compression or 'zlib'
+            if codec not in CODECS:
+                raise ValueError("compression must be one of %s" % list(CODECS))
+            if (codec == 'zstd' and not HAS_ZSTD) or (codec == 'blosc' and not HAS_BLOSC):
+                print('NOTE: %s not installed, compressing binary with zlib' % codec)
+                codec = 'zlib'
+            self.codec = CODECS[codec]
+            self.chunk_bytes = int(chunk_bytes or DEFAULT_CHUNK_BYTES) // 2 * 2
+            self._file = open(filename, 'wb')
+            self._file.write(MAGIC + np.array([VERSION, self.codec], np.uint32).tobytes()
+                             + np.array([self.chunk_bytes, 0], np.uint64).tobytes())
+            self._index = []
+            self._pending = bytearray()
+            self.nbytes = 0
+        elif mode in ['rb', 'r+b']:
+            self._file = open(filename, 'rb')
+            header = self._file.read(HEADER_BYTES)
+            if header[:len(MAGIC)] != MAGIC:
+                raise IOError("%s is not a chunked binary file" % filename)
+            self.codec = int(np.frombuffer(header, np.uint32, count=1, offset=12)[0])
+            self.chunk_bytes = int(np.frombuffer(header, np.uint64, count=1, offset=16)[0])
+            if (self.codec == CODECS['zstd'] and not HAS_ZSTD) or (self.codec == CODECS['blosc'] and not HAS_BLOSC):
+                raise ImportError("reading %s requires %s" % (filename, 'zstandard' if self.codec == CODECS['zstd'] else 'blosc'))
+            self._index = self._read_index()
+            self.nbytes = int(self._index[:, 2].sum())
+            if mode == 'r+b':
+                self._writer = ChunkedFile(filename + '.tmp', 'wb', chunk_bytes=self.chunk_bytes,
+                                           compression={v: k for k, v in CODECS.items()}[self.codec])
+        else:
+            raise ValueError("mode must be 'rb', 'r+b' or 'wb'")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _read_index(self) -> np.ndarray:
+        """reads the chunk index from the trailer, or rebuilds it from the chunk headers."""
+        self._file.seek(0, 2)
+        size = self._file.tell()
+        if size >= HEADER_BYTES + TRAILER_BYTES:
+            self._file.seek(size - TRAILER_BYTES)
+            trailer = self._file.read(TRAILER_BYTES)
+            if trailer[-len(MAGIC):] == MAGIC:
+                index_offset, nchunks = np.frombuffer(trailer, np.uint64, count=2)
+                self._file.seek(int(index_offset))
+                index = np.frombuffer(self._file.read(int(nchunks) * 24), np.uint64)
+                return index.reshape(-1, 3).astype(np.int64)
+        print('NOTE: %s has no chunk index (incomplete write), scanning chunks' % self.filename)
+        index = []
+        offset = HEADER_BYTES
+        while offset + 16 <= size:
+            self._file.seek(offset)
+            ncomp, nlogical = np.frombuffer(self._file.read(16), np.uint64).astype(np.int64)
+            if ncomp == 0 or offset + 16 + ncomp > size:
+                break
+            index.append([offset + 16, ncomp, nlogical])
+            offset += 16 + ncomp
+        return np.array(index, np.int64).reshape(-1, 3)
+
+    def _chunk(self, k: int) -> np.ndarray:
+        """returns decoded chunk k (uint8), caching the most recently used chunks."""
+        with self._lock:
+            if k in self._cache:
+                self._cache.move_to_end(k)
+                return self._cache[k]
+            offset, ncomp, nlogical = self._index[k]
+            self._file.seek(int(offset))
+            buff = self._file.read(int(ncomp))
+        data = _decompress(buff, self.codec, int(nlogical))
+        with self._lock:
+            self._cache[k] = data
+            if len(self._cache) > self._n_cached:
+                self._cache.popitem(last=False)
+        return data
+
+    def pread(self, nbytes: int, offset: int) -> bytearray:
+        """reads up to nbytes of logical data at offset without moving the file position."""
+        if self.mode == 'wb':
+            raise IOError("ChunkedFile opened for writing, reading not possible.")
+        nbytes = max(0, min(nbytes, self.nbytes - offset))
+        out = bytearray(nbytes)
+        done = 0
+        while done < nbytes:
+            k, i0 = divmod(offset + done, self.chunk_bytes)
+            chunk = self._chunk(k)
+            n = min(nbytes - done, len(chunk) - i0)
+            out[done:done + n] = chunk[i0:i0 + n].tobytes()
+            done += n
+        return out
+
+    def read(self, nbytes: int = -1) -> bytearray:
+        if nbytes is None or nbytes < 0:
+            nbytes = self.nbytes - self._pos
+        buff = self.pread(nbytes, self._pos)
+        self._pos += len(buff)
+        return buff
+
+    def write(self, buff) -> int:
+        if self.mode == 'rb':
+            raise IOError("ChunkedFile opened for reading, writing not possible.")
+        if self.mode == 'r+b':
+            if self._pos != self._writer.nbytes:
+                raise IOError("compressed binary files can only be rewritten sequentially")
+            n = self._writer.write(buff)
+            self._pos += n
+            return n
+        if self._pos != self.nbytes:
+            raise IOError("compressed binary files can only be written sequentially")
+        buff = memoryview(buff).cast('B')
+        self._pending += buff
+        self.nbytes += len(buff)
+        self._pos = self.nbytes
+        while len(self._pending) >= self.chunk_bytes:
+            self._write_chunk(bytes(self._pending[:self.chunk_bytes]))
+            del self._pending[:self.chunk_bytes]
+        return len(buff)
+
+    def _write_chunk(self, buff: bytes) -> None:
+        comp = _compress(buff, self.codec)
+        self._file.write(np.array([len(comp), len(buff)], np.uint64).tobytes())
+        self._index.append([self._file.tell(), len(comp), len(buff)])
+        self._file.write(comp)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self.nbytes
+        self._pos = int(offset)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        if self.mode == 'wb':
+            if len(self._pending):
+                self._write_chunk(bytes(self._pending))
+                self._pending = bytearray()
+            index_offset = self._file.tell()
+            self._file.write(np.array(self._index, np.uint64).reshape(-1, 3).tobytes())
+            self._file.write(np.array([index_offset, len(self._index), self.nbytes], np.uint64).tobytes() + MAGIC)
+            self._file.close()
+        elif self.mode == 'r+b':
+            if self._writer.nbytes > 0:
+                # copy the frames that were not rewritten, then replace the original
+                offset = self._writer.nbytes
+                while offset < self.nbytes:
+                    buff = self.pread(self.chunk_bytes, offset)
+                    self._writer.write(buff)
+                    offset += len(buff)
+                self._writer.close()
+                self._file.close()
+                os.replace(self._writer.filename, self.filename)
+            else:
+                self._writer.close()
+                self._file.close()
+                os.remove(self._writer.filename)
+        else:
+            self._file.close()
+        self._cache.clear()
+        self.closed = True
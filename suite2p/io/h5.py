@@ -1,10 +1,13 @@
 import math
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 import h5py
 import numpy as np
 import os
 
 from .utils import init_ops, find_files_open_binaries
+from . import manifest
 
 
 def h5py_to_binary(ops):
@@ -15,6 +18,8 @@ def h5py_to_binary(ops):
     ops : dictionary
         'nplanes', 'h5_path', 'h5_key', 'save_path', 'save_folder', 'fast_disk',
         'nchannels', 'keep_movie_raw', 'look_one_level_down'
+        (optional 'resume_ingest': continue after the last file written by an interrupted run, see io.manifest)
+        (optional 'io_workers': number of processes decompressing chunked, compressed datasets)
 
     Returns
     -------
@@ -28,7 +33,7 @@ def h5py_to_binary(ops):
     nchannels = ops1[0]['nchannels']
 
     # open all binary files for writing
-    ops1, h5list, reg_file, reg_file_chan2 = find_files_open_binaries(ops1, True)
+    ops1, h5list, reg_file, reg_file_chan2 = find_files_open_binaries(ops1, True, resumable=True)
     for ops in ops1:
         if not ops.get('data_path'):
             ops['data_path'] = [os.path.dirname(ops['h5py'])]
@@ -36,68 +41,50 @@ def h5py_to_binary(ops):
     keys = ops1[0]['h5py_key']
     if isinstance(keys, str):
         keys = [keys]
-    iall = 0
     for j in range(ops['nplanes']):
         ops1[j]['nframes_per_folder'] = np.zeros(len(h5list), np.int32)
+    # files already written by an interrupted run
+    nfiles_done, state = manifest.resume_counters(ops1)
+    iall = state.get('iall', 0)
 
+    nfunc = ops1[0]['functional_chan'] - 1 if nchannels > 1 else 0
     for ih5,h5 in enumerate(h5list):
-        with h5py.File(h5, 'r') as f:
+        if ih5 < nfiles_done:
+            continue
+        for key in keys:
             # if h5py data is 5D or 4D instead of 3D, assume that
-            # data = (nchan x) (nframes x) nplanes x pixels x pixels 
-            # 5D/4D data is flattened to process the same way as interleaved data
-            for key in keys:
-                hdims = f[key].ndim
-                # keep track of the plane identity of the first frame (channel identity is assumed always 0)
-                ncp = nplanes*nchannels
-                nbatch = ncp * math.ceil(ops1[0]['batch_size'] / ncp)
-                nframes_all = f[key].shape[0] if hdims == 3 else f[key].shape[0] * f[key].shape[1]
-                nbatch = min(nbatch, nframes_all)
-                nfunc = ops['functional_chan'] - 1 if nchannels > 1 else 0
-                # loop over all tiffs
-                ik = 0
-                while 1:
-                    if hdims==3:
-                        irange = np.arange(ik, min(ik+nbatch, nframes_all), 1)
-                        if irange.size==0:
-                            break
-                        im = f[key][irange, :, :]
-                    else:
-                        irange = np.arange(ik/ncp, 
-                                           min(ik/ncp + nbatch/ncp, nframes_all/ncp), 1)
-                        if irange.size==0:
-                            break
-                        im = f[key][irange,...]
-                        if im.ndim==5 and im.shape[0] == nchannels:
-                            im = im.transpose((1,0,2,3,4))
-                        # flatten to frames x pixels x pixels
-                        im = np.reshape(im, (-1, im.shape[-2], im.shape[-1]))
-                    nframes = im.shape[0]
-                    if type(im[0,0,0]) == np.uint16:
-                        im = im / 2
-                    for j in range(0,nplanes):
-                        if iall==0:
-                            ops1[j]['meanImg'] = np.zeros((im.shape[1],im.shape[2]),np.float32)
-                            if nchannels>1:
-                                ops1[j]['meanImg_chan2'] = np.zeros((im.shape[1],im.shape[2]),np.float32)
-                            ops1[j]['nframes'] = 0
-                        i0 = nchannels * ((j)%nplanes)
-                        im2write = im[np.arange(int(i0)+nfunc, nframes, ncp),:,:].astype(np.int16)
-                        reg_file[j].write(bytearray(im2write))
-                        ops1[j]['meanImg'] += im2write.astype(np.float32).sum(axis=0)
+            # data = (nchan x) (nframes x) nplanes x pixels x pixels
+            # and read hyperslabs of whole chunks along the frame axis
+            with h5py.File(h5, 'r') as f:
+                taxis, nt_batch, cache_nbytes, parallel, select = h5_layout(f[key], nplanes, nchannels,
+                                                                             ops1[0]['batch_size'])
+            n_workers = ops1[0].get('io_workers', 1) if parallel else 1
+            for im in iter_h5_batches(h5, key, taxis, nt_batch, cache_nbytes, n_workers):
+                if im.dtype == np.uint16:
+                    im = im // 2
+                for j in range(0,nplanes):
+                    if iall==0:
+                        ops1[j]['meanImg'] = np.zeros((im.shape[-2],im.shape[-1]),np.float32)
                         if nchannels>1:
-                            im2write = im[np.arange(int(i0)+1-nfunc, nframes, ncp),:,:].astype(np.int16)
-                            reg_file_chan2[j].write(bytearray(im2write))
-                            ops1[j]['meanImg_chan2'] += im2write.astype(np.float32).sum(axis=0)
-                        ops1[j]['nframes'] += im2write.shape[0]
-                        ops1[j]['nframes_per_folder'][ih5] += im2write.shape[0]
-                    ik += nframes
-                    iall += nframes
+                            ops1[j]['meanImg_chan2'] = np.zeros((im.shape[-2],im.shape[-1]),np.float32)
+                        ops1[j]['nframes'] = 0
+                    im2write = select(im, j, nfunc).astype(np.int16)
+                    reg_file[j].write(bytearray(im2write))
+                    ops1[j]['meanImg'] += im2write.astype(np.float32).sum(axis=0)
+                    if nchannels>1:
+                        im2write = select(im, j, 1 - nfunc).astype(np.int16)
+                        reg_file_chan2[j].write(bytearray(im2write))
+                        ops1[j]['meanImg_chan2'] += im2write.astype(np.float32).sum(axis=0)
+                    ops1[j]['nframes'] += im2write.shape[0]
+                    ops1[j]['nframes_per_folder'][ih5] += im2write.shape[0]
+                iall += im.size // (im.shape[-2] * im.shape[-1])
+        if iall > 0:
+            manifest.checkpoint(ops1, h5list, ih5 + 1, reg_file, reg_file_chan2, {'iall': iall})
 
     # write ops files
     do_registration = ops1[0]['do_registration']
     for ops in ops1:
-        ops['Ly'] = im2write.shape[1]
-        ops['Lx'] = im2write.shape[2]
+        ops['Ly'], ops['Lx'] = ops['meanImg'].shape
         if not do_registration:
             ops['yrange'] = np.array([0,ops['Ly']])
             ops['xrange'] = np.array([0,ops['Lx']])
@@ -111,3 +98,151 @@ def h5py_to_binary(ops):
         if nchannels > 1:
             reg_file_chan2[j].close()
     return ops1[0]
+
+
+def h5_layout(dset, nplanes: int, nchannels: int, batch_size: int):
+    """ returns how to read a dataset of (interleaved) planes and channels in batches
+
+    3D data is frames x Ly x Lx with planes and channels interleaved, 4D data is
+    nframes x (nplanes * nchannels) x Ly x Lx, and 5D data is nframes x nplanes x nchannels x Ly x Lx
+    or nchannels x nframes x nplanes x Ly x Lx
+
+    Parameters
+    ----------
+    dset : h5py.Dataset
+    nplanes : int
+    nchannels : int
+    batch_size : int
+        approximate number of frames per batch
+
+    Returns
+    -------
+    taxis : int
+        frame (time) axis
+    nt_batch : int
+        number of time points per batch, a multiple of nplanes * nchannels for 3D data,
+        and where it fits in max_batch_nbytes a multiple of the chunk size along taxis
+    cache_nbytes : int
+        size of the chunk cache to hold the chunks touched by one batch
+    parallel : bool
+        the dataset is compressed, so decoding batches in worker processes is worthwhile
+    select : function
+        select(im, j, ichan) returns the frames of plane j and channel ichan in batch im (a view)
+
+    """
+    ncp = nplanes * nchannels
+    shape = dset.shape
+    if dset.ndim == 3:
+        taxis = 0
+        step = ncp
+        select = lambda im, j, ichan: im[nchannels * j + ichan::ncp]
+    elif dset.ndim == 4 and shape[1] == ncp:
+        taxis = 0
+        step = 1
+        select = lambda im, j, ichan: im[:, nchannels * j + ichan]
+    elif dset.ndim == 5 and shape[0] == nchannels and shape[2] == nplanes:
+        taxis = 1
+        step = 1
+        select = lambda im, j, ichan: im[ichan, :, j]
+    elif dset.ndim == 5 and shape[1] == nplanes and shape[2] == nchannels:
+        taxis = 0
+        step = 1
+        select = lambda im, j, ichan: im[:, j, ichan]
+    else:
+        raise IOError('h5 dataset of shape %s does not match nplanes=%d, nchannels=%d'
+                      % (str(shape), nplanes, nchannels))
+    nt_batch = step * math.ceil(batch_size / ncp)
+    chunks = dset.chunks
+    if chunks is not None:
+        nt_batch = chunk_aligned_batch(nt_batch, step, chunks[taxis],
+                                       dset.dtype.itemsize * int(np.prod(shape)) // max(1, shape[taxis]))
+    nt_batch = max(1, min(nt_batch, shape[taxis]))
+    cache_nbytes = chunk_cache_nbytes(dset, taxis, nt_batch)
+    parallel = chunks is not None and dset.compression is not None
+    return taxis, nt_batch, cache_nbytes, parallel, select
+
+
+MAX_BATCH_NBYTES = 2**28
+
+
+def chunk_aligned_batch(nt_batch: int, step: int, chunk_len: int, frame_nbytes: int,
+                        max_nbytes: int = MAX_BATCH_NBYTES) -> int:
+    """ returns a batch size close to nt_batch that reads whole chunks along the frame axis
+
+    batches stay a multiple of step; they are rounded up to a whole number of chunks
+    if that fits in max_nbytes, else rounded down if they span at least one chunk,
+    else left unaligned (the chunk cache then keeps chunks shared by consecutive batches)
+
+    Parameters
+    ----------
+    nt_batch : int
+        requested number of time points per batch, a multiple of step
+    step : int
+        batches must be a multiple of step
+    chunk_len : int
+        chunk size along the frame axis
+    frame_nbytes : int
+        number of bytes of one time point
+
+    """
+    period = step * chunk_len // math.gcd(step, chunk_len)
+    nt_up = period * math.ceil(nt_batch / period)
+    if nt_up * frame_nbytes <= max(max_nbytes, nt_batch * frame_nbytes):
+        return nt_up
+    elif nt_batch >= period:
+        return period * (nt_batch // period)
+    return nt_batch
+
+
+def chunk_cache_nbytes(dset, taxis: int, nt_batch: int) -> int:
+    """ returns the size of a chunk cache holding all chunks touched by a batch of nt_batch time points """
+    chunks = dset.chunks
+    if chunks is None:
+        return 0
+    nchunks_t = math.ceil(nt_batch / chunks[taxis]) + (nt_batch % chunks[taxis] != 0)
+    nchunks = nchunks_t * int(np.prod([math.ceil(n / c) for d, (n, c) in enumerate(zip(dset.shape, chunks))
+                                       if d != taxis]))
+    return nchunks * int(np.prod(chunks)) * dset.dtype.itemsize
+
+
+_h5_files = {}
+
+
+def _read_h5_hyperslab(filename: str, key: str, taxis: int, t0: int, t1: int, cache_nbytes: int) -> np.ndarray:
+    """ reads time points t0:t1 of dataset key, keeping the file open in the (worker) process """
+    if filename not in _h5_files:
+        _h5_files[filename] = h5py.File(filename, 'r', rdcc_nbytes=max(cache_nbytes, 2**20),
+                                        rdcc_nslots=max(521, 101 * (cache_nbytes // 2**16)))
+    dset = _h5_files[filename][key]
+    return dset[t0:t1] if taxis == 0 else dset[:, t0:t1]
+
+
+def iter_h5_batches(filename: str, key: str, taxis: int, nt_batch: int, cache_nbytes: int = 0,
+                    n_workers: int = 1):
+    """ yields hyperslabs of nt_batch time points of dataset key in order
+
+    with n_workers > 1, batches are read (and decompressed) by a pool of processes,
+    at most 2*n_workers batches ahead of the consumer
+
+    """
+    with h5py.File(filename, 'r') as f:
+        nt = f[key].shape[taxis]
+    if n_workers <= 1:
+        try:
+            for t0 in range(0, nt, nt_batch):
+                yield _read_h5_hyperslab(filename, key, taxis, t0, min(nt, t0 + nt_batch), cache_nbytes)
+        finally:
+            f = _h5_files.pop(filename, None)
+            if f is not None:
+                f.close()
+        return
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        pending = deque()
+        for t0 in range(0, nt, nt_batch):
+            pending.append(executor.submit(_read_h5_hyperslab, filename, key, taxis, t0,
+                                           min(nt, t0 + nt_batch), cache_nbytes))
+            if len(pending) >= 2 * n_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
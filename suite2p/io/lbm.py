@@ -10,6 +10,9 @@ import imreg_dft as imreg
 import json
 import psutil
 import tracemalloc
+import weakref
+
+from . import tiffmeta
 
 def default_log(string, val=None): print(string)
 lbm_plane_to_ch = n.array([1,5,6,7,8,9,2,10,11,12,13,14,15,16,17,3,18,19,20,21,22,23,4,24,25,26,27,28,29,30])-1
@@ -33,21 +36,26 @@ def load_and_stitch_tifs(paths, planes, verbose=True,n_proc=15, mp_args = {}, fi
         debug (bool, optional): Debugging mode. Defaults to False.
 
     Returns:
-        _type_: _description_
+        mov: stitched movie (planes x time x y x x), or a list of shared-memory-backed movies per file if concat is False
     '''
     
 
 
     if convert_plane_ids_to_channel_ids:
         channels = lbm_plane_to_ch[n.array(planes)]
+    else:
+        channels = n.array(planes)
     if filt is not None:
         filt = get_filter(filt)
 
     mov_list = []
-    for tif_path in paths:
-        if verbose: log_cb("Loading %s" % tif_path, 2)
-        im, px, py = load_and_stitch_full_tif_mp(tif_path, channels=channels, verbose=False, filt=filt, n_proc=n_proc,debug=debug, **mp_args)
-        mov_list.append(im)
+    tiffmeta.tiff_metadata(paths)
+    # one worker pool and one shared input buffer for all files
+    with SharedTifLoader(n_proc=n_proc) as loader:
+        for tif_path in paths:
+            if verbose: log_cb("Loading %s" % tif_path, 2)
+            im, px, py = load_and_stitch_full_tif_mp(tif_path, channels=channels, verbose=False, filt=filt, n_proc=n_proc,debug=debug, loader=loader, **mp_args)
+            mov_list.append(im)
     if concat:
         mov = n.concatenate(mov_list,axis=1)
         size = mov.nbytes/(1024*1024*1024)
@@ -58,70 +66,154 @@ def load_and_stitch_tifs(paths, planes, verbose=True,n_proc=15, mp_args = {}, fi
     return mov
 
 
-def load_and_stitch_full_tif_mp(path, channels, n_proc=10, verbose=True,translations=None, filt = None, debug=False, get_roi_start_pix=False):
-    tic = time.time()
+class SharedArray(n.ndarray):
+    '''
+    Array backed by a SharedMemory block, which is closed and unlinked once the array
+    (and every view of it) is garbage collected
+    '''
+    def __new__(cls, shape, dtype):
+        shape = tuple(int(s) for s in shape)
+        nbytes = max(1, int(n.prod(shape)) * n.dtype(dtype).itemsize)
+        shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        arr = super().__new__(cls, shape, dtype=dtype, buffer=shm.buf)
+        arr.shm = shm
+        weakref.finalize(arr, release_shared_memory, shm)
+        return arr
+
+    def __array_finalize__(self, obj):
+        self.shm = getattr(obj, 'shm', None)
+
+    @property
+    def params(self):
+        ''' (name, shape, dtype) to attach to the array from another process '''
+        return self.shm.name, self.shape, self.dtype
+
+
+def release_shared_memory(shm):
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+    try:
+        shm.close()
+    except BufferError:
+        pass
+
+
+def attach_shared_array(name, shape, dtype):
+    ''' returns (SharedMemory, array) for a block created in another process '''
+    shm = shared_memory.SharedMemory(name)
+    return shm, n.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+class SharedTifLoader:
+    '''
+    Decodes LBM/mesoscope tiffs straight into a reusable shared-memory input buffer
+    and stitches them with a persistent pool of workers
 
-    # TODO imread from tifffile has an overhead of ~20-30 seconds before it actually reads the file?
-    tiffile = tifffile.imread(path)
-  
-    rois = get_meso_rois(path)
-  
-    sh_mem = shared_memory.SharedMemory(create=True, size=tiffile.nbytes)
-    sh_tif = n.ndarray(tiffile.shape, dtype=tiffile.dtype, buffer=sh_mem.buf)
-    sh_tif[:] = tiffile[:]
-    if debug: print("4, %.4f" % (time.time()-tic))
-    sh_mem_name = sh_mem.name
-    sh_mem_params = (sh_tif.shape, sh_tif.dtype)
-
-    n_t, n_ch_tif,__,__ = sh_tif.shape
-    n_ch = len(channels)
-
-    # split and stitch two frames to figure out the output size
-    ims_sample= split_rois_from_tif(tiffile[:2], rois, ch_id=0)
-    if debug: print("5, %.4f" % (time.time()-tic))
-    # sample_out = stitch_rois(ims_sample, rois, return_coords=False,mean_img=False)
-    if get_roi_start_pix:
-        return stitch_rois_fast(ims_sample, rois, mean_img=False, get_roi_start_pix=True)
-    sample_out, px, py = stitch_rois_fast(ims_sample, rois,mean_img=False)
-    if debug: print("6, %.4f" % (time.time()-tic))
-    __, n_y, n_x = sample_out.shape
-    del tiffile
-
-    shape_out = (n_ch,n_t,n_y,n_x)
-    size_out = (n_t*n_ch*n_y*n_x) * sh_tif[0,0,0,0].nbytes
-    sh_mem_out = shared_memory.SharedMemory(create=True, size=size_out)
-    sh_out = n.ndarray(shape_out, dtype=sh_tif.dtype, buffer=sh_mem_out.buf)    
-    sh_out_name = sh_mem_out.name
-    sh_out_params = (sh_out.shape, sh_out.dtype)
-    # print(sh_out_params)
-    if debug: print("7, %.4f" % (time.time()-tic))
-
-    if translations is None:
-        translations = n.zeros((n_ch,2))
+    Use as a context manager (or call close()) to stop the workers and free the input buffer
+    '''
+    def __init__(self, n_proc=10):
+        self.n_proc = n_proc
+        self.pool = None
+        self.buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read_tif(self, path):
+        '''
+        Decode a tiff into the shared input buffer, growing it if needed
+
+        Returns:
+            tif: view of the buffer with the shape and dtype of the tiff (time x channels x y x x)
+            rois: scanimage ROIs of the tiff
+        '''
+        meta = tiffmeta.tiff_metadata([path])[0]
+        shape, dtype = meta['shape'], n.dtype(meta['dtype']).newbyteorder('=')
+        nbytes = int(n.prod(shape)) * dtype.itemsize
+        if self.buffer is None or self.buffer.nbytes < nbytes:
+            self.buffer = None
+            self.buffer = SharedArray((nbytes,), n.uint8)
+        tif = self.buffer[:nbytes].view(dtype).reshape(shape)
+        if meta['offsets'] is not None and n.prod(shape) == meta['npages'] * meta['Ly'] * meta['Lx']:
+            # pages are read at their cached offsets without parsing the tiff
+            tiffmeta.read_pages(path, meta, 0, meta['npages'], out=tif.reshape(-1, meta['Ly'], meta['Lx']))
+        else:
+            with tifffile.TiffFile(path) as tf:
+                tf.series[0].asarray(out=tif)
+        rois = get_meso_rois(path)
+        return tif, rois
 
-    prep_tic = time.time()
-    if verbose: print("    Loaded file into shared memory in %.2f sec" % (prep_tic - tic))
-
-    p = Pool(processes = n_proc)
-    output = p.starmap(load_and_stitch_full_tif_worker, 
-                      [(idx,ch_id, rois, sh_mem_name, sh_mem_params, sh_out_name, sh_out_params, translations[idx], filt)\
-                        for idx,ch_id in enumerate(channels)])
-    proc_tic = time.time()
-    if verbose: print("    Workers completed in %.2f sec" % (proc_tic - prep_tic))
-    
-    if debug: print("8, %.4f" % (time.time()-tic))
+    def map(self, func, args):
+        if self.pool is None:
+            self.pool = Pool(processes = self.n_proc)
+        return self.pool.starmap(func, args)
 
-    # print(output)
-    if verbose: print("    Total time: %.2f sec" % (time.time()-tic))
-    sh_mem.close()
-    sh_mem.unlink()
-    p.close()
-    p.terminate()
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.buffer = None
 
-    im_full = n.zeros(sh_out.shape, sh_out.dtype)
-    im_full[:] = sh_out[:]
-    sh_mem_out.close()
-    sh_mem_out.unlink()
+
+def load_and_stitch_full_tif_mp(path, channels, n_proc=10, verbose=True,translations=None, filt = None, debug=False, get_roi_start_pix=False, loader=None):
+    '''
+    Load one LBM tiff and stitch its ROIs for the given channels
+
+    The tiff is decoded directly into shared memory, the workers of loader (a SharedTifLoader,
+    created for this file if None) write the stitched frames into a new SharedArray that is
+    returned without copying
+
+    Returns:
+        im_full (SharedArray): channels x time x y x x
+        px, py: pixel sizes
+    '''
+    tic = time.time()
+    own_loader = loader is None
+    if own_loader:
+        loader = SharedTifLoader(n_proc=n_proc)
+
+    try:
+        if get_roi_start_pix:
+            return get_roi_start_pix_from_metadata(path)
+        sh_tif, rois = loader.read_tif(path)
+        if debug: print("4, %.4f" % (time.time()-tic))
+
+        n_t, n_ch_tif,__,__ = sh_tif.shape
+        n_ch = len(channels)
+
+        # split and stitch two frames to figure out the output size
+        ims_sample= split_rois_from_tif(sh_tif[:2], rois, ch_id=0)
+        if debug: print("5, %.4f" % (time.time()-tic))
+        sample_out, px, py = stitch_rois_fast(ims_sample, rois,mean_img=False)
+        if debug: print("6, %.4f" % (time.time()-tic))
+        __, n_y, n_x = sample_out.shape
+
+        im_full = SharedArray((n_ch,n_t,n_y,n_x), sh_tif.dtype)
+        if debug: print("7, %.4f" % (time.time()-tic))
+
+        if translations is None:
+            translations = n.zeros((n_ch,2))
+
+        prep_tic = time.time()
+        if verbose: print("    Loaded file into shared memory in %.2f sec" % (prep_tic - tic))
+
+        sh_mem_params = (sh_tif.shape, sh_tif.dtype)
+        output = loader.map(load_and_stitch_full_tif_worker,
+                          [(idx,ch_id, rois, loader.buffer.shm.name, sh_mem_params, im_full.shm.name, (im_full.shape, im_full.dtype), translations[idx], filt)\
+                            for idx,ch_id in enumerate(channels)])
+        proc_tic = time.time()
+        if verbose: print("    Workers completed in %.2f sec" % (proc_tic - prep_tic))
+        if debug: print("8, %.4f" % (time.time()-tic))
+        if verbose: print("    Total time: %.2f sec" % (time.time()-tic))
+    finally:
+        if own_loader:
+            loader.close()
 
     return im_full, px, py
 
@@ -130,8 +222,7 @@ def load_and_stitch_full_tif_worker(idx, ch_id, rois, sh_mem_name, sh_arr_params
     if debug: print("Loading channel %d" % ch_id)
     tic = time.time()
 
-    sh_mem = shared_memory.SharedMemory(sh_mem_name)
-    tiffile = n.ndarray(shape=sh_arr_params[0], dtype=sh_arr_params[1], buffer=sh_mem.buf)
+    sh_mem, tiffile = attach_shared_array(sh_mem_name, sh_arr_params[0], sh_arr_params[1])
 
     if filt is not None:
         b,a = filt
@@ -143,8 +234,7 @@ def load_and_stitch_full_tif_worker(idx, ch_id, rois, sh_mem_name, sh_arr_params
         if debug: print('%d filtered in %.2f' % (ch_id, time.time() - tic))
         tic = time.time()
 
-    sh_mem_out = shared_memory.SharedMemory(sh_out_name)
-    outputs = n.ndarray(shape=sh_out_params[0], dtype=sh_out_params[1], buffer=sh_mem_out.buf)
+    sh_mem_out, outputs = attach_shared_array(sh_out_name, sh_out_params[0], sh_out_params[1])
     
     prep_time = time.time()
     if debug: print(" %d Loaded in %.2f" % (ch_id, prep_time-tic))
@@ -156,18 +246,19 @@ def load_and_stitch_full_tif_worker(idx, ch_id, rois, sh_mem_name, sh_arr_params
     if debug: print(" %d Stitch in %.2f" % (ch_id, stitch_time-split_time))
     if debug: print("Channel %d done in %.2f" % (ch_id, time.time()-tic))
 
-    sh_mem.close() # REMOVE ME IF THERE IS AN ERROR
-    sh_mem_out.close() # Remove me if there is an error
+    del tiffile, outputs, ims
+    sh_mem.close()
+    sh_mem_out.close()
 
 
     return time.time()-tic
 
 
 def get_meso_rois(tif_path, max_roi_width_pix=145):
-    tf = tifffile.TiffFile(tif_path)
-    artists_json = tf.pages[0].tags["Artist"].value
-
-    si_rois = json.loads(artists_json)['RoiGroups']['imagingRoiGroup']['rois']
+    '''
+    ScanImage ROIs of a tiff, from the tiff metadata cache (see tiffmeta)
+    '''
+    si_rois = tiffmeta.tiff_metadata([tif_path])[0]['scanimage']['rois']
 
     rois = []
     warned = False
@@ -195,6 +286,18 @@ def get_meso_rois(tif_path, max_roi_width_pix=145):
     return rois
 
 
+def get_roi_start_pix_from_metadata(tif_path):
+    '''
+    Starting pixels (y, x) of each ROI in the stitched image, as returned by
+    stitch_rois_fast(..., get_roi_start_pix=True), computed from the cached tiff metadata
+    without reading the tiff
+    '''
+    rois = get_meso_rois(tif_path)
+    Lx = tiffmeta.tiff_metadata([tif_path])[0]['Lx']
+    ims = [n.empty((0, roi['pixXY'][1], Lx)) for roi in rois]
+    return stitch_rois_fast(ims, rois, mean_img=False, get_roi_start_pix=True)
+
+
 def split_rois_from_tif(im, rois, ch_id = 0, return_coords=False):
     nt, np, ny, nx = im.shape
     n_rois = len(rois)
@@ -0,0 +1,271 @@
+"""
+Manifest of the input files converted to binaries, used to resume an interrupted conversion.
+
+After each input file is completely written, the converters record the file's path, size and
+modification time, the number of frames and the byte size of every binary, and the running
+per-plane sums ('nframes', 'meanImg', ...); these are saved in MANIFEST_NAME (in the save folder)
+at most every CHECKPOINT_INTERVAL seconds and after the last file. When the
+conversion is rerun with the same settings and the recorded files are unchanged, the binaries
+are truncated to the last checkpoint and conversion continues with the next file; files added
+to the data folder later are appended in the same way.
+"""
+import json
+import os
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from .chunked import open_binary
+from .opsfile import load_ops, meta_path
+
+MANIFEST_NAME = 'ingest_manifest.npz'
+VERSION = 1
+# per-plane fields of ops accumulated during conversion
+COUNTER_KEYS = ['nframes', 'meanImg', 'meanImg_chan2', 'frames_per_file', 'frames_per_folder', 'nframes_per_folder']
+# per-file counters that grow with the number of input files
+PER_FILE_KEYS = ['frames_per_file', 'nframes_per_folder']
+# minimum time in seconds between two manifest writes
+CHECKPOINT_INTERVAL = 30.
+
+# file records of the conversions running in this process and time of the last write, per manifest
+_records = {}
+
+
+def manifest_path(ops) -> str:
+    """the manifest is saved in the save folder that contains the plane folders."""
+    return os.path.join(os.path.dirname(os.path.normpath(ops['save_path'])), MANIFEST_NAME)
+
+
+def binary_paths(ops1) -> List[List[str]]:
+    """returns the binaries written during conversion for each plane (functional, then second channel)."""
+    keep_raw = ops1[0].get('keep_movie_raw', False)
+    paths = []
+    for ops in ops1:
+        plane = [ops['raw_file'] if keep_raw else ops['reg_file']]
+        if ops['nchannels'] > 1:
+            plane.append(ops['raw_file_chan2'] if keep_raw else ops['reg_file_chan2'])
+        paths.append(plane)
+    return paths
+
+
+def file_record(filename: str) -> dict:
+    stat = os.stat(filename)
+    return {'path': os.path.abspath(filename), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+
+def _settings(ops1) -> dict:
+    """settings that change the content of the binaries."""
+    ops = ops1[0]
+    return {'version': VERSION, 'input_format': ops.get('input_format', 'tif'), 'nplanes': ops['nplanes'],
+            'nchannels': ops['nchannels'], 'functional_chan': ops['functional_chan'],
+            'h5py_key': ops.get('h5py_key'), 'binaries': binary_paths(ops1)}
+
+
+def _unchanged(record: dict, filename: str) -> bool:
+    return record == {**record, **file_record(filename)}
+
+
+def _load_json(filename: str) -> Optional[dict]:
+    try:
+        with np.load(filename, allow_pickle=False) as f:
+            return json.loads(str(f['manifest']))
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def load_manifest(filename: str) -> Optional[dict]:
+    """
+    Loads an ingest manifest.
+
+    Returns
+    -------
+    manifest: dict or None
+        'settings', 'files' (one record per converted file with 'path', 'size', 'mtime',
+        and the 'nframes' per plane and 'nbytes' per plane and binary after the file),
+        'state' (converter counters) and 'counters' (per-plane dicts of COUNTER_KEYS);
+        None if missing or unreadable
+    """
+    manifest = _load_json(filename)
+    if manifest is None:
+        return None
+    with np.load(filename, allow_pickle=False) as f:
+        manifest['counters'] = [{key: f['plane%d_%s' % (j, key)] for key in COUNTER_KEYS
+                                 if 'plane%d_%s' % (j, key) in f.files}
+                                for j in range(manifest['settings']['nplanes'])]
+    return manifest
+
+
+def _resumable(ops1, fs, manifest, action: str = 'converting all files') -> bool:
+    """checks that the manifest was written with the same settings, for unchanged files and binaries."""
+    ops = ops1[0]
+    if manifest is None:
+        return False
+    if manifest['settings'] != json.loads(json.dumps(_settings(ops1))):
+        print('NOTE: conversion settings changed since last run, %s' % action)
+        return False
+    records = manifest['files']
+    if len(records) > len(fs) or not all(_unchanged(r, f) for r, f in zip(records, fs)):
+        print('NOTE: input files changed since last run, %s' % action)
+        return False
+    nbytes = records[-1]['nbytes'] if records else [[0] * len(p) for p in binary_paths(ops1)]
+    for paths, sizes in zip(binary_paths(ops1), nbytes):
+        for path, size in zip(paths, sizes):
+            if not os.path.isfile(path) or os.path.getsize(path) < size:
+                print('NOTE: binary %s is shorter than recorded, %s' % (path, action))
+                return False
+    # binaries written in place by registration cannot be extended with raw frames
+    if not ops.get('keep_movie_raw', False) and (os.path.isfile(ops['ops_path']) or
+                                                 os.path.isfile(meta_path(ops['ops_path']))):
+        ops_saved = load_ops(ops['ops_path'])
+        if 'yoff' in ops_saved:
+            print('NOTE: binaries were already registered in place, %s' % action)
+            return False
+    return True
+
+
+def open_binaries(ops1, fs, resumable: bool = True) -> Tuple[list, list]:
+    """
+    Opens the binaries of each plane for conversion, resuming from the manifest if possible.
+
+    Binaries are appended to (after truncation to the last checkpoint) when ops['resume_ingest']
+    is set, the converter supports checkpoints (resumable) and the manifest matches; then the
+    manifest is attached as ops1[0]['ingest_resume'] for resume_counters. Otherwise binaries are
+    created and an old manifest is removed.
+
+    Returns
+    -------
+    reg_file, reg_file_chan2: lists of open files per plane
+    """
+    ops = ops1[0]
+    compression = ops.get('compression')
+    filename = manifest_path(ops)
+    manifest = None
+    if resumable and ops.get('resume_ingest', False):
+        if compression or ops.get('fused_registration', False):
+            print('NOTE: conversion cannot be resumed with compression or fused_registration')
+        elif os.path.isfile(filename):
+            manifest = load_manifest(filename)
+            if not _resumable(ops1, fs, manifest):
+                manifest = None
+    if manifest is None and os.path.isfile(filename):
+        os.remove(filename)
+    _records[filename] = {'files': list(manifest['files']) if manifest is not None else [],
+                          'time': time.time()}
+
+    reg_file, reg_file_chan2 = [], []
+    for j, paths in enumerate(binary_paths(ops1)):
+        files = []
+        for k, path in enumerate(paths):
+            if manifest is not None:
+                f = open(path, 'r+b')
+                nbytes = manifest['files'][-1]['nbytes'][j][k] if manifest['files'] else 0
+                f.truncate(nbytes)
+                f.seek(nbytes)
+            else:
+                f = open_binary(path, 'wb', compression=compression)
+            files.append(f)
+        reg_file.append(files[0])
+        if len(files) > 1:
+            reg_file_chan2.append(files[1])
+    if manifest is not None:
+        print('NOTE: resuming conversion after %d of %d files' % (len(manifest['files']), len(fs)))
+        ops['ingest_resume'] = manifest
+    return reg_file, reg_file_chan2
+
+
+def resume_counters(ops1) -> Tuple[int, dict]:
+    """
+    Restores the per-plane counters saved at the last checkpoint (see open_binaries).
+
+    Call after the converter initialized its counters; per-file counters are extended to the
+    current number of files.
+
+    Returns
+    -------
+    nfiles: int
+        number of input files already converted (0 if not resuming)
+    state: dict
+        converter-specific state saved by checkpoint
+    """
+    manifest = ops1[0].pop('ingest_resume', None)
+    if manifest is None:
+        return 0, {}
+    for ops, counters in zip(ops1, manifest['counters']):
+        for key, val in counters.items():
+            if val.ndim == 0:
+                ops[key] = val.item()
+            elif val.ndim == 1:
+                n = len(ops[key]) if key in ops else (len(ops['filelist']) if key in PER_FILE_KEYS else len(val))
+                ops[key] = np.zeros(n, val.dtype)
+                ops[key][:len(val)] = val
+            else:
+                ops[key] = val.copy()
+    return len(manifest['files']), manifest['state']
+
+
+def checkpoint(ops1, fs, nfiles: int, reg_file, reg_file_chan2, state: Optional[dict] = None) -> None:
+    """
+    Records that the first nfiles files of fs are completely written to the binaries.
+
+    The manifest is written at most every CHECKPOINT_INTERVAL seconds and after the last file;
+    a resumed conversion restarts after the files of the last write.
+
+    Parameters
+    ----------
+    ops1: list of dictionaries
+        per-plane ops with the counters in COUNTER_KEYS
+    fs: list of str
+        all input files
+    nfiles: int
+        number of input files converted
+    reg_file, reg_file_chan2: lists of open binaries
+    state: dict (optional)
+        converter-specific state (json serializable), returned by resume_counters
+    """
+    ops = ops1[0]
+    if not ops.get('resume_ingest', False) or ops.get('compression') or ops.get('fused_registration', False):
+        return
+    filename = manifest_path(ops)
+    if filename not in _records:
+        manifest = _load_json(filename) if os.path.isfile(filename) else None
+        _records[filename] = {'files': manifest['files'] if manifest is not None else [], 'time': time.time()}
+    records = _records[filename]['files']
+    files = [reg_file] + ([reg_file_chan2] if len(reg_file_chan2) else [])
+    nbytes = [[f[j].tell() for f in files] for j in range(len(reg_file))]
+    nframes = [int(ops.get('nframes', 0)) for ops in ops1]
+    del records[nfiles:]
+    for k in range(len(records), nfiles):
+        records.append({**file_record(fs[k]), 'nframes': nframes, 'nbytes': nbytes})
+    if nfiles < len(fs) and time.time() - _records[filename]['time'] < CHECKPOINT_INTERVAL:
+        return
+    for f in reg_file + reg_file_chan2:
+        f.flush()
+    manifest = {'settings': _settings(ops1), 'files': records, 'state': state or {}}
+    arrays = {'plane%d_%s' % (j, key): np.asarray(ops[key]) for j, ops in enumerate(ops1)
+              for key in COUNTER_KEYS if key in ops}
+    with open(filename + '.tmp', 'wb') as f:
+        np.savez(f, manifest=json.dumps(manifest), **arrays)
+    os.replace(filename + '.tmp', filename)
+    _records[filename]['time'] = time.time()
+
+
+def has_new_files(save_folder: str, fs) -> bool:
+    """returns True if the manifest in save_folder lists unchanged first files of fs, but not all of them."""
+    manifest = _load_json(os.path.join(save_folder, MANIFEST_NAME))
+    if manifest is None or len(manifest['files']) >= len(fs):
+        return False
+    return all(_unchanged(r, f) for r, f in zip(manifest['files'], fs))
+
+
+def can_append(ops1, fs) -> bool:
+    """returns True if the manifest lists unchanged first files of fs but not all of them, and the
+    binaries can be extended with the other files (see open_binaries)."""
+    ops = ops1[0]
+    if not ops.get('resume_ingest', False) or ops.get('compression') or ops.get('fused_registration', False):
+        return False
+    filename = manifest_path(ops)
+    manifest = load_manifest(filename) if os.path.isfile(filename) else None
+    if manifest is None or len(manifest['files']) >= len(fs):
+        return False
+    return _resumable(ops1, fs, manifest, action='keeping the existing binaries')
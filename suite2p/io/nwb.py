@@ -1,4 +1,5 @@
 import datetime
+import math
 import os
 from natsort import natsorted 
 
@@ -6,9 +7,14 @@ import numpy as np
 import time
 import scipy
 import gc
+import h5py
 
 from ..detection.stats import roi_stats
-from . import utils
+from ..detection.roitable import load_stat
+from . import utils, manifest
+from .h5 import iter_h5_batches, chunk_aligned_batch, chunk_cache_nbytes
+from .opsfile import load_ops
+from .virtual import to_int16, write_virtual_h5, VirtualH5File
 from .. import run_s2p
 
 # try:
@@ -28,16 +34,88 @@ from .. import run_s2p
 NWB = False
 
 
+def nwb_plane_sources(nwbfile, ops):
+    """ finds the TwoPhotonSeries frames of each plane and channel
+
+    ops['nwb_series'] is one series name or a list of names, one per plane and channel
+    (plane-major, channel-minor); by default the first TwoPhotonSeries, or all of them if
+    there are exactly nplanes * nchannels. A single series is either frames x Ly x Lx with
+    planes and channels interleaved (as in tiffs), or frames x Ly x Lx x nplanes (one channel)
+
+    Returns
+    -------
+        sources : list (planes) of lists (channels) of dicts
+            'series' (name), 'start', 'stride' and 'zplane' (None or index of last axis):
+            the frames of the plane/channel are series.data[start::stride] (and [..., zplane])
+
+    """
+    from pynwb.ophys import TwoPhotonSeries
+    nplanes, nchannels = ops['nplanes'], ops['nchannels']
+    ncp = nplanes * nchannels
+    names = ops.get('nwb_series')
+    if not names:
+        names = [v.name for v in nwbfile.acquisition.values() if isinstance(v, TwoPhotonSeries)]
+        if len(names)==0:
+            raise ValueError('no TwoPhotonSeries in NWB file')
+        elif len(names) != ncp:
+            if len(names)>1:
+                print('NOTE: more than one TwoPhotonSeries in NWB file, choosing first one')
+            names = names[:1]
+    elif isinstance(names, str):
+        names = [names]
+    if len(names) == ncp and ncp > 1:
+        return [[{'series': names[j * nchannels + c], 'start': 0, 'stride': 1, 'zplane': None}
+                 for c in range(nchannels)] for j in range(nplanes)]
+    if len(names) != 1:
+        raise IOError('%d TwoPhotonSeries given for %d planes and %d channels' % (len(names), nplanes, nchannels))
+    shape = nwbfile.acquisition[names[0]].data.shape
+    if len(shape) == 4:
+        if shape[3] != nplanes or nchannels != 1:
+            raise IOError('TwoPhotonSeries of shape %s does not match nplanes=%d, nchannels=%d'
+                          % (str(shape), nplanes, nchannels))
+        return [[{'series': names[0], 'start': 0, 'stride': 1, 'zplane': j}] for j in range(nplanes)]
+    return [[{'series': names[0], 'start': j * nchannels + c, 'stride': ncp, 'zplane': None}
+             for c in range(nchannels)] for j in range(nplanes)]
+
+
+def iter_series_batches(data, stride: int, batch_size: int, n_workers: int = 1, local: bool = True):
+    """ yields (first frame, frames) of a TwoPhotonSeries' data in order
+
+    batches are a multiple of stride (and, for chunked HDF5 data, of the chunk length along frames
+    where that fits in h5.MAX_BATCH_NBYTES, see h5.chunk_aligned_batch);
+    local HDF5 datasets are read as hyperslabs by h5.iter_h5_batches, in worker processes if
+    compressed and n_workers > 1
+
+    """
+    nt = data.shape[0]
+    nt_batch = stride * math.ceil(batch_size / stride)
+    chunks = getattr(data, 'chunks', None)
+    if chunks is not None:
+        nt_batch = chunk_aligned_batch(nt_batch, stride, chunks[0],
+                                       data.dtype.itemsize * int(np.prod(data.shape[1:])))
+    if local and isinstance(data, h5py.Dataset):
+        cache_nbytes = chunk_cache_nbytes(data, 0, min(nt_batch, nt))
+        if chunks is None or data.compression is None:
+            n_workers = 1
+        t0 = 0
+        for im in iter_h5_batches(data.file.filename, data.name, 0, nt_batch, cache_nbytes, n_workers):
+            yield t0, im
+            t0 += im.shape[0]
+    else:
+        for t0 in range(0, nt, nt_batch):
+            yield t0, data[t0 : min(nt, t0 + nt_batch)]
+
+
 def nwb_to_binary(ops):
     """ convert nwb file to binary (experimental)
-    
-    converts single plane single channel nwb file to binary for suite2p processing
+
+    converts TwoPhotonSeries of one or more planes and channels to binaries (see nwb_plane_sources)
 
     Parameters
     ----------
     ops: dictionary
         requires 'nwb_file' key
-        optional keys 'nwb_driver', 'nwb_series'
+        optional keys 'nwb_driver', 'nwb_series', 'io_workers'
         uses 'nplanes', 'save_path', 'save_folder', 'fast_disk',
         'nchannels', 'keep_movie_raw', 'look_one_level_down'
 
@@ -49,91 +127,127 @@ def nwb_to_binary(ops):
             'frames_per_folder', 'nframes', 'meanImg', 'meanImg_chan2'
 
     """
-    
-    # force 1 plane 1 chan for now
-    ops['nplanes'] = 1
-    ops['nchannels'] = 1
+    from pynwb import NWBHDF5IO
 
     # initialize ops with reg_file and raw_file paths, etc
-    ops = utils.init_ops(ops)[0]
+    ops1 = utils.init_ops(ops)
 
     t0=time.time()
-    nplanes = ops['nplanes']
-    nchannels = ops['nchannels']
-    
-    batch_size = ops['batch_size']
-    batch_size = int(nplanes*nchannels*np.ceil(batch_size/(nplanes*nchannels)))
+    nplanes = ops1[0]['nplanes']
+    nchannels = ops1[0]['nchannels']
+    nfunc = ops1[0]['functional_chan'] - 1 if nchannels > 1 else 0
 
     # open reg_file (and when available reg_file_chan2)
-    if 'keep_movie_raw' in ops and ops['keep_movie_raw']:
-        reg_file = open(ops['raw_file'], 'wb')
-        if nchannels>1:
-            reg_file_chan2 = open(ops['raw_file_chan2'], 'wb')
-    else:
-        reg_file = open(ops['reg_file'], 'wb')
-        if nchannels>1:
-            reg_file_chan2 = open(ops['reg_file_chan2'], 'wb')
+    reg_file, reg_file_chan2 = manifest.open_binaries(ops1, [ops['nwb_file']], resumable=False)
 
     nwb_driver = None
-    if ops.get('nwb_driver') and isinstance(nwb_driver, str):
+    if ops.get('nwb_driver') and isinstance(ops['nwb_driver'], str):
         nwb_driver = ops['nwb_driver']
 
-        
     with NWBHDF5IO(ops['nwb_file'], 'r', driver=nwb_driver) as fio:
         nwbfile = fio.read()
+        sources = nwb_plane_sources(nwbfile, ops1[0])
+        for ops in ops1:
+            ops['nwb_series'] = sources[0][0]['series'] if len(sources[0]) == 1 else [src['series'] for src in sources[0]]
+            ops['nframes'] = 0
+            ops.pop('meanImg', None)
+            ops.pop('meanImg_chan2', None)
+
+        # read each series once and write the frames of all planes/channels it contains
+        for name in dict.fromkeys(src['series'] for plane in sources for src in plane):
+            data = nwbfile.acquisition[name].data
+            users = [(j, c, src) for j, plane in enumerate(sources) for c, src in enumerate(plane)
+                     if src['series'] == name]
+            stride = users[0][2]['stride']
+            nbatches = 0
+            for ik, im in iter_series_batches(data, stride, ops1[0]['batch_size'],
+                                              n_workers=ops1[0].get('io_workers', 1), local=nwb_driver is None):
+                for j, c, src in users:
+                    frames = im[src['start']::stride]
+                    if src['zplane'] is not None:
+                        frames = frames[..., src['zplane']]
+                    frames = to_int16(frames)
+                    key = 'meanImg' if c == nfunc else 'meanImg_chan2'
+                    if key not in ops1[j]:
+                        ops1[j][key] = np.zeros(frames.shape[1:], np.float32)
+                    ops1[j][key] += frames.astype(np.float32).sum(axis=0)
+                    if c == nfunc:
+                        reg_file[j].write(bytearray(frames))
+                        ops1[j]['nframes'] += frames.shape[0]
+                    else:
+                        reg_file_chan2[j].write(bytearray(frames))
+                nbatches += 1
+                if nbatches % 4 == 0:
+                    print('%d frames of binary, time %0.2f sec.'%(ik + im.shape[0],time.time()-t0))
+        gc.collect()
 
-        # get TwoPhotonSeries
-        if not ops.get('nwb_series'):
-            TwoPhotonSeries_names = []
-            for v in nwbfile.acquisition.values():
-                if isinstance(v, TwoPhotonSeries):
-                    TwoPhotonSeries_names.append(v.name)
-            if len(TwoPhotonSeries_names)==0:
-                raise ValueError('no TwoPhotonSeries in NWB file')
-            elif len(TwoPhotonSeries_names)>1:
-                raise Warning('more than one TwoPhotonSeries in NWB file, choosing first one')
-            ops['nwb_series'] = TwoPhotonSeries_names[0]
-    
-        series = nwbfile.acquisition[ops['nwb_series']]
-        series_shape = nwbfile.acquisition[ops['nwb_series']].data.shape
-        ops['nframes'] = series_shape[0]
+    # write ops files
+    for j, ops in enumerate(ops1):
         ops['frames_per_file'] = np.array([ops['nframes']])
         ops['frames_per_folder'] = np.array([ops['nframes']])
-        ops['meanImg'] = np.zeros((series_shape[1], series_shape[2]), np.float32)
-        for ik in np.arange(0, ops['nframes'], batch_size):
-            ikend = min(ik+batch_size, ops['nframes'])
-            im = series.data[ik : ikend]
-            
-            # check if uint16
-            if im.dtype.type == np.uint16:
-                im = (im // 2).astype(np.int16)
-            elif im.dtype.type == np.int32:
-                im = (im // 2).astype(np.int16)
-            elif im.dtype.type != np.int16:
-                im = im.astype(np.int16)
-
-            reg_file.write(bytearray(im))
-            ops['meanImg'] += im.astype(np.float32).sum(axis=0)
-
-            if ikend%(batch_size*4)==0:
-                print('%d frames of binary, time %0.2f sec.'%(ikend,time.time()-t0))
-        gc.collect()
+        ops['Ly'],ops['Lx'] = ops['meanImg'].shape
+        ops['yrange'] = np.array([0,ops['Ly']])
+        ops['xrange'] = np.array([0,ops['Lx']])
+        ops['meanImg'] /= ops['nframes']
+        if nchannels>1:
+            ops['meanImg_chan2'] /= ops['nframes']
+        # close all binary files and write ops files
+        np.save(ops['ops_path'], ops)
+        reg_file[j].close()
+        if nchannels>1:
+            reg_file_chan2[j].close()
 
-    # write ops files
-    do_registration = ops['do_registration']
-    ops['Ly'],ops['Lx'] = ops['meanImg'].shape
-    ops['yrange'] = np.array([0,ops['Ly']])
-    ops['xrange'] = np.array([0,ops['Lx']])
-    ops['meanImg'] /= ops['nframes']
-    if nchannels>1:
-        ops['meanImg_chan2'] /= ops['nframes']
-    # close all binary files and write ops files
-    np.save(ops['ops_path'], ops)
-    reg_file.close()
-    if nchannels>1:
-        reg_file_chan2.close()
-
-    return ops
+    return ops1[0]
+
+
+def nwb_to_virtual(ops):
+    """ exposes the TwoPhotonSeries of a local nwb file as virtual raw binaries (see io.virtual)
+
+    same outputs as nwb_to_binary, but ops['raw_file'] (and 'raw_file_chan2') are index files that
+    read frames from the nwb file, and 'keep_movie_raw' is set so that registration reads the nwb
+    file and writes only ops['reg_file']; 'meanImg' is computed from a subsample of frames
+
+    Returns
+    -------
+        ops : dictionary of first plane, or None if the nwb file is not local HDF5
+            (ops['nwb_driver'] set or data not stored as HDF5 datasets)
+
+    """
+    from pynwb import NWBHDF5IO
+    if ops.get('nwb_driver'):
+        print('NOTE: virtual nwb binaries need a local file, converting to binary')
+        return None
+    ops1 = utils.init_ops({**ops, 'keep_movie_raw': True})
+    nchannels = ops1[0]['nchannels']
+    nfunc = ops1[0]['functional_chan'] - 1 if nchannels > 1 else 0
+    with NWBHDF5IO(ops['nwb_file'], 'r') as fio:
+        nwbfile = fio.read()
+        sources = nwb_plane_sources(nwbfile, ops1[0])
+        datasets = {src['series']: nwbfile.acquisition[src['series']].data for plane in sources for src in plane}
+        if not all(isinstance(data, h5py.Dataset) for data in datasets.values()):
+            print('NOTE: TwoPhotonSeries data is not an HDF5 dataset, converting to binary')
+            return None
+        for j, ops in enumerate(ops1):
+            for c, src in enumerate(sources[j]):
+                data = datasets[src['series']]
+                key = 'raw_file' if c == nfunc else 'raw_file_chan2'
+                nframes = len(range(src['start'], data.shape[0], src['stride']))
+                write_virtual_h5(ops[key], ops['nwb_file'], data.name, nframes, data.shape[1], data.shape[2],
+                                 start=src['start'], stride=src['stride'], zplane=src['zplane'])
+                with VirtualH5File(ops[key]) as f:
+                    inds = np.linspace(0, nframes, 1 + min(nframes, 1000)).astype(np.int64)[:-1]
+                    meanImg = np.mean([f._frames(k, k + 1)[0] for k in inds], axis=0).astype(np.float32)
+                ops['meanImg' if c == nfunc else 'meanImg_chan2'] = meanImg
+                if c == nfunc:
+                    ops['nframes'] = nframes
+            ops['nwb_series'] = sources[0][0]['series'] if len(sources[0]) == 1 else [src['series'] for src in sources[0]]
+            ops['frames_per_file'] = np.array([ops['nframes']])
+            ops['frames_per_folder'] = np.array([ops['nframes']])
+            ops['Ly'], ops['Lx'] = ops['meanImg'].shape
+            ops['yrange'] = np.array([0, ops['Ly']])
+            ops['xrange'] = np.array([0, ops['Lx']])
+            np.save(ops['ops_path'], ops)
+    return ops1[0]
 
 
 def read_nwb(fpath):
@@ -267,7 +381,7 @@ def save_nwb(save_folder):
     """ convert folder with plane folders to NWB format """
 
     plane_folders = natsorted([ f.path for f in os.scandir(save_folder) if f.is_dir() and f.name[:5]=='plane'])
-    ops1 = [np.load(os.path.join(f, 'ops.npy'), allow_pickle=True).item() for f in plane_folders]
+    ops1 = [load_ops(os.path.join(f, 'ops.npy')) for f in plane_folders]
 
     if NWB and not ops1[0]['mesoscan']:
         if len(ops1)>1:
@@ -355,7 +469,7 @@ def save_nwb(save_folder):
                         trace   = np.concatenate((trace, fcat), axis=1)
                     traces[i] = np.append(traces[i], trace, axis=0) 
             
-            stat = np.load(os.path.join(ops['save_path'], 'stat.npy'), allow_pickle=True)
+            stat = load_stat(ops['save_path'])
             ncells = len(stat)
             for n in range(ncells):
                 if multiplane:
@@ -0,0 +1,166 @@
+"""
+ops saved as a small json document plus array sidecars.
+
+save_ops writes OPS_META (ops.json) next to ops.npy: scalars, strings, lists and small arrays are
+stored in the json; larger arrays (refImg, meanImg, Vcorr, each map of Vmap, regPC, xoff1, ...)
+are stored in SIDECAR_DIR as .npy files named by their key and a hash of their content. A
+sidecar is only written if no file with that content exists yet, so saving ops repeatedly
+during processing only rewrites the arrays that changed; sidecars no longer referenced are
+removed. load_ops memory-maps the sidecars (copy-on-write), so reading e.g. 'Ly' and 'Lx'
+does not load the arrays.
+
+Tuples, dicts with non-string keys and datetimes are tagged in the json; other values json
+cannot hold (e.g. np.dtype) are pickled to a sidecar. ops.npy (the pickled dict) is read by
+load_ops instead if it is at least as new as ops.json (e.g. saved with save_npy, by the GUI or
+an older version).
+"""
+import datetime
+import hashlib
+import json
+import os
+import pathlib
+import pickle
+
+import numpy as np
+
+OPS_META = 'ops.json'
+SIDECAR_DIR = 'ops_arrays'
+# arrays with at most this many elements are written into the json
+MAX_INLINE_SIZE = 16
+
+
+def meta_path(ops_path: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(ops_path)), OPS_META)
+
+
+def _sidecar_name(key: str, content: bytes, ext: str = '.npy') -> str:
+    h = hashlib.blake2b(digest_size=10)
+    h.update(content)
+    return '%s-%s%s' % (''.join(c if c.isalnum() or c in '_-' else '_' for c in key), h.hexdigest(), ext)
+
+
+def _array_name(key: str, arr: np.ndarray) -> str:
+    if arr.dtype == object:
+        return _sidecar_name(key, pickle.dumps(arr, protocol=4))
+    return _sidecar_name(key, str((arr.dtype.str, arr.shape)).encode()
+                         + np.ascontiguousarray(arr).view(np.uint8).ravel().tobytes())
+
+
+def _write_sidecar(folder: str, name: str, write) -> None:
+    """writes a sidecar with write(filename) unless a sidecar with that name (and content) exists."""
+    filename = os.path.join(folder, SIDECAR_DIR, name)
+    if not os.path.isfile(filename):
+        os.makedirs(os.path.join(folder, SIDECAR_DIR), exist_ok=True)
+        write(filename + '.tmp')
+        os.replace(filename + '.tmp', filename)
+
+
+def _encode(key: str, val, folder: str, used: set):
+    """converts val to json, writing arrays (and values json cannot hold) to sidecars in folder/SIDECAR_DIR."""
+    if isinstance(val, np.ndarray):
+        if val.dtype != object and val.size <= MAX_INLINE_SIZE:
+            return {'__ndarray__': val.tolist(), 'dtype': val.dtype.str, 'shape': list(val.shape)}
+        name = _array_name(key, val)
+        used.add(name)
+        def write(filename):
+            with open(filename, 'wb') as f:
+                np.save(f, val)
+        _write_sidecar(folder, name, write)
+        return {'__array__': SIDECAR_DIR + '/' + name}
+    if isinstance(val, dict):
+        if all(isinstance(k, str) for k in val):
+            return {k: _encode('%s.%s' % (key, k), v, folder, used) for k, v in val.items()}
+        return {'__items__': [[_encode('%s.key' % key, k, folder, used), _encode('%s.%s' % (key, k), v, folder, used)]
+                              for k, v in val.items()]}
+    if isinstance(val, list):
+        return [_encode('%s.%d' % (key, i), v, folder, used) for i, v in enumerate(val)]
+    if isinstance(val, tuple):
+        return {'__tuple__': [_encode('%s.%d' % (key, i), v, folder, used) for i, v in enumerate(val)]}
+    if isinstance(val, np.generic):
+        return val.item()
+    if isinstance(val, datetime.datetime):
+        return {'__datetime__': val.isoformat()}
+    if isinstance(val, pathlib.PurePath):
+        return os.fspath(val)
+    if val is None or isinstance(val, (bool, int, float, str)):
+        return val
+    content = pickle.dumps(val, protocol=4)
+    name = _sidecar_name(key, content, '.pkl')
+    used.add(name)
+    def write(filename):
+        with open(filename, 'wb') as f:
+            f.write(content)
+    _write_sidecar(folder, name, write)
+    return {'__pickle__': SIDECAR_DIR + '/' + name}
+
+
+def _decode(val, folder: str, mmap_mode):
+    if isinstance(val, dict):
+        if '__array__' in val:
+            filename = os.path.join(folder, *val['__array__'].split('/'))
+            try:
+                return np.load(filename, mmap_mode=mmap_mode)
+            except ValueError:  # object arrays cannot be memory-mapped
+                return np.load(filename, allow_pickle=True)
+        if '__pickle__' in val:
+            with open(os.path.join(folder, *val['__pickle__'].split('/')), 'rb') as f:
+                return pickle.load(f)
+        if '__ndarray__' in val:
+            return np.array(val['__ndarray__'], dtype=val['dtype']).reshape(val['shape'])
+        if '__tuple__' in val:
+            return tuple(_decode(v, folder, mmap_mode) for v in val['__tuple__'])
+        if '__items__' in val:
+            return {_decode(k, folder, mmap_mode): _decode(v, folder, mmap_mode) for k, v in val['__items__']}
+        if '__datetime__' in val:
+            return datetime.datetime.fromisoformat(val['__datetime__'])
+        return {k: _decode(v, folder, mmap_mode) for k, v in val.items()}
+    if isinstance(val, list):
+        return [_decode(v, folder, mmap_mode) for v in val]
+    return val
+
+
+def save_ops(ops: dict, ops_path: str = None, save_npy: bool = False) -> None:
+    """
+    Saves ops as OPS_META plus array sidecars in the folder of ops_path (default ops['ops_path']).
+
+    Parameters
+    ----------
+    ops: dict
+    ops_path: str (optional)
+        path of ops.npy
+    save_npy: bool (default False)
+        also save the pickled ops.npy for readers that do not use load_ops
+    """
+    ops_path = ops_path or ops['ops_path']
+    folder = os.path.dirname(os.path.abspath(ops_path))
+    used = set()
+    meta = {key: _encode(key, val, folder, used) for key, val in ops.items()}
+    filename = meta_path(ops_path)
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(meta, f, indent=1)
+    os.replace(filename + '.tmp', filename)
+    # written after ops.json, so that load_ops prefers the exact pickle
+    if save_npy:
+        np.save(ops_path, ops)
+    # remove sidecars of previous saves
+    sidecar_dir = os.path.join(folder, SIDECAR_DIR)
+    for name in os.listdir(sidecar_dir) if os.path.isdir(sidecar_dir) else []:
+        if name not in used:
+            try:
+                os.remove(os.path.join(sidecar_dir, name))
+            except OSError:
+                pass
+
+
+def load_ops(ops_path: str, mmap_mode: str = 'c') -> dict:
+    """
+    Loads ops saved by save_ops (arrays memory-mapped with mmap_mode, copy-on-write by default),
+    or ops.npy if OPS_META is missing or not newer than ops.npy.
+    """
+    filename = meta_path(ops_path)
+    if os.path.isfile(filename) and (not os.path.isfile(ops_path) or
+                                     os.stat(filename).st_mtime_ns > os.stat(ops_path).st_mtime_ns):
+        with open(filename, 'r') as f:
+            meta = json.load(f)
+        return _decode(meta, os.path.dirname(filename), mmap_mode)
+    return np.load(ops_path, allow_pickle=True).item()
@@ -0,0 +1,169 @@
+"""
+Consolidated results store of a plane (or of the combined view), RESULTS_NAME in the plane folder.
+
+One HDF5 file holds the traces ('F', 'Fneu', 'spks', 'F_chan2', 'Fneu_chan2', ROIs x frames) in
+chunks of a few ROIs by many frames, so that one ROI's trace or a time window of all traces
+is read without loading the whole matrix; 'iscell' and 'redcell'; the ROI table ('stat' group,
+see detection.roitable) and ops ('ops' group: arrays as datasets, everything else as json).
+
+load_results returns the traces as lazily-sliced h5py datasets, or as memory-mapped .npy files
+for plane folders written without the store.
+"""
+import json
+import os
+from typing import Optional
+
+import h5py
+import numpy as np
+
+from ..detection.roitable import ROITable, load_stat
+from .opsfile import load_ops
+
+RESULTS_NAME = 'results.h5'
+TRACE_KEYS = ['F', 'Fneu', 'spks', 'F_chan2', 'Fneu_chan2']
+CELL_KEYS = ['iscell', 'redcell']
+# ROIs x frames per chunk of the traces (64 kB of float32 per chunk)
+CHUNK_ROIS = 4
+CHUNK_FRAMES = 4096
+
+
+def _write_ops(group, ops: dict) -> None:
+    """numeric arrays of ops as datasets, other json-serializable values as the attribute 'json'."""
+    values = {}
+    for key, val in ops.items():
+        if isinstance(val, np.ndarray) and val.dtype.kind in 'biuf':
+            group.create_dataset(key, data=val)
+            continue
+        try:
+            values[key] = json.loads(json.dumps(val, default=lambda v: v.tolist() if hasattr(v, 'tolist') else str(v)))
+        except (TypeError, ValueError):
+            print('NOTE: ops[%s] not saved in results store' % key)
+    group.attrs['json'] = json.dumps(values)
+
+
+def _write_stat(group, table: ROITable) -> None:
+    group.create_dataset('offsets', data=table.offsets)
+    group.attrs['keys'] = json.dumps([key for key in table.keys if key in table.pixel or table.roi[key].dtype != object])
+    for name, columns in [('pixel', table.pixel), ('roi', table.roi)]:
+        sub = group.create_group(name)
+        for key, val in columns.items():
+            if val.dtype == object:
+                print('NOTE: stat[%s] not saved in results store' % key)
+                continue
+            sub.create_dataset(key, data=val)
+
+
+def save_results(fpath: str, ops: Optional[dict] = None, stat=None, **arrays) -> str:
+    """
+    Writes the results store RESULTS_NAME in folder fpath.
+
+    Parameters
+    ----------
+    fpath: str
+        plane (or combined) folder
+    ops: dict (optional)
+    stat: stat dicts or ROITable (optional)
+    arrays:
+        traces (TRACE_KEYS, ROIs x frames) and CELL_KEYS arrays; None values are skipped
+
+    Returns
+    -------
+    filename: str
+    """
+    filename = os.path.join(fpath, RESULTS_NAME)
+    with h5py.File(filename + '.tmp', 'w') as f:
+        for key, val in arrays.items():
+            if val is None:
+                continue
+            val = np.asarray(val)
+            if key in TRACE_KEYS and val.ndim == 2 and val.size > 0:
+                chunks = (min(CHUNK_ROIS, val.shape[0]), min(CHUNK_FRAMES, val.shape[1]))
+                f.create_dataset(key, data=val, chunks=chunks)
+            else:
+                f.create_dataset(key, data=val)
+        if stat is not None:
+            _write_stat(f.create_group('stat'), stat if isinstance(stat, ROITable) else ROITable.from_stat(stat))
+        if ops is not None:
+            _write_ops(f.create_group('ops'), ops)
+    os.replace(filename + '.tmp', filename)
+    return filename
+
+
+class Results:
+
+    def __init__(self, fpath: str):
+        """
+        Lazily-loaded results of a plane (or combined) folder, see load_results.
+
+        Traces and iscell/redcell are indexed as results['F'][iroi], results['F'][:, t0:t1];
+        results.stat (ROITable) and results.ops (dict) are read on first access.
+        """
+        self.fpath = fpath
+        filename = os.path.join(fpath, RESULTS_NAME)
+        self.file = h5py.File(filename, 'r') if os.path.isfile(filename) else None
+        self._stat = None
+        self._ops = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+
+    def keys(self):
+        if self.file is not None:
+            return [key for key in TRACE_KEYS + CELL_KEYS if key in self.file]
+        return [key for key in TRACE_KEYS + CELL_KEYS if os.path.isfile(os.path.join(self.fpath, key + '.npy'))]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.keys()
+
+    def __getitem__(self, key: str):
+        """h5py dataset (or read-only memory-mapped array) of the traces or cell labels key."""
+        if key not in self.keys():
+            raise KeyError(key)
+        if self.file is not None:
+            return self.file[key]
+        return np.load(os.path.join(self.fpath, key + '.npy'), mmap_mode='r')
+
+    @property
+    def stat(self) -> ROITable:
+        if self._stat is None:
+            if self.file is not None and 'stat' in self.file:
+                group = self.file['stat']
+                self._stat = ROITable(group['offsets'][()], {key: val[()] for key, val in group['pixel'].items()},
+                                      {key: val[()] for key, val in group['roi'].items()},
+                                      json.loads(group.attrs['keys']))
+            else:
+                self._stat = load_stat(self.fpath, as_table=True)
+        return self._stat
+
+    @property
+    def ops(self) -> dict:
+        if self._ops is None:
+            if self.file is not None and 'ops' in self.file:
+                group = self.file['ops']
+                self._ops = json.loads(group.attrs['json'])
+                self._ops.update({key: val[()] for key, val in group.items()})
+            else:
+                self._ops = load_ops(os.path.join(self.fpath, 'ops.npy'))
+        return self._ops
+
+
+def load_results(fpath: str) -> Results:
+    """
+    Opens the results of a plane (or combined) folder for lazy reading.
+
+    Uses the results store RESULTS_NAME if present, else the .npy files (memory-mapped).
+
+    Returns
+    -------
+    results: Results
+        results['F'][iroi] reads one trace, results['spks'][:, t0:t1] a time window;
+        results.stat is the ROITable and results.ops the ops dict
+    """
+    return Results(fpath)
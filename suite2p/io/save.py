@@ -5,6 +5,10 @@ from datetime import datetime
 import scipy
 import pathlib
 
+from ..detection.roitable import ROITable, load_stat, save_stat
+from .opsfile import load_ops, save_ops
+from .results import save_results
+
 def save_mat(ops, stat, F, Fneu, spks, iscell, redcell):
     ops_matlab = ops.copy()
     if ops_matlab.get('date_proc'):
@@ -76,7 +80,7 @@ def combined(save_folder, save=True):
     Multi-plane / multi-roi recordings are tiled after using dx,dy.
     """
     plane_folders = natsorted([ f.path for f in os.scandir(save_folder) if f.is_dir() and f.name[:5]=='plane'])
-    ops1 = [np.load(os.path.join(f, 'ops.npy'), allow_pickle=True).item() for f in plane_folders]
+    ops1 = [load_ops(os.path.join(f, 'ops.npy')) for f in plane_folders]
     dy, dx = compute_dydx(ops1)
     Ly = np.array([ops['Ly'] for ops in ops1])
     Lx = np.array([ops['Lx'] for ops in ops1])
@@ -98,7 +102,7 @@ def combined(save_folder, save=True):
         fpath = plane_folders[k]
         if not os.path.exists(os.path.join(fpath,'stat.npy')):
             continue
-        stat0 = np.load(os.path.join(fpath,'stat.npy'), allow_pickle=True)
+        stat0 = load_stat(fpath, as_table=True)
         xrange = np.arange(dx[k], dx[k] + Lx[k])
         yrange = np.arange(dy[k], dy[k] + Ly[k])
         meanImg[np.ix_(yrange, xrange)] = ops['meanImg']
@@ -114,12 +118,16 @@ def combined(save_folder, save=True):
         Vcorr[np.ix_(yrange, xrange)] = ops['Vcorr']
         if 'max_proj' in ops:
             max_proj[np.ix_(yrange, xrange)] = ops['max_proj']
-        for j in range(len(stat0)):
-            stat0[j]['xpix'] += dx[k]
-            stat0[j]['ypix'] += dy[k]
-            stat0[j]['med'][0] += dy[k]
-            stat0[j]['med'][1] += dx[k]
-            stat0[j]['iplane'] = k
+        if len(stat0):
+            stat0.pixel['xpix'] += dx[k]
+            stat0.pixel['ypix'] += dy[k]
+            if stat0.roi['med'].dtype == object:
+                stat0.roi['med'] = np.array([np.asarray(med) for med in stat0.roi['med']])
+            stat0.roi['med'][:, 0] += dy[k]
+            stat0.roi['med'][:, 1] += dx[k]
+            stat0.roi['iplane'] = np.full(len(stat0), k)
+            if 'iplane' not in stat0.keys:
+                stat0.keys.append('iplane')
         F0    = np.load(os.path.join(fpath,'F.npy'))
         Fneu0 = np.load(os.path.join(fpath,'Fneu.npy'))
         spks0 = np.load(os.path.join(fpath,'spks.npy'))
@@ -144,12 +152,13 @@ def combined(save_folder, save=True):
             F    = np.concatenate((F, F0))
             Fneu = np.concatenate((Fneu, Fneu0))
             spks = np.concatenate((spks, spks0))
-            stat = np.concatenate((stat,stat0))
+            stat = ROITable.concatenate((stat,stat0))
             iscell = np.concatenate((iscell,iscell0))
             if hasred:
                 redcell = np.concatenate((redcell,redcell0))
         ii+=1
         print('appended plane %d to combined view'%k)
+    stat_table, stat = stat, stat.to_stat()
     ops['meanImg']  = meanImg
     ops['meanImgE'] = meanImgE
     if ops['nchannels']>1:
@@ -188,8 +197,11 @@ def combined(save_folder, save=True):
         np.save(os.path.join(fpath, 'F.npy'), F)
         np.save(os.path.join(fpath, 'Fneu.npy'), Fneu)
         np.save(os.path.join(fpath, 'spks.npy'), spks)
-        np.save(os.path.join(fpath, 'ops.npy'), ops)
-        np.save(os.path.join(fpath, 'stat.npy'), stat)
+        save_ops(ops, os.path.join(fpath, 'ops.npy'), save_npy=ops.get('save_ops_npy', True))
+        save_stat(fpath, stat, table=stat_table)
+        if ops.get('save_results_h5'):
+            save_results(fpath, ops=ops, stat=stat_table, F=F, Fneu=Fneu, spks=spks, iscell=iscell,
+                         redcell=redcell if hasred else None)
         
         # save as matlab file
         if ops.get('save_mat'):
@@ -1,8 +1,11 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
+from numba import njit
 
 from .utils import init_ops, find_files_open_binaries
+from . import manifest
 
 try:
     from sbxreader import sbx_memmap
@@ -22,6 +25,9 @@ def sbx_to_binary(ops, ndeadcols=-1, ndeadrows=0):
     ops : dictionary
         'nplanes', 'data_path', 'save_path', 'save_folder', 'fast_disk',
         'nchannels', 'keep_movie_raw', 'look_one_level_down'
+        (optional 'resume_ingest': continue after the last file written by an interrupted run, see io.manifest)
+        (optional 'io_workers': with more than one, each plane and channel of a file is converted
+        by its own worker process, see convert_plane)
 
     Returns
     -------
@@ -35,11 +41,13 @@ def sbx_to_binary(ops, ndeadcols=-1, ndeadrows=0):
     nplanes = ops1[0]['nplanes']
     nchannels = ops1[0]['nchannels']
     # open all binary files for writing
-    ops1, sbxlist, reg_file, reg_file_chan2 = find_files_open_binaries(ops1)
-    iall = 0
+    ops1, sbxlist, reg_file, reg_file_chan2 = find_files_open_binaries(ops1, resumable=True)
     for j in range(ops1[0]['nplanes']):
         ops1[j]['nframes_per_folder'] = np.zeros(len(sbxlist), np.int32)
-    ik = 0
+    # files already written by an interrupted run
+    nfiles_done, state = manifest.resume_counters(ops1)
+    iall = state.get('iall', 0)
+    ik = state.get('ik', 0)
     if 'sbx_ndeadcols' in ops1[0].keys():
         ndeadcols = int(ops1[0]['sbx_ndeadcols'])
     if 'sbx_ndeadrows' in ops1[0].keys():
@@ -69,8 +77,21 @@ def sbx_to_binary(ops, ndeadcols=-1, ndeadrows=0):
     ops1[0]['sbx_ndeadcols'] = ndeadcols
     ops1[0]['sbx_ndeadrows'] = ndeadrows
     
+    n_workers = ops1[0].get('io_workers', 1)
+    executor = None
+    if n_workers > 1 and not ops1[0].get('compression'):
+        executor = ProcessPoolExecutor(max_workers=n_workers)
     for ifile,sbxfname in enumerate(sbxlist):
+        if ifile < nfiles_done:
+            continue
         f = sbx_memmap(sbxfname)
+        if executor is not None:
+            convert_file_parallel(executor, f, sbxfname, ifile, ops1, reg_file, reg_file_chan2,
+                                  ndeadrows, ndeadcols, first=iall==0)
+            ik += f.shape[0]
+            iall += f.shape[0]
+            manifest.checkpoint(ops1, sbxlist, ifile + 1, reg_file, reg_file_chan2, {'iall': iall, 'ik': ik})
+            continue
         nplanes = f.shape[1]
         nchannels = f.shape[2]
         nframes = f.shape[0]
@@ -89,33 +110,38 @@ def sbx_to_binary(ops, ndeadcols=-1, ndeadrows=0):
             im = np.array(f[onset:offset,:,:,ndeadrows:,ndeadcols:])//2
             im = im.astype(np.int16)
             im2mean = im.mean(axis = 0).astype(np.float32)/len(iblocks) 
+            if iall==0:
+                for j in range(0,nplanes):
+                    ops1[j]['meanImg'] = np.zeros((im.shape[3],im.shape[4]),np.float32)
+                    if nchannels>1:
+                        ops1[j]['meanImg_chan2'] = np.zeros((im.shape[3],im.shape[4]),np.float32)
+                    ops1[j]['nframes'] = 0
             for ichan in range(nchannels):
                 nframes = im.shape[0]
                 im2write = im[:,:,ichan,:,:]
                 for j in range(0,nplanes):
-                    if iall==0:
-                        ops1[j]['meanImg'] = np.zeros((im.shape[3],im.shape[4]),np.float32)
-                        if nchannels>1:
-                            ops1[j]['meanImg_chan2'] = np.zeros((im.shape[3],im.shape[4]),np.float32)
-                        ops1[j]['nframes'] = 0
                     if ichan == nfunc:
                         ops1[j]['meanImg'] += np.squeeze(im2mean[j,ichan,:,:])
                         reg_file[j].write(bytearray(im2write[:,j,:,:].astype('int16')))
+                        ops1[j]['nframes'] += im2write.shape[0]
+                        ops1[j]['nframes_per_folder'][ifile] += im2write.shape[0]
                     else:
                         ops1[j]['meanImg_chan2'] += np.squeeze(im2mean[j,ichan,:,:])
                         reg_file_chan2[j].write(bytearray(im2write[:,j,:,:].astype('int16')))
-                        
-                    ops1[j]['nframes'] += im2write.shape[0]
-                    ops1[j]['nframes_per_folder'][ifile] += im2write.shape[0]
+
             ik += nframes
             iall += nframes
+        if iall > 0:
+            manifest.checkpoint(ops1, sbxlist, ifile + 1, reg_file, reg_file_chan2, {'iall': iall, 'ik': ik})
+
+    if executor is not None:
+        executor.shutdown()
 
     # write ops files
     do_registration = ops1[0]['do_registration']
     do_nonrigid = ops1[0]['nonrigid']
     for ops in ops1:
-        ops['Ly'] = im.shape[3]
-        ops['Lx'] = im.shape[4]
+        ops['Ly'], ops['Lx'] = ops['meanImg'].shape
         if not do_registration:
             ops['yrange'] = np.array([0,ops['Ly']])
             ops['xrange'] = np.array([0,ops['Lx']])
@@ -129,3 +155,87 @@ def sbx_to_binary(ops, ndeadcols=-1, ndeadrows=0):
         if nchannels>1:
             reg_file_chan2[j].close()
     return ops1[0]
+
+
+@njit(cache=True)
+def invert_halve_sum(raw, out, msum):
+    """ out = (65535 - raw) // 2 as written by sbx_to_binary, and its sum over frames added to msum
+
+    raw is a (strided) view of the uint16 sbx memmap, out is int16 frames x Ly x Lx
+    """
+    n, Ly, Lx = raw.shape
+    for t in range(n):
+        for y in range(Ly):
+            for x in range(Lx):
+                v = (65535 - np.int32(raw[t, y, x])) >> 1
+                out[t, y, x] = v
+                msum[y, x] += v
+
+
+def convert_plane(sbxfname, j, ichan, ndeadrows, ndeadcols, batch_size, filename, offset):
+    """ writes plane j, channel ichan of a scanbox file to the binary filename at byte offset
+
+    frames are read directly from the memory-mapped file and inverted, halved and summed
+    in one pass (see invert_halve_sum)
+
+    Returns
+    -------
+        nframes : int
+            number of frames written
+        meanImg : 2D array
+            contribution to meanImg, normalized like the serial conversion in sbx_to_binary
+
+    """
+    f = sbx_memmap(sbxfname)
+    # raw counts without the inversion done by sbx_memmap.__getitem__
+    raw = f.view(np.ndarray)[:, j, ichan, ndeadrows:, ndeadcols:]
+    nframes, Ly, Lx = raw.shape
+    iblocks = np.arange(0, nframes, batch_size)
+    if iblocks[-1] < nframes:
+        iblocks = np.append(iblocks, nframes)
+    meanImg = np.zeros((Ly, Lx), np.float32)
+    msum = np.zeros((Ly, Lx), np.float64)
+    with open(filename, 'r+b') as fout:
+        for onset, offset_frame in zip(iblocks[:-1], iblocks[1:]):
+            out = np.empty((offset_frame - onset, Ly, Lx), np.int16)
+            msum[:] = 0
+            invert_halve_sum(raw[onset:offset_frame], out, msum)
+            meanImg += (msum / out.shape[0]).astype(np.float32) / len(iblocks)
+            fout.seek(offset + onset * out[0].nbytes)
+            fout.write(bytearray(out))
+    return nframes, meanImg
+
+
+def convert_file_parallel(executor, f, sbxfname, ifile, ops1, reg_file, reg_file_chan2,
+                          ndeadrows, ndeadcols, first=False):
+    """ converts one scanbox file with one worker per plane and channel (see convert_plane)
+
+    the binaries are written at their current positions, which are then moved past the new frames
+
+    """
+    nchannels = f.shape[2]
+    nfunc = ops1[0]['functional_chan'] - 1 if nchannels > 1 else 0
+    futures = {}
+    for j in range(len(ops1)):
+        for ichan in range(nchannels):
+            fbin = reg_file[j] if ichan == nfunc else reg_file_chan2[j]
+            fbin.flush()
+            futures[j, ichan] = (fbin, fbin.tell(), executor.submit(
+                convert_plane, sbxfname, j, ichan, ndeadrows, ndeadcols, ops1[0]['batch_size'],
+                fbin.name, fbin.tell()))
+    if first:
+        Ly, Lx = f.shape[3] - ndeadrows, f.shape[4] - ndeadcols
+        for ops in ops1:
+            ops['meanImg'] = np.zeros((Ly, Lx), np.float32)
+            if nchannels > 1:
+                ops['meanImg_chan2'] = np.zeros((Ly, Lx), np.float32)
+            ops['nframes'] = 0
+    for (j, ichan), (fbin, offset, future) in futures.items():
+        nframes, meanImg = future.result()
+        fbin.seek(offset + nframes * meanImg.size * 2)
+        if ichan == nfunc:
+            ops1[j]['meanImg'] += meanImg
+            ops1[j]['nframes'] += nframes
+            ops1[j]['nframes_per_folder'][ifile] += nframes
+        else:
+            ops1[j]['meanImg_chan2'] += meanImg
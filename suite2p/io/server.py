@@ -4,6 +4,8 @@ from natsort import natsorted
 import paramiko
 import numpy as np
 
+from .opsfile import load_ops
+
 def unix_path(path):
     return str(path).replace(os.sep, '/')
 
@@ -86,7 +88,7 @@ def send_jobs(save_folder,
         ipl = int(Path(pdir).parts[-1][5:])
         print('>>>>>>>>>> PLANE %d <<<<<<<<<'%ipl)
         ops_path_orig = pdir + 'ops.npy'
-        op = np.load(ops_path_orig, allow_pickle=True).item()
+        op = load_ops(ops_path_orig)
         fast_disk_orig = Path(op['fast_disk'])
 
         ## change paths
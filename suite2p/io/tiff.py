@@ -4,6 +4,8 @@ import json
 import math
 import os
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union, Tuple, Optional
 
 
@@ -11,7 +13,7 @@ import numpy as np
 from ScanImageTiffReader import ScanImageTiffReader
 from tifffile import imread, TiffFile, TiffWriter
 
-from . import utils
+from . import utils, manifest, tiffmeta
 
 
 def generate_tiff_filename(functional_chan: int, align_by_chan: int, save_path: str, k: int, ichan: bool) -> str:
@@ -74,10 +76,13 @@ def save_tiff(mov: np.ndarray, fname: str) -> None:
 
 
 def open_tiff(file: str, sktiff: bool) -> Tuple[Union[TiffFile, ScanImageTiffReader], int]:
-    """ Returns image and its length from tiff file with either ScanImageTiffReader or tifffile, based on 'sktiff'"""
+    """ Returns image and its length from tiff file with either ScanImageTiffReader or tifffile, based on 'sktiff'
+
+    with tifffile, the number of pages is taken from the tiff metadata cache (see tiffmeta)
+    """
     if sktiff:
         tif = TiffFile(file)
-        Ltif = len(tif.pages)
+        Ltif = tiffmeta.tiff_metadata([file])[0]['npages']
     else:
         tif = ScanImageTiffReader(file)
         Ltif = 1 if len(tif.shape()) < 3 else tif.shape()[0]  # single page tiffs
@@ -85,14 +90,103 @@ def open_tiff(file: str, sktiff: bool) -> Tuple[Union[TiffFile, ScanImageTiffRea
 
 
 def use_sktiff_reader(tiff_filename, batch_size: Optional[int] = None) -> bool:
-    """Returns False if ScanImageTiffReader works on the tiff file, else True (in which case use tifffile)."""
-    try:
-        with ScanImageTiffReader(tiff_filename) as tif:
-            tif.data() if len(tif.shape()) < 3 else tif.data(beg=0, end=np.minimum(batch_size, tif.shape()[0] - 1))
-        return False
-    except:
+    """Returns False if ScanImageTiffReader works on the tiff file, else True (in which case use tifffile).
+
+    The result is kept in the tiff metadata cache (see tiffmeta), so the test read is done once per file.
+    """
+    sktiff = tiffmeta.tiff_metadata([tiff_filename])[0].get('sktiff')
+    if sktiff is None:
+        try:
+            with ScanImageTiffReader(tiff_filename) as tif:
+                tif.data() if len(tif.shape()) < 3 else tif.data(beg=0, end=np.minimum(batch_size, tif.shape()[0] - 1))
+            sktiff = False
+        except:
+            sktiff = True
+        tiffmeta.update_tiff_metadata(tiff_filename, sktiff=sktiff)
+    if sktiff:
         print('NOTE: ScanImageTiffReader not working for this tiff type, using tifffile')
-        return True
+    return sktiff
+
+def imread_pages(file: str, ix: int, nfr: int) -> np.ndarray:
+    """ reads pages ix to ix+nfr with tifffile, directly at their cached offsets if they can be memory-mapped (see tiffmeta) """
+    meta = tiffmeta.tiff_metadata([file])[0]
+    if meta['offsets'] is not None:
+        return tiffmeta.read_pages(file, meta, ix, nfr)
+    return imread(file, pages=range(ix, min(ix + nfr, meta['npages'])))
+
+
+def read_tiff(file: str, tif, Ltif: int, ix: int, nfr: int, use_sktiff: bool) -> np.ndarray:
+    """ reads pages ix to ix+nfr of an open tiff and returns them as int16 (uint16 and int32 are halved)
+
+    with tifffile, see imread_pages
+    """
+    if use_sktiff:
+        im = imread_pages(file, ix, nfr)
+    elif Ltif == 1:
+        im = tif.data()
+    else:
+        im = tif.data(beg=ix, end=ix+nfr)
+
+    # for single-page tiffs, add 1st dim
+    if len(im.shape) < 3:
+        im = np.expand_dims(im, axis=0)
+
+    # check if uint16
+    if im.dtype.type == np.uint16:
+        im = (im // 2).astype(np.int16)
+    elif im.dtype.type == np.int32:
+        im = (im // 2).astype(np.int16)
+    elif im.dtype.type != np.int16:
+        im = im.astype(np.int16)
+
+    if im.shape[0] > nfr:
+        im = im[:nfr, :, :]
+    return im
+
+
+def iter_tiff_batches(fs, use_sktiff: bool, batch_size: int, n_workers: int = 1):
+    """ yields (file index, first page, frames) for all tiffs in fs in file and page order
+
+    with n_workers > 1, the page counts of all files are read first and batches of pages
+    are decoded by a pool of threads, at most 2*n_workers batches ahead of the consumer;
+    with tifffile, the metadata of all files is looked up (and cached) at once, see tiffmeta
+
+    """
+    if use_sktiff:
+        tiffmeta.tiff_metadata(fs, n_workers=n_workers)
+    if n_workers <= 1:
+        for ik, file in enumerate(fs):
+            tif, Ltif = open_tiff(file, use_sktiff)
+            for ix in range(0, Ltif, batch_size):
+                yield ik, ix, read_tiff(file, tif, Ltif, ix, min(Ltif - ix, batch_size), use_sktiff)
+            gc.collect()
+        return
+
+    def n_pages(file):
+        tif, Ltif = open_tiff(file, use_sktiff)
+        tif.close()
+        return Ltif
+
+    def decode(ik, ix, nfr, Ltif):
+        tif, _ = open_tiff(fs[ik], use_sktiff)
+        try:
+            return read_tiff(fs[ik], tif, Ltif, ix, nfr, use_sktiff)
+        finally:
+            tif.close()
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        Ltifs = list(executor.map(n_pages, fs))
+        pending = deque()
+        for ik, Ltif in enumerate(Ltifs):
+            for ix in range(0, Ltif, batch_size):
+                pending.append((ik, ix, executor.submit(decode, ik, ix, min(Ltif - ix, batch_size), Ltif)))
+                if len(pending) >= 2 * n_workers:
+                    ik0, ix0, im = pending.popleft()
+                    yield ik0, ix0, im.result()
+        while pending:
+            ik0, ix0, im = pending.popleft()
+            yield ik0, ix0, im.result()
+
 
 def tiff_to_binary(ops):
     """  finds tiff files and writes them to binaries
@@ -101,6 +195,9 @@ def tiff_to_binary(ops):
     ----------
     ops : dictionary
         'nplanes', 'data_path', 'save_path', 'save_folder', 'fast_disk', 'nchannels', 'keep_movie_raw', 'look_one_level_down'
+        (optional 'io_workers': number of threads decoding tiffs, frames are still written in order)
+        (optional 'fused_registration': register frames while converting, see utils.init_fused_registration)
+        (optional 'resume_ingest': continue after the last tiff written by an interrupted run, see io.manifest)
 
     Returns
     -------
@@ -119,94 +216,103 @@ def tiff_to_binary(ops):
 
     # open all binary files for writing
     # look for tiffs in all requested folders
-    ops1, fs, reg_file, reg_file_chan2 = utils.find_files_open_binaries(ops1, False)
+    ops1, fs, reg_file, reg_file_chan2 = utils.find_files_open_binaries(ops1, False, resumable=True)
     ops = ops1[0]
+    # tiffs already written by an interrupted run
+    nfiles_done, state = manifest.resume_counters(ops1)
     # try tiff readers
     use_sktiff = True if ops['force_sktiff'] else use_sktiff_reader(fs[0], batch_size=ops1[0].get('batch_size'))
     
     batch_size = ops['batch_size']
     batch_size = nplanes*nchannels*math.ceil(batch_size/(nplanes*nchannels))
 
-    # loop over all tiffs
-    which_folder = -1
-    ntotal=0
-    for ik, file in enumerate(fs):
-        # open tiff
-        tif, Ltif = open_tiff(file, use_sktiff)
-        # keep track of the plane identity of the first frame (channel identity is assumed always 0)
-        if ops['first_tiffs'][ik]:
-            which_folder += 1
-            iplane = 0
-        ix = 0
+    # register frames as they are converted (None if registering after conversion)
+    regs = utils.init_fused_registration(ops1)
+    align_is_func = nchannels == 1 or ops['functional_chan'] == ops['align_by_chan']
 
-        while 1:
-            if ix >= Ltif:
-                break
-            nfr = min(Ltif - ix, batch_size)
-            # tiff reading
-            if use_sktiff:
-                im = imread(file, pages=range(ix, ix + nfr))
-            elif Ltif == 1:
-                im = tif.data()
+    def write_plane(j, frames, frames_chan2):
+        if regs is not None:
+            if align_is_func:
+                frames, frames_chan2 = regs[j].register(frames, frames_chan2)
             else:
-                im = tif.data(beg=ix, end=ix+nfr)
-
-            # for single-page tiffs, add 1st dim
-            if len(im.shape) < 3:
-                im = np.expand_dims(im, axis=0)
-
-            # check if uint16
-            if im.dtype.type == np.uint16:
-                im = (im // 2).astype(np.int16)
-            elif im.dtype.type == np.int32:
-                im = (im // 2).astype(np.int16)
-            elif im.dtype.type != np.int16:
-                im = im.astype(np.int16)
-            
-            if im.shape[0] > nfr:
-                im = im[:nfr, :, :]
-            nframes = im.shape[0]
-            for j in range(0,nplanes):
-                if ik==0 and ix==0:
-                    ops1[j]['nframes'] = 0
-                    ops1[j]['frames_per_file'] = np.zeros((len(fs),), dtype=int)
-                    ops1[j]['meanImg'] = np.zeros((im.shape[1], im.shape[2]), np.float32)
-                    if nchannels>1:
-                        ops1[j]['meanImg_chan2'] = np.zeros((im.shape[1], im.shape[2]), np.float32)
-                i0 = nchannels * ((iplane+j)%nplanes)
+                frames_chan2, frames = regs[j].register(frames_chan2, frames)
+        reg_file[j].write(bytearray(frames))
+        if nchannels>1:
+            reg_file_chan2[j].write(bytearray(frames_chan2))
+
+    # loop over all tiffs, batches are decoded in parallel but arrive (and are written) in order
+    which_folder = state.get('which_folder', -1)
+    iplane = state.get('iplane', 0)
+    ntotal = state.get('ntotal', 0)
+    ik_last = nfiles_done - 1
+    for ik, ix, im in iter_tiff_batches(fs[nfiles_done:], use_sktiff, batch_size, n_workers=ops.get('io_workers', 1)):
+        ik += nfiles_done
+        if ik != ik_last and ntotal > 0 and regs is None:
+            # all tiffs before this one are written
+            manifest.checkpoint(ops1, fs, ik, reg_file, reg_file_chan2,
+                                {'which_folder': which_folder, 'iplane': iplane, 'ntotal': ntotal})
+        # keep track of the plane identity of the first frame (channel identity is assumed always 0)
+        for ik_new in range(ik_last + 1, ik + 1):
+            if ops['first_tiffs'][ik_new]:
+                which_folder += 1
+                iplane = 0
+        ik_last = ik
+
+        nframes = im.shape[0]
+        for j in range(0,nplanes):
+            if ntotal==0:
+                ops1[j]['nframes'] = 0
+                ops1[j]['frames_per_file'] = np.zeros((len(fs),), dtype=int)
+                ops1[j]['meanImg'] = np.zeros((im.shape[1], im.shape[2]), np.float32)
                 if nchannels>1:
-                    nfunc = ops['functional_chan']-1
-                else:
-                    nfunc = 0
-                im2write = im[int(i0)+nfunc:nframes:nplanes*nchannels]
-
-                reg_file[j].write(bytearray(im2write))
-                ops1[j]['meanImg'] += im2write.astype(np.float32).sum(axis=0)
-                ops1[j]['nframes'] += im2write.shape[0]
-                ops1[j]['frames_per_file'][ik] += im2write.shape[0]
-                ops1[j]['frames_per_folder'][which_folder] += im2write.shape[0]
-                #print(ops1[j]['frames_per_folder'][which_folder])
+                    ops1[j]['meanImg_chan2'] = np.zeros((im.shape[1], im.shape[2]), np.float32)
+            i0 = nchannels * ((iplane+j)%nplanes)
+            if nchannels>1:
+                nfunc = ops['functional_chan']-1
+            else:
+                nfunc = 0
+            im2write = im[int(i0)+nfunc:nframes:nplanes*nchannels]
+            im2write_chan2 = im[int(i0)+1-nfunc:nframes:nplanes*nchannels] if nchannels>1 else None
+
+            ops1[j]['meanImg'] += im2write.astype(np.float32).sum(axis=0)
+            ops1[j]['nframes'] += im2write.shape[0]
+            ops1[j]['frames_per_file'][ik] += im2write.shape[0]
+            ops1[j]['frames_per_folder'][which_folder] += im2write.shape[0]
+            #print(ops1[j]['frames_per_folder'][which_folder])
+            if nchannels>1:
+                ops1[j]['meanImg_chan2'] += im2write_chan2.mean(axis=0)
+            write_plane(j, im2write, im2write_chan2)
+
+        iplane = (iplane-nframes/nchannels)%nplanes
+        ntotal+=nframes
+        if ntotal%(batch_size*4)==0:
+            print('%d frames of binary, time %0.2f sec.'%(ntotal,time.time()-t0))
+    # register frames still buffered for the reference image
+    if regs is not None:
+        for j in range(nplanes):
+            frames, frames_chan2 = regs[j].flush()
+            if len(frames):
+                if not align_is_func:
+                    frames, frames_chan2 = frames_chan2, frames
+                reg_file[j].write(bytearray(frames))
                 if nchannels>1:
-                    im2write = im[int(i0)+1-nfunc:nframes:nplanes*nchannels]
-                    reg_file_chan2[j].write(bytearray(im2write))
-                    ops1[j]['meanImg_chan2'] += im2write.mean(axis=0)
-
-
-            iplane = (iplane-nframes/nchannels)%nplanes
-            ix+=nframes
-            ntotal+=nframes
-            if ntotal%(batch_size*4)==0:
-                print('%d frames of binary, time %0.2f sec.'%(ntotal,time.time()-t0))
-        gc.collect()
+                    reg_file_chan2[j].write(bytearray(frames_chan2))
+    elif ntotal > 0:
+        manifest.checkpoint(ops1, fs, len(fs), reg_file, reg_file_chan2,
+                            {'which_folder': which_folder, 'iplane': iplane, 'ntotal': ntotal})
     # write ops files
     do_registration = ops['do_registration']
-    for ops in ops1:
+    for j, ops in enumerate(ops1):
         ops['Ly'],ops['Lx'] = ops['meanImg'].shape
         ops['yrange'] = np.array([0,ops['Ly']])
         ops['xrange'] = np.array([0,ops['Lx']])
         ops['meanImg'] /= ops['nframes']
         if nchannels>1:
             ops['meanImg_chan2'] /= ops['nframes']
+        if regs is not None:
+            # offsets, registered mean images, badframes and valid region
+            ops = regs[j].finalize()
+            ops['registered_on_convert'] = True
         np.save(ops['ops_path'], ops)
     # close all binary files and write ops files
     for j in range(0,nplanes):
@@ -287,6 +393,9 @@ def mesoscan_to_binary(ops):
     # which tiff reader works for user's tiffs
     use_sktiff = True if ops['force_sktiff'] else use_sktiff_reader(fs[0], batch_size=ops1[0].get('batch_size'))
 
+    if use_sktiff:
+        tiffmeta.tiff_metadata(fs)
+
     # loop over all tiffs
     which_folder = -1
     ntotal=0
@@ -302,7 +411,7 @@ def mesoscan_to_binary(ops):
                 break
             nfr = min(Ltif - ix, batch_size)
             if use_sktiff:
-                im = imread(file, pages = range(ix, ix + nfr))
+                im = imread_pages(file, ix, nfr)
             else:
                 if Ltif==1:
                     im = tif.data()
@@ -0,0 +1,228 @@
+"""
+Cached tiff header metadata, shared by all tiff readers.
+
+Parsing the headers of a tiff (every page's IFD, and the ScanImage JSON metadata) is slow for
+large multi-page files and was repeated by every reader and pipeline stage. tiff_metadata parses
+each tiff once and stores the result in TIFF_INDEX_CACHE in the tiff's folder, keyed by file
+name, size and modification time, so later calls (also by other processes and later runs) read
+it from the cache. The cache file is rewritten at the end of each call for several files, every
+SAVE_EVERY new entries, and at exit, so converters should look up their whole file list at once.
+The cached fields are
+
+    'npages': number of pages
+    'Ly', 'Lx', 'dtype': shape and dtype (with byte order) of the first page
+    'offsets': data offset of each page (int64 array), or None if the pages cannot be
+        memory-mapped (compressed, tiled, not contiguous or differing in shape / dtype)
+    'shape': shape of the first tiff series
+    'scanimage': None, or a dict with the ScanImage 'rois' (the imaging ROI group of the
+        'Artist' tag), 'frame_rate', 'volume_rate', 'nplanes' and 'channels' (those found)
+
+and readers may add fields with update_tiff_metadata (e.g. 'sktiff', see tiff.use_sktiff_reader).
+"""
+import atexit
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import numpy as np
+from tifffile import TiffFile
+
+TIFF_INDEX_CACHE = '.suite2p_tiff_index.npz'
+VERSION = 2
+# number of new entries of a folder after which single-file lookups rewrite its cache file
+SAVE_EVERY = 256
+
+_caches = {}
+# names of the entries of each folder that are not in its cache file yet
+_unsaved = {}
+_lock = threading.Lock()
+
+# ScanImage FrameData fields kept in the metadata
+SCANIMAGE_FIELDS = {'frame_rate': 'SI.hRoiManager.scanFrameRate',
+                    'volume_rate': 'SI.hRoiManager.scanVolumeRate',
+                    'nplanes': 'SI.hStackManager.numSlices',
+                    'channels': 'SI.hChannels.channelSave'}
+
+
+def page_offsets(tif: TiffFile) -> Optional[np.ndarray]:
+    """returns the data offset of each page of an open tiff, or None if the pages cannot be memory-mapped."""
+    offsets = np.zeros(len(tif.pages), np.int64)
+    shape, dtype = None, None
+    for k, page in enumerate(tif.pages):
+        if page.compression != 1 or page.is_tiled or page.samplesperpixel != 1 or len(page.shape) != 2:
+            return None
+        if shape is None:
+            shape, dtype = page.shape, page.dtype
+        elif page.shape != shape or page.dtype != dtype:
+            return None
+        starts, counts = np.array(page.dataoffsets), np.array(page.databytecounts)
+        if np.any(starts[1:] != starts[:-1] + counts[:-1]) or counts.sum() != page.dtype.itemsize * np.prod(shape):
+            return None
+        offsets[k] = starts[0]
+    return offsets
+
+
+def scanimage_metadata(tif: TiffFile) -> Optional[dict]:
+    """returns the ROIs and frame rates of a ScanImage tiff, None for other tiffs."""
+    meta = {}
+    try:
+        artist = tif.pages[0].tags['Artist'].value
+        meta['rois'] = json.loads(artist)['RoiGroups']['imagingRoiGroup']['rois']
+    except (KeyError, TypeError, ValueError):
+        pass
+    try:
+        frame_data = tif.scanimage_metadata['FrameData']
+    except (KeyError, TypeError, ValueError):
+        frame_data = {}
+    for field, key in SCANIMAGE_FIELDS.items():
+        if key in frame_data:
+            meta[field] = frame_data[key]
+    return meta or None
+
+
+def read_tiff_metadata(file: str) -> dict:
+    """parses the header of a tiff (see module docstring), without the cache."""
+    with TiffFile(file) as tif:
+        page = tif.pages[0]
+        meta = {'npages': len(tif.pages), 'Ly': page.shape[-2], 'Lx': page.shape[-1],
+                'dtype': tif.byteorder + page.dtype.str[1:], 'offsets': page_offsets(tif),
+                'shape': tuple(tif.series[0].shape) if tif.series else tuple(page.shape),
+                'scanimage': scanimage_metadata(tif)}
+    return meta
+
+
+def _cache_path(folder: str) -> str:
+    return os.path.join(folder, TIFF_INDEX_CACHE)
+
+
+def _load_cache(folder: str) -> dict:
+    """returns the cache of a folder, reloaded (keeping unsaved entries) if it was written by another process."""
+    path = _cache_path(folder)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        mtime = None
+    if folder in _caches and _caches[folder][0] == mtime:
+        return _caches[folder][1]
+    cache = {}
+    if mtime is not None:
+        try:
+            with np.load(path, allow_pickle=True) as f:
+                cache = f['meta'].item()
+            if cache.get('_version') != VERSION:
+                cache = {}
+        except (OSError, KeyError, ValueError, EOFError):
+            cache = {}
+    if folder in _caches:
+        for name in _unsaved.get(folder, ()):
+            cache[name] = _caches[folder][1][name]
+    _caches[folder] = (mtime, cache)
+    return cache
+
+
+def _save_cache(folder: str) -> None:
+    cache = _load_cache(folder)
+    path = _cache_path(folder)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            np.savez(f, meta=np.array({**cache, '_version': VERSION}, dtype=object))
+        os.replace(tmp, path)
+        _caches[folder] = (os.stat(path).st_mtime_ns, cache)
+    except OSError:
+        print('NOTE: could not write tiff metadata cache in %s' % folder)
+    _unsaved.pop(folder, None)
+
+
+def _key(file: str):
+    stat = os.stat(file)
+    return (os.path.basename(file), stat.st_size, stat.st_mtime_ns)
+
+
+def tiff_metadata(fs: List[str], n_workers: int = 1) -> List[dict]:
+    """
+    Returns the header metadata of each tiff in fs (see module docstring), parsing only
+    the tiffs that are not in the cache of their folder or changed since.
+
+    Parameters
+    ----------
+    fs: list of str
+        tiff files
+    n_workers: int, default 1
+        number of threads parsing tiffs that are not in the cache
+
+    Returns
+    -------
+    metas: list of dict
+    """
+    metas = [None] * len(fs)
+    missing = []
+    with _lock:
+        for i, file in enumerate(fs):
+            folder, name = os.path.split(os.path.abspath(file))
+            key = _key(file)
+            entry = _load_cache(folder).get(name, {})
+            if entry.get('key') == key:
+                metas[i] = entry['meta']
+            else:
+                missing.append((i, folder, name, key))
+    # parse headers without holding the lock, so that reader threads are not serialized
+    if n_workers > 1 and len(missing) > 1:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            parsed = list(executor.map(read_tiff_metadata, [fs[i] for i, _, _, _ in missing]))
+    else:
+        parsed = [read_tiff_metadata(fs[i]) for i, _, _, _ in missing]
+    with _lock:
+        for (i, folder, name, key), meta in zip(missing, parsed):
+            cache = _load_cache(folder)
+            if cache.get(name, {}).get('key') != key:
+                cache[name] = {'key': key, 'meta': meta}
+                _unsaved.setdefault(folder, set()).add(name)
+            metas[i] = cache[name]['meta']
+        for folder in {folder for _, folder, _, _ in missing}:
+            if folder in _unsaved and (len(fs) > 1 or len(_unsaved[folder]) >= SAVE_EVERY):
+                _save_cache(folder)
+    return metas
+
+
+def update_tiff_metadata(file: str, **fields) -> dict:
+    """adds fields to the cached metadata of a tiff and returns the metadata (saved like new entries)."""
+    meta = tiff_metadata([file])[0]
+    folder, name = os.path.split(os.path.abspath(file))
+    with _lock:
+        meta.update(fields)
+        _unsaved.setdefault(folder, set()).add(name)
+        if len(_unsaved[folder]) >= SAVE_EVERY:
+            _save_cache(folder)
+    return meta
+
+
+@atexit.register
+def flush_tiff_metadata() -> None:
+    """writes the cache files of all folders with unsaved entries."""
+    with _lock:
+        for folder in list(_unsaved):
+            _save_cache(folder)
+
+
+def read_pages(file: str, meta: dict, ix: int, nfr: int, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Reads pages ix to ix+nfr of a tiff that can be memory-mapped (meta['offsets'] is not None)
+    directly at the cached page offsets, without parsing the tiff.
+
+    Returns
+    -------
+    im: nframes x Ly x Lx in the tiff's dtype (out, if given), nframes = min(nfr, npages - ix)
+    """
+    dtype = np.dtype(meta['dtype'])
+    npix = meta['Ly'] * meta['Lx']
+    offsets = meta['offsets'][ix:ix + nfr]
+    if out is None:
+        out = np.empty((len(offsets), meta['Ly'], meta['Lx']), dtype.newbyteorder('='))
+    mm = np.memmap(file, mode='r', dtype=np.uint8)
+    for k, offset in enumerate(offsets):
+        out[k] = mm[offset: offset + npix * dtype.itemsize].view(dtype).reshape(meta['Ly'], meta['Lx'])
+    del mm
+    return out
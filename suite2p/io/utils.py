@@ -5,6 +5,8 @@ from pathlib import Path
 import numpy as np
 from natsort import natsorted
 
+from . import manifest
+
 
 def search_for_ext(rootdir, extension = 'tif', look_one_level_down=False):
     filepaths = []
@@ -161,72 +163,91 @@ def get_tif_list(ops):
             print('** Found %d tifs - converting to binary **'%(len(fsall)))
     return fsall, ops
 
-def find_files_open_binaries(ops1, ish5=False):
-    """  finds tiffs or h5 files and opens binaries for writing
-
-    Parameters
-    ----------
-    ops1 : list of dictionaries
-        'keep_movie_raw', 'data_path', 'look_one_level_down', 'reg_file'...
+def list_input_files(ops, ish5=False):
+    """  finds the tiff, h5 or sbx files to convert, as given by ops['input_format']
 
     Returns
     -------
-        ops1 : list of dictionaries
-            adds fields 'filelist', 'first_tiffs', opens binaries
+        fs : list of files
+        ops2 : dictionary with 'first_tiffs' for tiffs, None otherwise
 
     """
-
-    reg_file = []
-    reg_file_chan2=[]
-
-
-    for ops in ops1:
-        nchannels = ops['nchannels']
-        if 'keep_movie_raw' in ops and ops['keep_movie_raw']:
-            reg_file.append(open(ops['raw_file'], 'wb'))
-            if nchannels>1:
-                reg_file_chan2.append(open(ops['raw_file_chan2'], 'wb'))
-        else:
-            reg_file.append(open(ops['reg_file'], 'wb'))
-            if nchannels>1:
-                reg_file_chan2.append(open(ops['reg_file_chan2'], 'wb'))
-
-        if 'input_format' in ops.keys():
-            input_format = ops['input_format']
-        else:
-            input_format = 'tif'
-    if ish5:
-        input_format = 'h5'
-    print(input_format)
+    input_format = 'h5' if ish5 else ops.get('input_format', 'tif')
+    ops2 = None
     if input_format == 'h5':
-        if len(ops1[0]['data_path'])>0:
-            fs, ops2 = get_h5_list(ops1[0])
+        if len(ops['data_path'])>0:
+            fs, ops2 = get_h5_list(ops)
             print('NOTE: using a list of h5 files:')
             print(fs)
         # find h5's
         else:
-            if ops1[0]['look_one_level_down']:
-                fs = list_h5(ops1[0])
+            if ops['look_one_level_down']:
+                fs = list_h5(ops)
                 print('NOTE: using a list of h5 files:')
                 print(fs)
             else:
-                fs = [ops1[0]['h5py']]
+                fs = [ops['h5py']]
     elif input_format == 'sbx':
         # find sbx
-        fs, ops2 = get_sbx_list(ops1[0])
+        fs, ops2 = get_sbx_list(ops)
         print('Scanbox files:')
         print('\n'.join(fs))
     else:
         # find tiffs
-        fs, ops2 = get_tif_list(ops1[0])
+        fs, ops2 = get_tif_list(ops)
+    return fs, ops2
+
+
+def find_files_open_binaries(ops1, ish5=False, resumable=False):
+    """  finds tiffs or h5 files and opens binaries for writing
+
+    Parameters
+    ----------
+    ops1 : list of dictionaries
+        'keep_movie_raw', 'data_path', 'look_one_level_down', 'reg_file'...
+    resumable : bool (optional, default False)
+        the converter records checkpoints (see io.manifest), so that with ops['resume_ingest']
+        binaries of an interrupted conversion are appended to instead of overwritten
+
+    Returns
+    -------
+        ops1 : list of dictionaries
+            adds fields 'filelist', 'first_tiffs', opens binaries
+
+    """
+    input_format = 'h5' if ish5 else ops1[0].get('input_format', 'tif')
+    print(input_format)
+    fs, ops2 = list_input_files(ops1[0], ish5)
+    if input_format not in ['h5', 'sbx']:
         for ops in ops1:
             ops['first_tiffs'] = ops2['first_tiffs']
             ops['frames_per_folder'] = np.zeros((ops2['first_tiffs'].sum(),), np.int32)
     for ops in ops1:
         ops['filelist'] = fs
+    reg_file, reg_file_chan2 = manifest.open_binaries(ops1, fs, resumable)
     return ops1, fs, reg_file, reg_file_chan2
 
 
+def init_fused_registration(ops1):
+    """ returns a registration.register.StreamingRegistration per plane if ops['fused_registration'] is set
+
+    frames are then registered while they are converted and only the registered binary is written;
+    returns None (register after conversion) if registration is off or forced, or if
+    'keep_movie_raw', 'two_step_registration' or 'frames_include' are set
+
+    """
+    ops = ops1[0]
+    if not ops.get('fused_registration', False) or ops['do_registration'] != 1:
+        return None
+    if ops.get('keep_movie_raw') or ops.get('two_step_registration') or ops.get('frames_include', -1) != -1:
+        print("NOTE: fused_registration is not used with keep_movie_raw, two_step_registration or frames_include")
+        return None
+    # imported here as registration depends on io
+    from ..registration.register import StreamingRegistration
+    return [StreamingRegistration(ops, refImg=ops['refImg'] if 'refImg' in ops and ops.get('force_refImg', False) else None)
+            for ops in ops1]
+
+
 def init_ops(ops):
     """ initializes ops files for each plane in recording
 
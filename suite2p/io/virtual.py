@@ -0,0 +1,294 @@
+"""
+Virtual binary files backed by uncompressed TIFFs or HDF5 (NWB) datasets.
+
+Instead of copying every frame into data_raw.bin, a small index file is written in its place.
+For tiffs it lists, for each frame of one plane/channel, the tiff and the byte offset of its
+pixel data (read by VirtualTiffFile, which memory-maps the tiffs); for HDF5 it names the file,
+the dataset and which of its frames belong to the plane/channel (read by VirtualH5File).
+Both are read like a raw binary (int16 frames, uint16/int32 halved as in tiff_to_binary).
+
+The page offsets of each tiff are read from the tiff metadata cache (see tiffmeta), so the
+tiffs are only parsed once.
+"""
+import json
+import os
+import threading
+import time
+from typing import List, Optional
+
+import numpy as np
+import h5py
+
+from . import utils, tiffmeta
+from .tiffmeta import TIFF_INDEX_CACHE
+
+MAGIC = b'S2PTIFV1'
+
+
+def is_virtual(filename) -> bool:
+    """Returns True if filename is a virtual tiff-backed binary."""
+    try:
+        with open(filename, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except (FileNotFoundError, IsADirectoryError):
+        return False
+
+
+def index_tiffs(fs: List[str]) -> Optional[List[dict]]:
+    """
+    Returns the cached tiff metadata (with the page 'offsets') of each tiff in fs, see tiffmeta.
+
+    Returns None if any tiff cannot be memory-mapped or the tiffs differ in frame size or dtype.
+    """
+    indexes = tiffmeta.tiff_metadata(fs)
+    for index in indexes:
+        if index['offsets'] is None or (index['Ly'], index['Lx'], index['dtype']) != \
+                (indexes[0]['Ly'], indexes[0]['Lx'], indexes[0]['dtype']):
+            return None
+    return indexes
+
+
+def to_int16(frames: np.ndarray) -> np.ndarray:
+    """converts frames to int16 as the converters do (uint16 and int32 are halved)."""
+    if frames.dtype.type in [np.uint16, np.int32]:
+        return (frames // 2).astype(np.int16)
+    return frames.astype(np.int16)
+
+
+def _write_header(f, header: dict) -> None:
+    header = json.dumps(header).encode()
+    f.write(MAGIC + np.array([len(header)], np.uint64).tobytes() + header)
+
+
+def _read_header(f) -> dict:
+    if f.read(len(MAGIC)) != MAGIC:
+        raise IOError("%s is not a virtual binary" % f.name)
+    nheader = int(np.frombuffer(f.read(8), np.uint64)[0])
+    return json.loads(f.read(nheader).decode())
+
+
+def write_virtual_file(filename: str, fs: List[str], file_ids: np.ndarray, offsets: np.ndarray,
+                       Ly: int, Lx: int, dtype: str) -> None:
+    """
+    Writes the index of a virtual tiff binary: frame k is read from fs[file_ids[k]] at byte offsets[k].
+    """
+    with open(filename, 'wb') as f:
+        _write_header(f, {'kind': 'tiff', 'files': [os.path.abspath(f) for f in fs], 'Ly': int(Ly),
+                          'Lx': int(Lx), 'dtype': dtype, 'nframes': len(offsets)})
+        f.write(np.asarray(file_ids, np.uint32).tobytes())
+        f.write(np.asarray(offsets, np.uint64).tobytes())
+
+
+def write_virtual_h5(filename: str, h5_file: str, dataset: str, nframes: int, Ly: int, Lx: int,
+                     start: int = 0, stride: int = 1, zplane: Optional[int] = None) -> None:
+    """
+    Writes the index of a virtual HDF5 binary: frame k is dataset[start + k * stride] (and [..., zplane]).
+    """
+    with open(filename, 'wb') as f:
+        _write_header(f, {'kind': 'h5', 'files': [os.path.abspath(h5_file)], 'dataset': dataset,
+                          'Ly': int(Ly), 'Lx': int(Lx), 'nframes': int(nframes), 'start': int(start),
+                          'stride': int(stride), 'zplane': None if zplane is None else int(zplane)})
+
+
+def open_virtual(filename: str):
+    """returns a VirtualTiffFile or VirtualH5File for the virtual binary filename."""
+    with open(filename, 'rb') as f:
+        kind = _read_header(f).get('kind', 'tiff')
+    return VirtualH5File(filename) if kind == 'h5' else VirtualTiffFile(filename)
+
+
+class VirtualFile:
+
+    def __init__(self, filename: str):
+        """
+        Read-only file-like access to the int16 frames of a virtual binary.
+
+        Subclasses read the index after the header and implement _frames.
+
+        Parameters
+        ----------
+        filename: str
+            The virtual binary (index) file
+        """
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            header = _read_header(f)
+            self._read_index(f, header)
+        self.files = header['files']
+        self.Ly, self.Lx = header['Ly'], header['Lx']
+        self.nframes = header['nframes']
+        self.nbytesframe = 2 * self.Ly * self.Lx
+        self.nbytes = self.nbytesframe * self.nframes
+        self._pos = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _read_index(self, f, header: dict) -> None:
+        pass
+
+    def _frames(self, k0: int, k1: int) -> np.ndarray:
+        """returns frames k0 to k1 as int16 (nframes x Ly x Lx)."""
+        raise NotImplementedError
+
+    def pread(self, nbytes: int, offset: int) -> bytearray:
+        """reads up to nbytes of int16 frame data at offset without moving the file position."""
+        nbytes = max(0, min(nbytes, self.nbytes - offset))
+        if nbytes == 0:
+            return bytearray()
+        k0, i0 = divmod(offset, self.nbytesframe)
+        k1 = -(-(offset + nbytes) // self.nbytesframe)
+        return bytearray(self._frames(k0, k1).view(np.uint8).ravel()[i0:i0 + nbytes])
+
+    def read(self, nbytes: int = -1) -> bytearray:
+        if nbytes is None or nbytes < 0:
+            nbytes = self.nbytes - self._pos
+        buff = self.pread(nbytes, self._pos)
+        self._pos += len(buff)
+        return buff
+
+    def write(self, buff) -> int:
+        raise IOError("virtual binaries are read-only")
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self.nbytes
+        self._pos = int(offset)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class VirtualTiffFile(VirtualFile):
+    """Frames of a virtual binary stored in uncompressed tiffs (see write_virtual_file), memory-mapped."""
+
+    def _read_index(self, f, header: dict) -> None:
+        nframes = header['nframes']
+        self.file_ids = np.frombuffer(f.read(4 * nframes), np.uint32).astype(np.int64)
+        self.offsets = np.frombuffer(f.read(8 * nframes), np.uint64).astype(np.int64)
+        self.dtype = np.dtype(header['dtype'])
+        self._maps = {}
+
+    def _frame(self, k: int) -> np.ndarray:
+        """returns frame k as int16 (Ly x Lx)."""
+        ifile = self.file_ids[k]
+        if ifile not in self._maps:
+            self._maps[ifile] = np.memmap(self.files[ifile], mode='r', dtype=np.uint8)
+        npix = self.Ly * self.Lx
+        frame = self._maps[ifile][self.offsets[k]: self.offsets[k] + npix * self.dtype.itemsize].view(self.dtype)
+        return to_int16(frame.reshape(self.Ly, self.Lx))
+
+    def _frames(self, k0: int, k1: int) -> np.ndarray:
+        return np.stack([self._frame(k) for k in range(k0, k1)])
+
+    def close(self) -> None:
+        self._maps = {}
+        self.closed = True
+
+
+class VirtualH5File(VirtualFile):
+    """Frames of a virtual binary stored in an HDF5 dataset (see write_virtual_h5), read with h5py."""
+
+    def _read_index(self, f, header: dict) -> None:
+        self.dataset = header['dataset']
+        self.start, self.stride, self.zplane = header['start'], header['stride'], header['zplane']
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _frames(self, k0: int, k1: int) -> np.ndarray:
+        # h5py is not thread-safe across handles, and the prefetch thread may call pread
+        with self._lock:
+            if self._file is None:
+                self._file = h5py.File(self.files[0], 'r')
+            t0 = self.start + k0 * self.stride
+            frames = self._file[self.dataset][t0: t0 + (k1 - k0 - 1) * self.stride + 1: self.stride]
+        if self.zplane is not None:
+            frames = frames[..., self.zplane]
+        return to_int16(frames)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.closed = True
+
+
+def tiff_to_virtual(ops):
+    """  finds tiff files and writes virtual raw binaries that read frames from the tiffs
+
+    same outputs as tiff_to_binary, but ops['raw_file'] (and 'raw_file_chan2') are index
+    files pointing into the tiffs, and 'keep_movie_raw' is set so that registration reads
+    the tiffs and writes only ops['reg_file']; 'meanImg' is computed from a subsample of frames
+
+    Parameters
+    ----------
+    ops : dictionary
+        'nplanes', 'data_path', 'save_path', 'save_folder', 'fast_disk', 'nchannels', 'look_one_level_down'
+
+    Returns
+    -------
+        ops : dictionary of first plane, or None if the tiffs cannot be memory-mapped
+            (compressed, tiled or differing in frame size / data type)
+
+    """
+    t0 = time.time()
+    ops = {**ops, 'keep_movie_raw': True}
+    fs, ops2 = utils.get_tif_list(ops)
+    indexes = index_tiffs(fs)
+    if indexes is None:
+        print('NOTE: tiffs cannot be memory-mapped, converting to binary')
+        return None
+
+    ops1 = utils.init_ops(ops)
+    nplanes = ops1[0]['nplanes']
+    nchannels = ops1[0]['nchannels']
+    first_tiffs = ops2['first_tiffs']
+    nfunc = ops['functional_chan'] - 1 if nchannels > 1 else 0
+
+    # global page list; plane and channel identity restart at the first tiff of each folder
+    file_ids = np.hstack([np.full(len(index['offsets']), ik, np.int64) for ik, index in enumerate(indexes)])
+    offsets = np.hstack([index['offsets'] for index in indexes])
+    folder = np.cumsum(first_tiffs)[file_ids] - 1
+    folder_start = np.searchsorted(folder, folder)
+    ipage = np.arange(len(file_ids)) - folder_start
+    plane = (ipage // nchannels) % nplanes
+    chan = ipage % nchannels
+
+    Ly, Lx, dtype = indexes[0]['Ly'], indexes[0]['Lx'], indexes[0]['dtype']
+    for j, ops in enumerate(ops1):
+        ops['first_tiffs'] = first_tiffs
+        ops['filelist'] = fs
+        ops['keep_movie_raw'] = True
+        ops['Ly'], ops['Lx'] = Ly, Lx
+        files = [('raw_file', nfunc)] + ([('raw_file_chan2', 1 - nfunc)] if nchannels > 1 else [])
+        for key, ichan in files:
+            iframes = np.nonzero((plane == j) & (chan == ichan))[0]
+            write_virtual_file(ops[key], fs, file_ids[iframes], offsets[iframes], Ly, Lx, dtype)
+            if key == 'raw_file':
+                ops['nframes'] = len(iframes)
+                ops['frames_per_file'] = np.bincount(file_ids[iframes], minlength=len(fs))
+                ops['frames_per_folder'] = np.bincount(folder[iframes], minlength=first_tiffs.sum()).astype(np.int32)
+            # mean image from a subsample of frames
+            with VirtualTiffFile(ops[key]) as f:
+                nsamp = min(len(iframes), 1000)
+                inds = np.linspace(0, len(iframes), 1 + nsamp).astype(np.int64)[:-1]
+                meanImg = np.mean([f._frame(k) for k in inds], axis=0).astype(np.float32)
+            ops['meanImg' if key == 'raw_file' else 'meanImg_chan2'] = meanImg
+        ops['yrange'] = np.array([0, Ly])
+        ops['xrange'] = np.array([0, Lx])
+        np.save(ops['ops_path'], ops)
+    print('indexed %d tiff pages for virtual binaries, time %0.2f sec.' % (len(file_ids), time.time() - t0))
+    return ops1[0]
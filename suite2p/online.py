@@ -0,0 +1,245 @@
+"""
+Online registration and trace extraction of one plane, e.g. for closed-loop experiments.
+
+OnlinePipeline registers small batches of frames as they arrive with the precomputed reference
+and masks of registration.register.StreamingRegistration (the reference is computed from the first
+ops['nimg_init'] frames unless refImg is given), extracts the traces of a fixed set of ROIs with
+extraction.extract.matmul_traces and appends the registered frames and traces to save_path.
+
+Frames are either passed to process (registered in the calling thread) or put on a bounded queue
+that a worker thread processes (put, run); the latency of every batch (from put to written) and the
+queue depth are recorded in metrics.
+"""
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Optional
+
+import numpy as np
+from numba.typed import List
+
+from .extraction.extract import matmul_traces, matmul_neuropil
+from .extraction.masks import create_masks
+from .io import save_ops
+from .registration.register import StreamingRegistration
+
+
+class OnlinePipeline:
+
+    def __init__(self, ops: Dict[str, Any], refImg=None, stat=None, save_path: Optional[str] = None,
+                 max_queue: int = 8, callback: Optional[Callable] = None):
+        """
+        Registers (and extracts traces of) frames of one plane as they arrive.
+
+        Parameters
+        ----------
+        ops: dictionary
+            registration and extraction options of the plane (see default_ops); 'Ly' and 'Lx'
+            are set from the first frames
+        refImg: 2D array (optional, default None)
+            reference image; computed from the first ops['nimg_init'] frames if None
+        stat: stat dicts or ROITable (optional, default None)
+            ROIs to extract the fluorescence ('F') and neuropil ('Fneu') of
+        save_path: str (optional, default None)
+            folder to append the registered frames ('data.bin', 'data_chan2.bin') and the traces
+            to, and to write 'F.npy', 'Fneu.npy' and ops to in close; nothing is saved if None
+        max_queue: int (default 8)
+            maximum number of batches waiting in the queue of put
+        callback: function (optional, default None)
+            called as callback(frames, F, Fneu) with every registered batch (F, Fneu are None
+            without stat), in the thread that registered it
+        """
+        self.ops = ops
+        self.stat = stat
+        self.save_path = save_path
+        self.callback = callback
+        self.reg = StreamingRegistration(ops, refImg=refImg)
+        self._masks = None
+        self._files = {}
+        if save_path is not None:
+            os.makedirs(save_path, exist_ok=True)
+            self.ops['save_path'] = save_path
+            self.ops['ops_path'] = os.path.join(save_path, 'ops.npy')
+            self.ops['reg_file'] = os.path.join(save_path, 'data.bin')
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._error = None
+        self.latency = []
+        self.nframes = 0
+        self.dropped = 0
+        self.queue_max = 0
+
+    def process(self, frames: np.ndarray, frames_alt: Optional[np.ndarray] = None, t_arrival: Optional[float] = None):
+        """
+        Registers frames (nimg x Ly x Lx, the channel used for alignment), shifts frames_alt (the other
+        channel, optional) by the same offsets, extracts the traces and appends them to save_path.
+
+        Returns
+        -------
+        frames: int16 array
+            registered frames; empty while frames are buffered for the reference image
+        F, Fneu: float32 arrays (ROIs x frames) or None
+            traces of the ROIs of stat of the registered frames (of the functional channel)
+        """
+        t_arrival = time.time() if t_arrival is None else t_arrival
+        frames, frames_alt = self.reg.register(frames, frames_alt)
+        return self._output(frames, frames_alt, t_arrival)
+
+    def put(self, frames: np.ndarray, frames_alt: Optional[np.ndarray] = None, block: bool = True) -> bool:
+        """
+        Queues frames to be processed by the worker thread (started on the first call).
+
+        If block is False and the queue is full, the frames are dropped (counted in metrics) so
+        that the latency stays bounded by the queue size.
+
+        Returns
+        -------
+        queued: bool
+        """
+        self._raise_error()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._worker, daemon=True)
+            self._thread.start()
+        try:
+            self._queue.put((frames, frames_alt, time.time()), block=block)
+        except queue.Full:
+            self.dropped += len(frames)
+            return False
+        self.queue_max = max(self.queue_max, self._queue.qsize())
+        return True
+
+    def run(self, batches: Iterable, block: bool = True) -> Dict[str, Any]:
+        """
+        Processes batches of frames (e.g. from a directory watcher or a socket) as they are yielded,
+        then closes the pipeline.
+
+        Parameters
+        ----------
+        batches: iterable
+            yields nimg x Ly x Lx arrays, or tuples (frames, frames_alt)
+        block: bool (default True)
+            wait for space in the queue (else drop frames, see put)
+
+        Returns
+        -------
+        ops: dictionary
+            see close
+        """
+        for batch in batches:
+            self.put(*(batch if isinstance(batch, tuple) else (batch,)), block=block)
+        return self.close()
+
+    def close(self) -> Dict[str, Any]:
+        """
+        Waits for the queued frames, registers frames still buffered for the reference image
+        and writes the results.
+
+        Returns
+        -------
+        ops: dictionary
+            with the offsets, mean images, bad frames and valid region (as register_binary) and
+            'online_metrics'; also saved to save_path (with 'F.npy' and 'Fneu.npy' if stat is given)
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._raise_error()
+        frames, frames_alt = self.reg.flush()
+        if len(frames):
+            self._output(frames, frames_alt, time.time())
+        for f in self._files.values():
+            f.close()
+        ops = self.reg.finalize()
+        ops['online_metrics'] = self.metrics()
+        if self.save_path is not None:
+            if self.stat is not None:
+                ncells = len(self._masks[0]) if self._masks is not None else len(self.stat)
+                for key in ['F', 'Fneu']:
+                    filename = os.path.join(self.save_path, key + '_online.bin')
+                    if os.path.isfile(filename):
+                        traces = np.fromfile(filename, np.float32).reshape(-1, ncells)
+                        np.save(os.path.join(self.save_path, key + '.npy'), traces.T)
+                        os.remove(filename)
+            save_ops(ops, save_npy=True)
+        return ops
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        Returns
+        -------
+        metrics: dictionary
+            'nbatches', 'nframes' (registered), 'dropped' (frames), 'queue_max' (batches), latency of
+            the batches in seconds ('latency_mean', 'latency_max', 'latency_p99') and 'latency_last'
+        """
+        latency = np.array(self.latency) if self.latency else np.zeros(1)
+        return {'nbatches': len(self.latency), 'nframes': self.nframes, 'dropped': self.dropped,
+                'queue_max': self.queue_max, 'latency_mean': float(latency.mean()),
+                'latency_max': float(latency.max()), 'latency_p99': float(np.percentile(latency, 99)),
+                'latency_last': float(latency[-1])}
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                continue
+            try:
+                self.process(*item)
+            except Exception as e:
+                self._error = e
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _extract(self, frames):
+        if self._masks is None:
+            cell_masks, neuropil_masks = create_masks(self.ops, self.stat)
+            cell_ipix, cell_lam = List(), List()
+            for ipix, lam in cell_masks:
+                cell_ipix.append(ipix.astype(np.int64))
+                cell_lam.append(lam.astype(np.float32))
+            neuropil_ipix = None
+            if neuropil_masks is not None:
+                neuropil_ipix = List()
+                for ipix in neuropil_masks:
+                    neuropil_ipix.append(ipix.astype(np.int64))
+            self._masks = (cell_ipix, cell_lam, neuropil_ipix,
+                           np.array([len(ipix) for ipix in neuropil_ipix or []], np.float32))
+        cell_ipix, cell_lam, neuropil_ipix, neuropil_npix = self._masks
+        data = frames.reshape(len(frames), -1).astype(np.float32)
+        F = matmul_traces(np.zeros((len(cell_ipix), len(frames)), np.float32), data, cell_ipix, cell_lam)
+        Fneu = matmul_neuropil(np.zeros((len(cell_ipix), len(frames)), np.float32), data, neuropil_ipix,
+                               neuropil_npix) if neuropil_ipix is not None else np.zeros_like(F)
+        return F, Fneu
+
+    def _append(self, name, data):
+        if name not in self._files:
+            self._files[name] = open(os.path.join(self.save_path, name), 'wb')
+        self._files[name].write(bytearray(np.ascontiguousarray(data)))
+        self._files[name].flush()
+
+    def _output(self, frames, frames_alt, t_arrival):
+        if len(frames) == 0:
+            return frames, None, None
+        # traces and data.bin are of the functional channel
+        func, other = frames, frames_alt
+        if frames_alt is not None and self.ops['functional_chan'] != self.ops['align_by_chan']:
+            func, other = frames_alt, frames
+        F, Fneu = self._extract(func) if self.stat is not None else (None, None)
+        if self.save_path is not None:
+            self._append('data.bin', func)
+            if other is not None:
+                self._append('data_chan2.bin', other)
+                self.ops['reg_file_chan2'] = os.path.join(self.save_path, 'data_chan2.bin')
+            if F is not None:
+                self._append('F_online.bin', F.T)
+                self._append('Fneu_online.bin', Fneu.T)
+        if self.callback is not None:
+            self.callback(frames, F, Fneu)
+        self.nframes += len(frames)
+        self.latency.append(time.time() - t_arrival)
+        return frames, F, Fneu
@@ -1,3 +1,4 @@
 from .register import register_binary
 from .metrics import get_pc_metrics
 from .zalign import compute_zpos
+from .tuning import auto_tune
@@ -161,13 +161,12 @@ def pc_register(pclow, pchigh, bidi_corrected, spatial_hp=None, pre_smooth=None,
 
         # rigid registration
         ymax, xmax, cmax = rigid.phasecorr(
-            data=rigid.apply_masks(data=dwrite, maskMul=maskMul, maskOffset=maskOffset),
+            data=rigid.apply_masks(data=dwrite, maskMul=maskMul, maskOffset=maskOffset, real=True),
             cfRefImg=cfRefImg.squeeze(),
             maxregshift=maxregshift,
             smooth_sigma_time=0,
         )
-        for frame, dy, dx in zip(Img, ymax.flatten(), xmax.flatten()):
-            frame[:] = rigid.shift_frame(frame=frame, dy=dy, dx=dx)
+        rigid.roll_frames(Img, ymax.flatten(), xmax.flatten())
         ###
 
         # non-rigid registration
@@ -223,9 +222,9 @@ def get_pc_metrics(ops, use_red=False):
     # n frames to pick from full movie
     nsamp = min(2000 if ops['nframes'] < 5000 or ops['Ly'] > 700 or ops['Lx'] > 700 else 5000, ops['nframes'])
     with io.BinaryFile(Lx=ops['Lx'], Ly=ops['Ly'],
-                       read_filename=ops['reg_file_chan2'] if use_red and 'reg_file_chan2' in ops else ops['reg_file']
-                       ) as f:
-        mov = f[np.linspace(0, ops['nframes'] - 1, nsamp).astype('int')]
+                       read_filename=ops['reg_file_chan2'] if use_red and 'reg_file_chan2' in ops else ops['reg_file'],
+                       use_memmap=ops.get('use_memmap', False)) as f:
+        mov = f.sample_frames(np.linspace(0, ops['nframes'] - 1, nsamp).astype('int'))
         mov = mov[:, ops['yrange'][0]:ops['yrange'][-1], ops['xrange'][0]:ops['xrange'][-1]]
     pclow, pchigh, sv, ops['tPC'] = pclowhigh(mov, nlowhigh=np.minimum(300, int(ops['nframes'] / 2)),
                                               nPC=nPC, random_state=random_state
@@ -367,7 +366,7 @@ def get_flow_metrics(ops):
     # done in batches for memory reasons
     Ly = ops['Ly']
     Lx = ops['Lx']
-    reg_file = open(ops['reg_file'], 'rb')
+    reg_file = io.open_binary(ops['reg_file'], 'rb')
     nbatch = ops['batch_size']
     nbytesread = 2 * Ly * Lx * nbatch
 
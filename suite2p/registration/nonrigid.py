@@ -6,7 +6,8 @@ from numba import float32, njit, prange
 from numpy import fft
 from scipy.fftpack import next_fast_len
 
-from .utils import addmultiply, spatial_taper, gaussian_fft, kernelD2, mat_upsample, convolve, convolve_faster
+from .utils import addmultiply, addmultiply_real, spatial_taper, gaussian_fft, kernelD2, mat_upsample, convolve, convolve_faster, \
+    convolve_rfft
 
 
 def calculate_nblocks(L: int, block_size: int = 128) -> Tuple[int, int]:
@@ -126,16 +127,18 @@ def getSNR(cc: np.ndarray, lcorr: int, lpad: int) -> float:
     """
     cc0 = cc[:, lpad:-lpad, lpad:-lpad].reshape(cc.shape[0], -1)
     # set to 0 all pts +-lpad from ymax,xmax
-    cc1 = cc.copy()
-    for c1, ymax, xmax in zip(cc1, *np.unravel_index(np.argmax(cc0, axis=1), (2 * lcorr + 1, 2 * lcorr + 1))):
-        c1[ymax:ymax + 2 * lpad, xmax:xmax + 2 * lpad] = 0
+    ymax, xmax = np.unravel_index(np.argmax(cc0, axis=1), (2 * lcorr + 1, 2 * lcorr + 1))
+    iy, ix = np.arange(cc.shape[1]), np.arange(cc.shape[2])
+    in_y = (iy >= ymax[:, np.newaxis]) & (iy < ymax[:, np.newaxis] + 2 * lpad)
+    in_x = (ix >= xmax[:, np.newaxis]) & (ix < xmax[:, np.newaxis] + 2 * lpad)
+    cc1 = np.where(in_y[:, :, np.newaxis] & in_x[:, np.newaxis, :], 0, cc)
 
     snr = np.amax(cc0, axis=1) / np.maximum(1e-10, np.amax(cc1.reshape(cc.shape[0], -1), axis=1))  # ensure positivity for outlier cases
     return snr
 
 
 def phasecorr(data: np.ndarray, maskMul, maskOffset, cfRefImg, snr_thresh, NRsm, xblock, yblock, maxregshiftNR, subpixel: int = 10, lpad: int = 3,
-                convolve_method='old'):
+                convolve_method='rfft', workers=-1):
     """
     Compute phase correlations for each block
     
@@ -157,6 +160,10 @@ def phasecorr(data: np.ndarray, maskMul, maskOffset, cfRefImg, snr_thresh, NRsm,
     subpixel: int
     lpad: int
         upsample from a square +/- lpad
+    convolve_method: str
+        'rfft' (real-to-complex FFTs on workers threads), 'old' (mkl_fft) or 'fast_cpu' (torch)
+    workers: int
+        number of threads of the FFTs for convolve_method='rfft' (-1: all cores)
 
     Returns
     -------
@@ -179,7 +186,10 @@ def phasecorr(data: np.ndarray, maskMul, maskOffset, cfRefImg, snr_thresh, NRsm,
     for n in range(nb):
         yind, xind = yblock[n], xblock[n]
         Y[:,n] = data[:, yind[0]:yind[-1], xind[0]:xind[-1]]
-    Y = addmultiply(Y, maskMul, maskOffset)
+    if convolve_method == 'rfft':
+        Y = convolve_rfft(mov=addmultiply_real(Y, maskMul, maskOffset), img=cfRefImg, workers=workers)
+    else:
+        Y = addmultiply(Y, maskMul, maskOffset)
     if convolve_method == 'fast_cpu':
         Y = convolve_faster(mov=Y, img= cfRefImg)
     elif convolve_method == 'old':
@@ -204,39 +214,33 @@ def phasecorr(data: np.ndarray, maskMul, maskOffset, cfRefImg, snr_thresh, NRsm,
 
     cc2 = [cc0, NRsm @ cc0, NRsm @ NRsm @ cc0]
     cc2 = [c2.reshape(nb, nimg, 2 * lcorr + 2 * lpad + 1, 2 * lcorr + 2 * lpad + 1) for c2 in cc2]
+    # blocks x frames with low SNR use the correlations smoothed over neighboring blocks (once or twice)
     ccsm = cc2[0]
-    for n in range(nb):
-        snr = np.ones(nimg, 'float32')
-        for j, c2 in enumerate(cc2):
-            ism = snr < snr_thresh
-            if np.sum(ism) == 0:
-                break
-            cc = c2[n, ism, :, :]
-            if j > 0:
-                ccsm[n, ism, :, :] = cc
-            snr[ism] = getSNR(cc, lcorr, lpad)
-
-    # calculate ymax1, xmax1, cmax1
+    snr = np.ones((nb, nimg), 'float32')
+    for j, c2 in enumerate(cc2):
+        ism = snr < snr_thresh
+        if not ism.any():
+            break
+        cc = c2[ism]
+        if j > 0:
+            ccsm[ism] = cc
+        snr[ism] = getSNR(cc, lcorr, lpad)
+
+    # calculate ymax1, xmax1, cmax1 of all blocks x frames at once
     mdpt = nup // 2
-    ymax1 = np.empty((nimg, nb), np.float32)
-    cmax1 = np.empty((nimg, nb), np.float32)
-    xmax1 = np.empty((nimg, nb), np.float32)
-    ymax = np.empty((nb,), np.int32)
-    xmax = np.empty((nb,), np.int32)
-    for t in range(nimg):
-        ccmat = np.empty((nb, 2*lpad+1, 2*lpad+1), np.float32)
-        for n in range(nb):
-            ix = np.argmax(ccsm[n, t][lpad:-lpad, lpad:-lpad], axis=None)
-            ym, xm = np.unravel_index(ix, (2 * lcorr + 1, 2 * lcorr + 1))
-            ccmat[n] = ccsm[n, t][ym:ym + 2 * lpad + 1, xm:xm + 2 * lpad + 1]
-            ymax[n], xmax[n] = ym - lcorr, xm - lcorr
-        ccb = ccmat.reshape(nb, -1) @ Kmat
-        cmax1[t] = np.amax(ccb, axis=1)
-        ymax1[t], xmax1[t] = np.unravel_index(np.argmax(ccb, axis=1), (nup, nup))
-        ymax1[t] = (ymax1[t] - mdpt) / subpixel + ymax
-        xmax1[t] = (xmax1[t] - mdpt) / subpixel + xmax
-
-    return ymax1, xmax1, cmax1
+    ix = np.argmax(ccsm[:, :, lpad:-lpad, lpad:-lpad].reshape(nb, nimg, -1), axis=2)
+    ym, xm = np.unravel_index(ix, (2 * lcorr + 1, 2 * lcorr + 1))
+    # (2*lpad+1) x (2*lpad+1) patches around the peaks
+    ipatch = np.arange(2 * lpad + 1)
+    ccmat = ccsm[np.arange(nb)[:, np.newaxis, np.newaxis, np.newaxis], np.arange(nimg)[:, np.newaxis, np.newaxis],
+                 ym[:, :, np.newaxis, np.newaxis] + ipatch[:, np.newaxis], xm[:, :, np.newaxis, np.newaxis] + ipatch]
+    ccb = ccmat.astype(np.float32).reshape(nb * nimg, -1) @ Kmat
+    cmax1 = np.amax(ccb, axis=1).reshape(nb, nimg).T.astype(np.float32)
+    yup, xup = np.unravel_index(np.argmax(ccb, axis=1), (nup, nup))
+    ymax1 = ((yup.astype(np.float32) - mdpt) / subpixel).reshape(nb, nimg) + (ym - lcorr)
+    xmax1 = ((xup.astype(np.float32) - mdpt) / subpixel).reshape(nb, nimg) + (xm - lcorr)
+
+    return ymax1.T.astype(np.float32), xmax1.T.astype(np.float32), cmax1
 
 
 @njit(['(int16[:, :],float32[:,:], float32[:,:], float32[:,:])', 
@@ -1,8 +1,13 @@
 import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from itertools import repeat
+from multiprocessing import cpu_count, get_context
 from os import path
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Tuple
 from warnings import warn
 
+import numba
 import numpy as np
 from scipy.signal import medfilt, medfilt2d
 
@@ -136,7 +141,8 @@ def compute_reference(ops, frames):
                 *rigid.compute_masks(
                     refImg=refImg,
                     maskSlope=ops['spatial_taper'] if ops['1Preg'] else 3 * ops['smooth_sigma'],
-                )
+                ),
+                real=True,
             ),
             cfRefImg=rigid.phasecorr_reference(
                 refImg=refImg,
@@ -144,9 +150,9 @@ def compute_reference(ops, frames):
             ),
             maxregshift=ops['maxregshift'],
             smooth_sigma_time=ops['smooth_sigma_time'],
+            workers=ops.get('fft_workers', -1),
         )
-        for frame, dy, dx in zip(frames, ymax, xmax):
-            frame[:] = rigid.shift_frame(frame=frame, dy=dy, dx=dx)
+        rigid.roll_frames(frames, ymax, xmax)
 
         nmax = int(frames.shape[0] * (1. + iter) / (2 * niter))
         isort = np.argsort(-cmax)[1:nmax]
@@ -188,9 +194,21 @@ def compute_reference_masks(refImg, ops=None):
     else:
         maskMulNR, maskOffsetNR, cfRefImgNR = [], [], []
 
+    if ops.get('pyramid_levels', 0) > 0:
+        # masks and references of the coarse and fine levels of rigid registration
+        pyramid = rigid.pyramid_reference(
+            refImg=refImg,
+            maskSlope=ops['spatial_taper'] if ops['1Preg'] else 3 * ops['smooth_sigma'],
+            smooth_sigma=ops['smooth_sigma'],
+            levels=int(ops['pyramid_levels']),
+            maxregshift=ops['maxregshift'],
+            crop_to_texture=ops.get('pyramid_crop', True),
+        )
+        return maskMul, maskOffset, cfRefImg, maskMulNR, maskOffsetNR, cfRefImgNR, pyramid
+
     return maskMul, maskOffset, cfRefImg, maskMulNR, maskOffsetNR, cfRefImgNR
 
-def register_frames(refAndMasks, frames, ops=None, base_shift=None, convolve_method='old', do_rigid=True):
+def register_frames(refAndMasks, frames, ops=None, base_shift=None, convolve_method=None, do_rigid=True):
     """ register frames to reference image 
     
     Parameters
@@ -208,6 +226,9 @@ def register_frames(refAndMasks, frames, ops=None, base_shift=None, convolve_met
     base_shift : tuple (optional, default None)
         a tuple in the form (dy, dx) of a constant shift to be applied to all frames
 
+    convolve_method : str (optional, default ops['convolve_method'])
+        FFT implementation of the phase correlations, see rigid.phasecorr
+
     Returns
     --------
 
@@ -217,19 +238,26 @@ def register_frames(refAndMasks, frames, ops=None, base_shift=None, convolve_met
 
     """
     if len(refAndMasks)==6 or not isinstance(refAndMasks, np.ndarray):
-        maskMul, maskOffset, cfRefImg, maskMulNR, maskOffsetNR, cfRefImgNR = refAndMasks 
+        maskMul, maskOffset, cfRefImg, maskMulNR, maskOffsetNR, cfRefImgNR = refAndMasks[:6]
+        pyramid = refAndMasks[6] if len(refAndMasks) > 6 else None
     else:
         refImg = refAndMasks
         if ops.get('norm_frames', False) and 'rmin' not in ops:
             ops['rmin'], ops['rmax'] = np.int16(np.percentile(refImg,1)), np.int16(np.percentile(refImg,99))
             refImg = np.clip(refImg, ops['rmin'], ops['rmax'])
-        maskMul, maskOffset, cfRefImg, maskMulNR, maskOffsetNR, cfRefImgNR = compute_reference_masks(refImg, ops)
+        refAndMasks = compute_reference_masks(refImg, ops)
+        maskMul, maskOffset, cfRefImg, maskMulNR, maskOffsetNR, cfRefImgNR = refAndMasks[:6]
+        pyramid = refAndMasks[6] if len(refAndMasks) > 6 else None
         
 
     if ops['bidiphase'] and not ops['bidi_corrected']:
         bidiphase.shift(frames, int(ops['bidiphase']))
 
-    fsmooth = frames.copy().astype(np.float32)
+    convolve_method = convolve_method or ops.get('convolve_method', 'rfft')
+    fft_workers = ops.get('fft_workers', -1)
+    # float32 copy of the batch to compute the shifts on (frames itself if already float32 and not
+    # smoothed); frames are shifted in place
+    fsmooth = frames.astype(np.float32, copy=False)
     if ops['smooth_sigma_time'] > 0:
         fsmooth = utils.temporal_smooth(data=fsmooth, sigma=ops['smooth_sigma_time'])
 
@@ -241,33 +269,43 @@ def register_frames(refAndMasks, frames, ops=None, base_shift=None, convolve_met
 
     # rigid registration
     if ops.get('norm_frames', False):
-        fsmooth = np.clip(fsmooth, ops['rmin'], ops['rmax'])
+        fsmooth = np.clip(fsmooth, ops['rmin'], ops['rmax'], out=None if fsmooth is frames else fsmooth)
     
     if do_rigid:
-        ymax, xmax, cmax = rigid.phasecorr(
-            data=rigid.apply_masks(data=fsmooth, maskMul=maskMul, maskOffset=maskOffset),
-            cfRefImg=cfRefImg,
-            maxregshift=ops['maxregshift'],
-            smooth_sigma_time=ops['smooth_sigma_time'], convolve_method=convolve_method,
-        )
+        if pyramid is not None:
+            # coarse-to-fine shifts (see rigid.pyramid_phasecorr)
+            ymax, xmax, cmax = rigid.pyramid_phasecorr(
+                data=fsmooth,
+                pyramid=pyramid,
+                maxregshift=ops['maxregshift'],
+                smooth_sigma_time=ops['smooth_sigma_time'], convolve_method=convolve_method,
+                workers=fft_workers,
+            )
+        else:
+            ymax, xmax, cmax = rigid.phasecorr(
+                data=rigid.apply_masks(data=fsmooth, maskMul=maskMul, maskOffset=maskOffset,
+                                       real=convolve_method == 'rfft'),
+                cfRefImg=cfRefImg,
+                maxregshift=ops['maxregshift'],
+                smooth_sigma_time=ops['smooth_sigma_time'], convolve_method=convolve_method,
+                workers=fft_workers,
+            )
         if base_shift is not None:
             if ops['nonrigid']: print("base_shift with nonrigid on is broken!")
             ymax += base_shift[0]
             xmax += base_shift[1]
 
-        for frame, dy, dx in zip(frames, ymax, xmax):
-            frame[:] = rigid.shift_frame(frame=frame, dy=dy, dx=dx)
+        rigid.roll_frames(frames, ymax, xmax)
     else:
         ymax = None; xmax = None; cmax = None;
 
     # non-rigid registration
     if ops['nonrigid']:
         # need to also shift smoothed data (if smoothing used)
-        if ops['smooth_sigma_time'] or ops['1Preg']:
-            for fsm, dy, dx in zip(fsmooth, ymax, xmax):
-                fsm[:] = rigid.shift_frame(frame=fsm, dy=dy, dx=dx)
+        if fsmooth is not frames and (ops['smooth_sigma_time'] > 0 or ops['1Preg']):
+            rigid.roll_frames(fsmooth, ymax, xmax)
         else:
-            fsmooth = frames.copy()
+            fsmooth = frames
 
         if ops.get('norm_frames', False):
             fsmooth = np.clip(fsmooth, ops['rmin'], ops['rmax'])
@@ -282,7 +320,8 @@ def register_frames(refAndMasks, frames, ops=None, base_shift=None, convolve_met
             xblock=ops['xblock'],
             yblock=ops['yblock'],
             maxregshiftNR=ops['maxregshiftNR'],
-            convolve_method=convolve_method
+            convolve_method=convolve_method,
+            workers=fft_workers,
         )
 
         frames = nonrigid.transform_data(
@@ -302,14 +341,113 @@ def shift_frames(frames, yoff, xoff, yoff1, xoff1, ops=None):
     if ops['bidiphase'] != 0 and not ops['bidi_corrected']:
         bidiphase.shift(frames, int(ops['bidiphase']))
     
-    for frame, dy, dx in zip(frames, yoff, xoff):
-        frame[:] = rigid.shift_frame(frame=frame, dy=dy, dx=dx)
+    rigid.roll_frames(frames, yoff, xoff)
 
     if ops['nonrigid']:
         frames = nonrigid.transform_data(frames, nblocks=ops['nblocks'], xblock=ops['xblock'], yblock=ops['yblock'],
                                         ymax1=yoff1, xmax1=xoff1, bilinear=ops.get('bilinear_reg', True))
     return frames
 
+def register_batch(refAndMasks, frames, frames_alt, ops, k):
+    """ registers batch k of frames, shifts frames_alt (other channel, or None) by the same offsets
+    and saves the registered tiffs if requested
+
+    Returns
+    --------
+    frames, frames_alt : registered frames
+    rigid_offset : [ymax, xmax, cmax]
+    nonrigid_offset : [ymax1, xmax1, cmax1]
+    """
+    frames, ymax, xmax, cmax, ymax1, xmax1, cmax1 = register_frames(refAndMasks, frames, ops)
+    if frames_alt is not None:
+        frames_alt = shift_frames(frames_alt, ymax.astype(int), xmax.astype(int), ymax1, xmax1, ops)
+    align_is_func = ops['functional_chan'] == ops['align_by_chan']
+    for mov, ichan, save in [(frames, True, ops['reg_tif'] if align_is_func else ops['reg_tif_chan2']),
+                             (frames_alt, False, ops['reg_tif_chan2'] if align_is_func else ops['reg_tif'])]:
+        if mov is not None and save:
+            fname = io.generate_tiff_filename(
+                functional_chan=ops['functional_chan'],
+                align_by_chan=ops['align_by_chan'],
+                save_path=ops['save_path'],
+                k=k,
+                ichan=ichan
+            )
+            io.save_tiff(mov=mov, fname=fname)
+    return frames, frames_alt, [ymax, xmax, cmax], [ymax1, xmax1, cmax1]
+
+
+def _register_shard(args):
+    """ registers frames i0:i1 of the binaries in files (read, write) in place of the written binaries """
+    refAndMasks, ops, files, i0, i1, nthreads = args
+    numba.set_num_threads(min(nthreads, numba.config.NUMBA_NUM_THREADS))
+    ops['fft_workers'] = nthreads
+    Ly, Lx, batch_size = ops['Ly'], ops['Lx'], ops['batch_size']
+    mmaps = []
+    for read_filename, write_filename in files:
+        nframes = path.getsize(read_filename) // (2 * Ly * Lx)
+        read_file = np.memmap(read_filename, mode='r+' if read_filename == write_filename else 'r', dtype=np.int16,
+                              shape=(nframes, Ly, Lx))
+        write_file = read_file if read_filename == write_filename else \
+            np.memmap(write_filename, mode='r+', dtype=np.int16, shape=(nframes, Ly, Lx))
+        mmaps.append((read_file, write_file))
+    rigid_offsets, nonrigid_offsets = [], []
+    mean_imgs = [np.zeros((Ly, Lx)) for _ in files]
+    for b0 in range(i0, i1, batch_size):
+        b1 = min(b0 + batch_size, i1)
+        batches = [read_file[b0:b1].astype(np.float32) for read_file, _ in mmaps]
+        frames, frames_alt, rigid_offset, nonrigid_offset = register_batch(
+            refAndMasks, batches[0], batches[1] if len(batches) > 1 else None, ops, b0 // batch_size)
+        rigid_offsets.append(rigid_offset)
+        if ops['nonrigid']:
+            nonrigid_offsets.append(nonrigid_offset)
+        for (_, write_file), mov, mean_img in zip(mmaps, [frames, frames_alt], mean_imgs):
+            write_file[b0:b1] = np.minimum(mov, 2 ** 15 - 2)
+            mean_img += mov.sum(axis=0) / ops['nframes']
+    for _, write_file in mmaps:
+        write_file.flush()
+    return rigid_offsets, nonrigid_offsets, mean_imgs
+
+
+def register_shards(refAndMasks, ops, files, nshards):
+    """ registers contiguous ranges of frames (shards) in separate worker processes
+
+    each shard is a whole number of batches, so offsets are the same as registering all batches in
+    one process; workers write to their own frames of the binaries
+
+    Parameters
+    ----------
+    refAndMasks : reference image and masks (see compute_reference_masks)
+    ops : dictionary
+    files : list of (str, str)
+        (read, write) binary of the alignment channel (and of the other channel, shifted along)
+    nshards : int
+
+    Returns
+    --------
+    rigid_offsets, nonrigid_offsets : lists of offsets of each batch
+    mean_img, mean_img_alt : mean registered images of the channels
+    """
+    nframes = path.getsize(files[0][0]) // (2 * ops['Ly'] * ops['Lx'])
+    nbatches = int(np.ceil(nframes / ops['batch_size']))
+    nshards = min(nshards, nbatches)
+    bounds = np.minimum(np.linspace(0, nbatches, nshards + 1).astype(int) * ops['batch_size'], nframes)
+    for read_filename, write_filename in files:
+        if read_filename != write_filename:
+            with open(write_filename, 'wb') as f:
+                f.truncate(path.getsize(read_filename))
+    nthreads = max(1, (cpu_count() or 1) // nshards)
+    print('registering %d frames in %d shards' % (nframes, nshards))
+    t0 = time.time()
+    jobs = [(refAndMasks, ops, files, i0, i1, nthreads) for i0, i1 in zip(bounds[:-1], bounds[1:])]
+    with ProcessPoolExecutor(max_workers=nshards, mp_context=get_context('spawn')) as executor:
+        results = list(executor.map(_register_shard, jobs))
+    print('Registered %d/%d in %0.2fs' % (nframes, ops['nframes'], time.time() - t0))
+    rigid_offsets = [o for result in results for o in result[0]]
+    nonrigid_offsets = [o for result in results for o in result[1]]
+    mean_imgs = [sum(result[2][i] for result in results) for i in range(len(files))]
+    return rigid_offsets, nonrigid_offsets, mean_imgs[0], mean_imgs[1] if len(files) > 1 else np.zeros_like(mean_imgs[0])
+
+
 def register_binary(ops: Dict[str, Any], refImg=None, raw=True, base_shift = None):
     """ main registration function
 
@@ -342,7 +480,7 @@ def register_binary(ops: Dict[str, Any], refImg=None, raw=True, base_shift = Non
     if ops['frames_include'] != -1:
         ops['nframes'] = min((ops['nframes'], ops['frames_include']))
     else:
-        nbytes = path.getsize(ops['raw_file'] if ops.get('keep_movie_raw') and path.exists(ops['raw_file']) else ops['reg_file'])
+        nbytes = io.file_nbytes(ops['raw_file'] if ops.get('keep_movie_raw') and path.exists(ops['raw_file']) else ops['reg_file'])
         ops['nframes'] = int(nbytes / (2 * ops['Ly'] * ops['Lx'])) # this equation is only true with int16 :)
 
     print('registering %d frames'%ops['nframes'])
@@ -362,64 +500,70 @@ def register_binary(ops: Dict[str, Any], refImg=None, raw=True, base_shift = Non
             ops['bidi_corrected'] = True
 
     ### ----- compute and use bidiphase shift -------------- ###
+    frames = None
     if refImg is None or (ops['do_bidiphase'] and ops['bidiphase'] == 0):
         # grab frames
-        with io.BinaryFile(Lx=ops['Lx'], Ly=ops['Ly'], read_filename=raw_file_align if raw else reg_file_align) as f:
-            frames = f[np.linspace(0, ops['nframes'], 1 + np.minimum(ops['nimg_init'], ops['nframes']), dtype=int)[:-1]]    
-        # compute bidiphase shift
-        if ops['do_bidiphase'] and ops['bidiphase'] == 0:
-            ops['bidiphase'] = bidiphase.compute(frames)
-            print('NOTE: estimated bidiphase offset from data: %d pixels' % ops['bidiphase'])
-        # shift frames
-        if refImg is None and ops['bidiphase'] != 0:
-            bidiphase.shift(frames, int(ops['bidiphase'])) 
-
-    if refImg is not None:
-        print('NOTE: user reference frame given')
-    else:
-        t0 = time.time()
-        refImg = compute_reference(ops, frames)
-        print('Reference frame, %0.2f sec.'%(time.time()-t0))
-
-    ops['refImg'] = refImg
-
-    # normalize reference image
-    refImg = ops['refImg'].copy()
-    if ops.get('norm_frames', False):
-        ops['rmin'], ops['rmax'] = np.int16(np.percentile(refImg,1)), np.int16(np.percentile(refImg,99))
-        refImg = np.clip(refImg, ops['rmin'], ops['rmax'])
+        with io.BinaryFile(Lx=ops['Lx'], Ly=ops['Ly'], read_filename=raw_file_align if raw else reg_file_align,
+                           use_memmap=ops.get('use_memmap', False)) as f:
+            frames = f.sample_frames(np.linspace(0, ops['nframes'], 1 + np.minimum(ops['nimg_init'], ops['nframes']), dtype=int)[:-1])
 
-    refAndMasks = compute_reference_masks(refImg, ops)
+    refAndMasks = prepare_reference(ops, frames, refImg=refImg)
     
     ### ------------- register binary to reference image ------------ ###
 
+    # with two channels, the other channel is shifted in the same pass (unless register_chan2_together is False)
+    if ops['nchannels'] > 1:
+        reg_file_alt = ops['reg_file_chan2'] if ops['functional_chan'] == ops['align_by_chan'] else ops['reg_file']
+        raw_file_alt = ops.get('raw_file_chan2') if ops['functional_chan'] == ops['align_by_chan'] else ops.get('raw_file')
+        raw_file_alt = raw_file_alt if raw else []
+    together = ops['nchannels'] > 1 and ops.get('register_chan2_together', True)
+    files = [(raw_file_align if raw_file_align else reg_file_align, reg_file_align)]
+    if together:
+        files.append((raw_file_alt if raw_file_alt else reg_file_alt, reg_file_alt))
+        # batches of both channels are registered in lockstep, which would silently stop at the shorter binary
+        n_frames = [io.file_nbytes(fr) // (2 * ops['Ly'] * ops['Lx']) for fr, _ in files]
+        if n_frames[0] != n_frames[1] or n_frames[0] < ops['nframes']:
+            raise ValueError('%s has %d frames and %s has %d frames, both channels need the same number of frames '
+                             '(at least %d)' % (files[0][0], n_frames[0], files[1][0], n_frames[1], ops['nframes']))
+
     mean_img = np.zeros((ops['Ly'], ops['Lx']))
+    mean_img_alt = np.zeros((ops['Ly'], ops['Lx']))
     rigid_offsets, nonrigid_offsets = [], []
-    with io.BinaryFile(Ly=ops['Ly'], Lx=ops['Lx'],
-                       read_filename=raw_file_align if raw_file_align else reg_file_align,
-                       write_filename=reg_file_align) as f:
-        t0 = time.time()
-        for k, (_, frames) in enumerate(f.iter_frames(batch_size=ops['batch_size'])):
-            frames, ymax, xmax, cmax, ymax1, xmax1, cmax1 = register_frames(refAndMasks, frames, ops)
-            
-            rigid_offsets.append([ymax, xmax, cmax])
-            if ops['nonrigid']:
-                nonrigid_offsets.append([ymax1, xmax1, cmax1])
-
-            mean_img += frames.sum(axis=0) / ops['nframes']
-
-            f.write(frames)
-            if (ops['reg_tif'] if ops['functional_chan'] == ops['align_by_chan'] else ops['reg_tif_chan2']):
-                fname = io.generate_tiff_filename(
-                    functional_chan=ops['functional_chan'],
-                    align_by_chan=ops['align_by_chan'],
-                    save_path=ops['save_path'],
-                    k=k,
-                    ichan=True
-                )
-                io.save_tiff(mov=frames, fname=fname)
-            if (k+1)%4==0:
-                print('Registered %d/%d in %0.2fs'%(min((k+1)*ops['batch_size'], ops['nframes']), ops['nframes'], time.time()-t0))
+    nshards = ops.get('registration_shards', 1)
+    if nshards > 1 and (ops.get('compression') or any(io.chunked.is_chunked(fr) or io.virtual.is_virtual(fr) for fr, _ in files)):
+        print('NOTE: compressed or virtual binaries are registered in one process, registration_shards ignored')
+        nshards = 1
+    if nshards > 1:
+        rigid_offsets, nonrigid_offsets, mean_img, mean_img_alt = register_shards(refAndMasks, ops, files, nshards)
+    else:
+        with ExitStack() as stack:
+            f = stack.enter_context(io.BinaryFile(Ly=ops['Ly'], Lx=ops['Lx'],
+                           read_filename=raw_file_align if raw_file_align else reg_file_align,
+                           write_filename=reg_file_align, use_memmap=ops.get('use_memmap', False),
+                           write_behind=ops.get('write_behind', False), compression=ops.get('compression')))
+            batches_alt = repeat((None, None))
+            if together:
+                f_alt = stack.enter_context(io.BinaryFile(Ly=ops['Ly'], Lx=ops['Lx'],
+                               read_filename=raw_file_alt if raw_file_alt else reg_file_alt,
+                               write_filename=reg_file_alt, use_memmap=ops.get('use_memmap', False),
+                               write_behind=ops.get('write_behind', False), compression=ops.get('compression')))
+                batches_alt = f_alt.iter_frames(batch_size=ops['batch_size'], prefetch=ops.get('prefetch_batches', 0))
+            t0 = time.time()
+            for k, ((_, frames), (_, frames_alt)) in enumerate(zip(f.iter_frames(batch_size=ops['batch_size'],
+                                                                                 prefetch=ops.get('prefetch_batches', 0)),
+                                                                   batches_alt)):
+                frames, frames_alt, rigid_offset, nonrigid_offset = register_batch(refAndMasks, frames, frames_alt, ops, k)
+                rigid_offsets.append(rigid_offset)
+                if ops['nonrigid']:
+                    nonrigid_offsets.append(nonrigid_offset)
+
+                mean_img += frames.sum(axis=0) / ops['nframes']
+                f.write(frames)
+                if frames_alt is not None:
+                    mean_img_alt += frames_alt.sum(axis=0) / ops['nframes']
+                    f_alt.write(frames_alt)
+                if (k+1)%4==0:
+                    print('Registered %d/%d in %0.2fs'%(min((k+1)*ops['batch_size'], ops['nframes']), ops['nframes'], time.time()-t0))
 
     ops['yoff'], ops['xoff'], ops['corrXY'] = utils.combine_offsets_across_batches(rigid_offsets, rigid=True)
     if ops['nonrigid']:
@@ -427,18 +571,18 @@ def register_binary(ops: Dict[str, Any], refImg=None, raw=True, base_shift = Non
     mean_img_key = 'meanImg' if ops['nchannels'] == 1 or ops['functional_chan'] == ops['align_by_chan'] else 'meanImg_chan2'
     ops[mean_img_key] = mean_img
 
-    if ops['nchannels'] > 1:
-        reg_file_alt = ops['reg_file_chan2'] if ops['functional_chan'] == ops['align_by_chan'] else ops['reg_file']
-        raw_file_alt = ops.get('raw_file_chan2') if ops['functional_chan'] == ops['align_by_chan'] else ops.get('raw_file')
-        raw_file_alt = raw_file_alt if raw else []
-
+    if together:
+        ops['meanImg' if ops['functional_chan'] != ops['align_by_chan'] else 'meanImg_chan2'] = mean_img_alt
+    elif ops['nchannels'] > 1:
         t0 = time.time()
         mean_img_sum = np.zeros((ops['Ly'], ops['Lx']))
         with io.BinaryFile(Ly=ops['Ly'], Lx=ops['Lx'],
                            read_filename=raw_file_alt if raw_file_alt else reg_file_alt,
-                           write_filename=reg_file_alt) as f:
+                           write_filename=reg_file_alt, use_memmap=ops.get('use_memmap', False),
+                           write_behind=ops.get('write_behind', False), compression=ops.get('compression')) as f:
 
-            for k, (iframes, frames) in enumerate(f.iter_frames(batch_size=ops['batch_size'])):
+            for k, (iframes, frames) in enumerate(f.iter_frames(batch_size=ops['batch_size'],
+                                                                prefetch=ops.get('prefetch_batches', 0))):
                 # apply shifts
                 
                 yoff, xoff = ops['yoff'][iframes].astype(int), ops['xoff'][iframes].astype(int)
@@ -466,6 +610,73 @@ def register_binary(ops: Dict[str, Any], refImg=None, raw=True, base_shift = Non
         meanImg_key = 'meanImg' if ops['functional_chan'] != ops['align_by_chan'] else 'meanImg_chan2'
         ops[meanImg_key] = mean_img_sum / (k + 1)
 
+    return compute_valid_region(ops)
+
+
+def prepare_reference(ops, frames, refImg=None):
+    """ computes bidiphase offset and reference image, and returns reference image and masks for registration
+
+    Parameters
+    ----------
+    ops : dictionary
+        registration options; 'bidiphase', 'refImg' (and 'rmin', 'rmax' if 'norm_frames') are set
+    
+    frames : 3D array, int16
+        size [nimg_init x Ly x Lx], frames to use to create reference (modified in place),
+        can be None if refImg is given and bidiphase does not need to be estimated
+
+    refImg : 2D array (optional, default None)
+        user-supplied reference image
+
+    Returns
+    -------
+    refAndMasks : list
+        maskMul, maskOffset, cfRefImg, maskMulNR, maskOffsetNR, cfRefImgNR
+
+    """
+    # compute bidiphase shift
+    if ops['do_bidiphase'] and ops['bidiphase'] == 0:
+        ops['bidiphase'] = bidiphase.compute(frames)
+        print('NOTE: estimated bidiphase offset from data: %d pixels' % ops['bidiphase'])
+
+    if refImg is not None:
+        print('NOTE: user reference frame given')
+    else:
+        # shift frames
+        if ops['bidiphase'] != 0:
+            bidiphase.shift(frames, int(ops['bidiphase']))
+        t0 = time.time()
+        refImg = compute_reference(ops, frames)
+        print('Reference frame, %0.2f sec.'%(time.time()-t0))
+
+    ops['refImg'] = refImg
+
+    # normalize reference image
+    refImg = ops['refImg'].copy()
+    if ops.get('norm_frames', False):
+        ops['rmin'], ops['rmax'] = np.int16(np.percentile(refImg,1)), np.int16(np.percentile(refImg,99))
+        refImg = np.clip(refImg, ops['rmin'], ops['rmax'])
+
+    return compute_reference_masks(refImg, ops)
+
+
+def compute_valid_region(ops):
+    """ finds bad frames and the valid (non-cropped) region from the registration offsets
+
+    also loads user-specified bad_frames.npy from ops['data_path'][0] and adds
+    the enhanced mean image
+
+    Parameters
+    ----------
+    ops : dictionary
+        'nframes', 'yoff', 'xoff', 'corrXY', 'th_badframes', 'maxregshift', 'Ly', 'Lx', 'meanImg'
+
+    Returns
+    -------
+    ops : dictionary
+        'badframes', 'yrange', 'xrange', 'meanImgE'
+
+    """
     # compute valid region
     # ignore user-specified bad_frames.npy
     ops['badframes'] = np.zeros((ops['nframes'],), 'bool')
@@ -544,4 +755,109 @@ def enhanced_mean_image(ops):
         ops['xrange'][0]:ops['xrange'][1]] = mimg0
     ops['meanImgE'] = mimg
     print('added enhanced mean image')
-    return ops
\ No newline at end of file
+    return ops
+
+class StreamingRegistration:
+
+    def __init__(self, ops: Dict[str, Any], refImg=None):
+        """
+        Registers frames of one plane batch by batch as they arrive, e.g. while they are
+        converted to binary, instead of reading the binary back in register_binary.
+
+        The first ops['nimg_init'] frames are buffered to compute the reference image
+        (unless refImg is given); after that every batch is registered as it is passed in.
+
+        Parameters
+        ----------
+        ops: dictionary
+            registration options of the plane; updated in place with 'refImg', 'bidiphase'
+            and the offsets in finalize
+        refImg: 2D array (optional, default None)
+            reference image to register to
+        """
+        self.ops = ops
+        self.refImg = refImg
+        self.refAndMasks = None
+        self._buffer, self._buffer_alt = [], []
+        self.rigid_offsets, self.nonrigid_offsets = [], []
+        self.mean_img, self.mean_img_alt = 0., 0.
+        self.nframes = 0
+
+    def register(self, frames: np.ndarray, frames_alt: Optional[np.ndarray] = None) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """
+        Registers frames (the channel used for alignment) and shifts frames_alt (the other
+        channel, optional) by the same offsets.
+
+        Returns
+        -------
+        frames, frames_alt: int16 arrays
+            registered frames; empty while frames are buffered for the reference image
+        """
+        if self.refAndMasks is None:
+            self._buffer.append(frames)
+            if frames_alt is not None:
+                self._buffer_alt.append(frames_alt)
+            if self.refImg is None and sum(len(f) for f in self._buffer) < self.ops['nimg_init']:
+                return self._empty(frames), None if frames_alt is None else self._empty(frames_alt)
+            frames, frames_alt = self._pop_buffer()
+            self._init_reference(frames)
+        return self._register(frames, frames_alt)
+
+    def flush(self) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """registers frames still buffered for the reference image (recordings shorter than nimg_init)."""
+        if self.refAndMasks is not None or len(self._buffer) == 0:
+            return np.zeros((0, 0, 0), np.int16), None
+        frames, frames_alt = self._pop_buffer()
+        self._init_reference(frames)
+        return self._register(frames, frames_alt)
+
+    def finalize(self) -> Dict[str, Any]:
+        """
+        Adds offsets, mean images, bad frames and valid region to ops, as register_binary does.
+
+        Returns
+        -------
+        ops : dictionary
+            'yoff', 'xoff', 'corrXY', 'yoff1', 'xoff1', 'corrXY1', 'meanImg', 'badframes', 'yrange', 'xrange'
+        """
+        ops = self.ops
+        ops['yoff'], ops['xoff'], ops['corrXY'] = utils.combine_offsets_across_batches(self.rigid_offsets, rigid=True)
+        if ops['nonrigid']:
+            ops['yoff1'], ops['xoff1'], ops['corrXY1'] = utils.combine_offsets_across_batches(self.nonrigid_offsets, rigid=False)
+        align_is_func = ops['nchannels'] == 1 or ops['functional_chan'] == ops['align_by_chan']
+        ops['meanImg' if align_is_func else 'meanImg_chan2'] = self.mean_img / self.nframes
+        if ops['nchannels'] > 1:
+            ops['meanImg_chan2' if align_is_func else 'meanImg'] = self.mean_img_alt / self.nframes
+        ops['nframes'] = self.nframes
+        return compute_valid_region(ops)
+
+    @staticmethod
+    def _empty(frames):
+        return np.zeros((0,) + frames.shape[1:], np.int16)
+
+    def _pop_buffer(self):
+        frames = np.concatenate(self._buffer, axis=0)
+        frames_alt = np.concatenate(self._buffer_alt, axis=0) if self._buffer_alt else None
+        self._buffer, self._buffer_alt = [], []
+        return frames, frames_alt
+
+    def _init_reference(self, frames):
+        self.ops['Ly'], self.ops['Lx'] = frames.shape[1:]
+        frames = frames[:self.ops['nimg_init']].copy() if self.refImg is None or self.ops['do_bidiphase'] else None
+        self.refAndMasks = prepare_reference(self.ops, frames, refImg=self.refImg)
+
+    def _register(self, frames, frames_alt):
+        ops = self.ops
+        frames, ymax, xmax, cmax, ymax1, xmax1, cmax1 = register_frames(self.refAndMasks, frames.astype(np.float32), ops)
+        self.rigid_offsets.append([ymax, xmax, cmax])
+        if ops['nonrigid']:
+            self.nonrigid_offsets.append([ymax1, xmax1, cmax1])
+        self.mean_img = self.mean_img + frames.sum(axis=0)
+        self.nframes += frames.shape[0]
+        frames = np.minimum(frames, 2 ** 15 - 2).astype(np.int16)
+        if frames_alt is not None:
+            frames_alt = shift_frames(frames_alt.astype(np.float32), ymax.astype(int), xmax.astype(int),
+                                      ymax1, xmax1, ops)
+            self.mean_img_alt = self.mean_img_alt + frames_alt.sum(axis=0)
+            frames_alt = np.minimum(frames_alt, 2 ** 15 - 2).astype(np.int16)
+        return frames, frames_alt
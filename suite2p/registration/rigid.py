@@ -1,8 +1,10 @@
 from typing import Tuple
 
 import numpy as np
+from numba import njit, prange, get_num_threads
 
-from .utils import convolve, convolve_faster, complex_fft2, spatial_taper, addmultiply, gaussian_fft, temporal_smooth
+from .utils import convolve, convolve_faster, convolve_rfft, complex_fft2, spatial_taper, addmultiply, addmultiply_real, \
+    gaussian_fft, temporal_smooth
 
 import torch
 
@@ -28,7 +30,7 @@ def compute_masks(refImg, maskSlope) -> Tuple[np.ndarray, np.ndarray]:
     return maskMul.astype('float32'), maskOffset.astype('float32')
 
 
-def apply_masks(data: np.ndarray, maskMul: np.ndarray, maskOffset: np.ndarray) -> np.ndarray:
+def apply_masks(data: np.ndarray, maskMul: np.ndarray, maskOffset: np.ndarray, real: bool = False) -> np.ndarray:
     """
     Returns a 3D image 'data', multiplied by 'maskMul' and then added 'maskOffet'.
 
@@ -37,12 +39,14 @@ def apply_masks(data: np.ndarray, maskMul: np.ndarray, maskOffset: np.ndarray) -
     data: nImg x Ly x Lx
     maskMul
     maskOffset
+    real: bool (default False)
+        return float32 (for convolve_method='rfft') instead of complex64
 
     Returns
     --------
     maskedData: nImg x Ly x Lx
     """
-    return addmultiply(data, maskMul, maskOffset)
+    return addmultiply_real(data, maskMul, maskOffset) if real else addmultiply(data, maskMul, maskOffset)
 
 
 def phasecorr_reference(refImg: np.ndarray, smooth_sigma=None) -> np.ndarray:
@@ -64,7 +68,7 @@ def phasecorr_reference(refImg: np.ndarray, smooth_sigma=None) -> np.ndarray:
     cfRefImg *= gaussian_fft(smooth_sigma, cfRefImg.shape[0], cfRefImg.shape[1])
     return cfRefImg.astype('complex64')
 
-def phasecorr(data, cfRefImg, maxregshift, smooth_sigma_time, convolve_method='old') -> Tuple[int, int, float]:
+def phasecorr(data, cfRefImg, maxregshift, smooth_sigma_time, convolve_method='rfft', workers=-1) -> Tuple[int, int, float]:
     """ compute phase correlation between data and reference image
 
     Parameters
@@ -75,6 +79,10 @@ def phasecorr(data, cfRefImg, maxregshift, smooth_sigma_time, convolve_method='o
         maximum shift as a fraction of the minimum dimension of data (min(Ly,Lx) * maxregshift)
     smooth_sigma_time : float
         how many frames to smooth in time
+    convolve_method : str
+        'rfft' (real-to-complex FFTs on workers threads), 'old' (mkl_fft) or 'fast_cpu' (torch)
+    workers : int
+        number of threads of the FFTs for convolve_method='rfft' (-1: all cores)
 
     Returns
     -------
@@ -89,7 +97,9 @@ def phasecorr(data, cfRefImg, maxregshift, smooth_sigma_time, convolve_method='o
     min_dim = np.minimum(*data.shape[1:])  # maximum registration shift allowed
     lcorr = int(np.minimum(np.round(maxregshift * min_dim), min_dim // 2))
     
-    if convolve_method == 'fast_cpu': 
+    if convolve_method == 'rfft':
+        data = convolve_rfft(data, cfRefImg, workers=workers)
+    elif convolve_method == 'fast_cpu': 
         data = convolve_faster(data, cfRefImg)
     elif convolve_method == 'old':  
         data = convolve(data, cfRefImg)
@@ -109,9 +119,8 @@ def phasecorr(data, cfRefImg, maxregshift, smooth_sigma_time, convolve_method='o
     
     cc = temporal_smooth(cc, smooth_sigma_time) if smooth_sigma_time > 0 else cc
 
-    ymax, xmax = np.zeros(data.shape[0], np.int32), np.zeros(data.shape[0], np.int32)
-    for t in np.arange(data.shape[0]):
-        ymax[t], xmax[t] = np.unravel_index(np.argmax(cc[t], axis=None), (2 * lcorr + 1, 2 * lcorr + 1))
+    ymax, xmax = np.unravel_index(np.argmax(cc.reshape(cc.shape[0], -1), axis=1), (2 * lcorr + 1, 2 * lcorr + 1))
+    ymax, xmax = ymax.astype(np.int32), xmax.astype(np.int32)
     cmax = cc[np.arange(len(cc)), ymax, xmax]
     ymax, xmax = ymax - lcorr, xmax - lcorr
 
@@ -137,3 +146,197 @@ def shift_frame(frame: np.ndarray, dy: int, dx: int) -> np.ndarray:
 
     """
     return np.roll(frame, (-dy, -dx), axis=(0, 1))
+
+
+@njit(cache=True)
+def _roll_row(src, dst, dx: int) -> None:
+    """ writes row src, rolled by dx, into a different row dst """
+    Lx = src.shape[0]
+    dst[dx:] = src[:Lx - dx]
+    dst[:dx] = src[Lx - dx:]
+
+
+def roll_frames(frames, ymax, xmax) -> None:
+    """
+    Shifts each frame of 'frames' in place by -ymax[t] and -xmax[t] (as shift_frame), frames in parallel
+
+    Rows are moved along the cycles of the vertical shift and rolled horizontally on the way,
+    so each thread only needs one row of scratch memory
+
+    Parameters
+    ----------
+    frames: nimg x Ly x Lx
+    ymax: int array of size nimg
+        vertical shift of each frame
+    xmax: int array of size nimg
+        horizontal shift of each frame
+    """
+    _roll_frames(frames, ymax, xmax, min(len(frames), get_num_threads()))
+
+
+@njit(parallel=True, cache=True)
+def _roll_frames(frames, ymax, xmax, nblocks: int) -> None:
+    """ roll_frames with the frames split into nblocks blocks, one per thread """
+    nimg, Ly, Lx = frames.shape
+    scratch = np.empty((nblocks, Lx), frames.dtype)
+    for b in prange(nblocks):
+        row = scratch[b]
+        for t in range(b, nimg, nblocks):
+            dy, dx = (-int(ymax[t])) % Ly, (-int(xmax[t])) % Lx
+            if dy == 0 and dx == 0:
+                continue
+            frame = frames[t]
+            # row i moves to row (i + dy) % Ly: fill each cycle backwards from its first row
+            moved = 0
+            i0 = 0
+            while moved < Ly:
+                row[:] = frame[i0]
+                i = i0
+                src = (i - dy) % Ly
+                while src != i0:
+                    _roll_row(frame[src], frame[i], dx)
+                    i = src
+                    src = (i - dy) % Ly
+                    moved += 1
+                _roll_row(row, frame[i], dx)
+                moved += 1
+                i0 += 1
+
+
+def downsample(data: np.ndarray, factor: int) -> np.ndarray:
+    """
+    Returns data (nimg x Ly x Lx or Ly x Lx) averaged in blocks of factor x factor pixels (edges cropped)
+
+    Parameters
+    ----------
+    data: nimg x Ly x Lx or Ly x Lx
+    factor: int
+
+    Returns
+    -------
+    data_down: nimg x Ly // factor x Lx // factor (or Ly // factor x Lx // factor), float32
+    """
+    Ly, Lx = data.shape[-2:]
+    Lyc, Lxc = Ly // factor, Lx // factor
+    data = data[..., :Lyc * factor, :Lxc * factor].astype(np.float32, copy=False)
+    return data.reshape(data.shape[:-2] + (Lyc, factor, Lxc, factor)).mean(axis=(-3, -1), dtype=np.float32)
+
+
+def texture_window(refImg: np.ndarray, cy: int, cx: int, margin: int) -> Tuple[int, int]:
+    """
+    Returns the top-left corner of the cy x cx window of refImg with the most gradient energy,
+    at least margin pixels (if possible) from the edges
+
+    Parameters
+    ----------
+    refImg: Ly x Lx
+    cy, cx: int
+        window size
+    margin: int
+
+    Returns
+    -------
+    y0, x0: int
+    """
+    Ly, Lx = refImg.shape
+    img = refImg.astype(np.float64)
+    energy = np.zeros((Ly, Lx))
+    energy[1:] += np.diff(img, axis=0) ** 2
+    energy[:, 1:] += np.diff(img, axis=1) ** 2
+    S = np.pad(energy.cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)))
+    box = S[cy:, cx:] - S[:-cy, cx:] - S[cy:, :-cx] + S[:-cy, :-cx]
+    my, mx = min(margin, (Ly - cy) // 2), min(margin, (Lx - cx) // 2)
+    box = box[my:Ly - cy - my + 1, mx:Lx - cx - mx + 1]
+    y0, x0 = np.unravel_index(np.argmax(box), box.shape)
+    return int(y0 + my), int(x0 + mx)
+
+
+def pyramid_reference(refImg: np.ndarray, maskSlope, smooth_sigma, levels: int, maxregshift: float,
+                      crop_to_texture: bool = True):
+    """
+    Returns the masks and fft'ed references of a coarse-to-fine rigid registration (see pyramid_phasecorr)
+
+    The coarse level is refImg downsampled by factor = 2 ** levels; the fine level is a window of refImg
+    at full resolution of about 1 / factor of its size (at least 64 pixels), on its most textured part if
+    crop_to_texture, else in the center.
+
+    Parameters
+    ----------
+    refImg: Ly x Lx
+    maskSlope: float
+        slope of the taper masks at full resolution (see compute_masks)
+    smooth_sigma: float
+        smoothing of the references at full resolution (see phasecorr_reference)
+    levels: int
+        number of times the frames are downsampled by 2 at the coarse level
+    maxregshift: float
+        maximum shift as a fraction of the minimum dimension of refImg
+    crop_to_texture: bool (default True)
+
+    Returns
+    -------
+    pyramid: tuple
+        factor, maskMul, maskOffset, cfRefImg (coarse level), window (y0, x0, cy, cx) and maskMul, maskOffset,
+        cfRefImg of the window
+    """
+    factor = 2 ** levels
+    Ly, Lx = refImg.shape
+    refCoarse = downsample(refImg, factor)
+    maskMul, maskOffset = compute_masks(refCoarse, maskSlope / factor)
+    cfRefImg = phasecorr_reference(refCoarse, smooth_sigma / factor)
+
+    cy, cx = min(Ly, max(Ly // factor, 64)), min(Lx, max(Lx // factor, 64))
+    margin = int(np.round(maxregshift * min(Ly, Lx))) + factor
+    y0, x0 = texture_window(refImg, cy, cx, margin) if crop_to_texture else ((Ly - cy) // 2, (Lx - cx) // 2)
+    refCrop = refImg[y0:y0 + cy, x0:x0 + cx]
+    maskMulCrop, maskOffsetCrop = compute_masks(refCrop, min(maskSlope, min(cy, cx) / 8))
+    cfRefCrop = phasecorr_reference(refCrop, smooth_sigma)
+    return factor, maskMul, maskOffset, cfRefImg, (y0, x0, cy, cx), maskMulCrop, maskOffsetCrop, cfRefCrop
+
+
+def pyramid_phasecorr(data, pyramid, maxregshift, smooth_sigma_time, convolve_method='rfft',
+                      workers=-1) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ coarse-to-fine phase correlation between data and the reference of pyramid
+
+    shifts are estimated on data downsampled by pyramid's factor and then refined within +/- factor
+    pixels on a full-resolution window of the frames shifted by the coarse estimate
+
+    Parameters
+    ----------
+    data : frames x Ly x Lx
+        frames (not masked)
+    pyramid : tuple
+        see pyramid_reference
+    maxregshift : float
+        maximum shift as a fraction of the minimum dimension of data
+    smooth_sigma_time : float
+        how many frames to smooth in time
+    convolve_method, workers :
+        see phasecorr
+
+    Returns
+    -------
+    ymax, xmax : int
+        shifts in y and x from the reference to data for each frame
+    cmax : float
+        maximum of the phase correlation of the window for each frame
+    """
+    factor, maskMul, maskOffset, cfRefImg, (y0, x0, cy, cx), maskMulCrop, maskOffsetCrop, cfRefCrop = pyramid
+    Ly, Lx = data.shape[1:]
+    real = convolve_method == 'rfft'
+    ymax, xmax, _ = phasecorr(
+        data=apply_masks(downsample(data, factor), maskMul, maskOffset, real=real),
+        cfRefImg=cfRefImg, maxregshift=maxregshift, smooth_sigma_time=smooth_sigma_time,
+        convolve_method=convolve_method, workers=workers,
+    )
+    ymax, xmax = ymax * factor, xmax * factor
+
+    rows = (y0 + ymax[:, np.newaxis] + np.arange(cy)) % Ly
+    cols = (x0 + xmax[:, np.newaxis] + np.arange(cx)) % Lx
+    crops = data[np.arange(len(data))[:, np.newaxis, np.newaxis], rows[:, :, np.newaxis], cols[:, np.newaxis, :]]
+    ymax1, xmax1, cmax = phasecorr(
+        data=apply_masks(crops.astype(np.float32, copy=False), maskMulCrop, maskOffsetCrop, real=real),
+        cfRefImg=cfRefCrop, maxregshift=factor / min(cy, cx), smooth_sigma_time=smooth_sigma_time,
+        convolve_method=convolve_method, workers=workers,
+    )
+    return ymax + ymax1, xmax + xmax1, cmax
@@ -0,0 +1,194 @@
+"""
+Calibration of the registration settings for the frame size and the machine.
+
+auto_tune times register_frames (and the trace extraction kernel) on a synthetic batch of the
+plane's frame size, picks the fastest 'convolve_method', 'fft_workers' and 'batch_size' and
+caches them per machine, frame size and number of blocks in a json file ('tuning_cache', by
+default TUNING_CACHE), so later runs on the same node reuse them without benchmarking.
+"""
+import datetime
+import json
+import os
+import platform
+import tempfile
+import time
+from multiprocessing import cpu_count
+
+import numpy as np
+from numba.typed import List
+
+from . import nonrigid
+from .register import compute_reference_masks, register_frames
+from ..extraction.extract import matmul_traces
+
+TUNING_CACHE = os.path.join(os.path.expanduser('~'), '.suite2p', 'tuning.json')
+CONVOLVE_METHODS = ['rfft', 'old', 'fast_cpu']
+BATCH_SIZES = [100, 200, 500, 1000]
+# largest synthetic batch (float32) benchmarked, larger batch sizes are not tried
+MAX_BENCHMARK_BYTES = 2 ** 27
+# ROIs of the synthetic extraction benchmark
+NROIS = 200
+
+
+def tuning_key(ops) -> str:
+    """key of the settings of this machine (and cores available to ops) and of the frame size and registration mode of ops."""
+    nblocks = nonrigid.make_blocks(Ly=ops['Ly'], Lx=ops['Lx'], block_size=ops['block_size'])[2] \
+        if ops['nonrigid'] else [0, 0]
+    ncores = ops['fft_workers'] if ops.get('fft_workers', -1) > 0 else cpu_count()
+    return '%s|%d/%d cores|%dx%d|nblocks %dx%d|1Preg %d|pyramid %d' % (
+        platform.node(), ncores, cpu_count(), ops['Ly'], ops['Lx'], nblocks[0], nblocks[1], int(ops['1Preg']),
+        int(ops.get('pyramid_levels', 0)))
+
+
+def _synthetic_movie(Ly: int, Lx: int, nframes: int, seed: int = 0) -> np.ndarray:
+    """randomly shifted frames of a field of gaussian blobs."""
+    rs = np.random.RandomState(seed)
+    ncells = max(10, Ly * Lx // 400)
+    img = np.zeros((Ly + 20, Lx + 20), np.float32)
+    y, x = (rs.rand(ncells, 2) * [Ly + 20, Lx + 20]).astype(int).T
+    np.add.at(img, (y, x), 1000)
+    img = np.fft.irfft2(np.fft.rfft2(img) * np.exp(-2 * (np.fft.fftfreq(Ly + 20)[:, None] ** 2 +
+                                                          np.fft.rfftfreq(Lx + 20) ** 2) * np.pi ** 2 * 4),
+                        s=img.shape).astype(np.float32)
+    shifts = rs.randint(-10, 11, size=(nframes, 2))
+    mov = np.stack([img[10 + dy:10 + dy + Ly, 10 + dx:10 + dx + Lx] for dy, dx in shifts])
+    return (mov + 50 * rs.rand(nframes, Ly, Lx)).astype(np.int16)
+
+
+def _time(fun, repeats: int = 1) -> float:
+    """fastest of repeats calls of fun, after one call to compile / plan."""
+    fun()
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fun()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def benchmark(ops, nframes: int = 50):
+    """
+    Times registration and trace extraction on a synthetic batch of the frame size of ops.
+
+    Parameters
+    ----------
+    ops : dictionary
+        'Ly', 'Lx', 'nonrigid', 'block_size', '1Preg' and the registration options
+    nframes : int (default 50)
+        frames of the batch the convolve methods and thread counts are compared on
+
+    Returns
+    -------
+    settings : dictionary
+        fastest 'convolve_method', 'fft_workers' and 'batch_size', and 'ms_per_frame' (registration and
+        extraction with these settings)
+    """
+    ops = {**ops, 'norm_frames': False, 'bidiphase': 0, 'bidi_corrected': True}
+    for key in ['yblock', 'xblock', 'nblocks', 'NRsm']:
+        ops.pop(key, None)
+    Ly, Lx = ops['Ly'], ops['Lx']
+    batch_sizes = [b for b in BATCH_SIZES if b * Ly * Lx * 4 <= MAX_BENCHMARK_BYTES] or [BATCH_SIZES[0]]
+    mov = _synthetic_movie(Ly, Lx, max(batch_sizes + [nframes]))
+    refAndMasks = compute_reference_masks(mov[:50].mean(axis=0), ops)
+
+    def register(nimg, **settings):
+        return _time(lambda: register_frames(refAndMasks, mov[:nimg].astype(np.float32), {**ops, **settings},
+                                             convolve_method=settings.get('convolve_method'))) / nimg
+
+    # convolve method (with all cores)
+    times = {}
+    for method in CONVOLVE_METHODS:
+        try:
+            times[method] = register(nframes, convolve_method=method, fft_workers=-1)
+        except Exception as e:
+            print('NOTE: convolve_method %s not benchmarked (%s)' % (method, e))
+    convolve_method = min(times, key=times.get)
+
+    # threads of the FFTs
+    fft_workers = ops.get('fft_workers', -1)
+    if convolve_method == 'rfft':
+        ncores = fft_workers if fft_workers > 0 else cpu_count()
+        workers = sorted(set([2 ** k for k in range(int(np.log2(ncores)) + 1)] + [ncores]))
+        times = {w: register(nframes, convolve_method=convolve_method, fft_workers=w) for w in workers}
+        fft_workers = min(times, key=times.get)
+
+    # batch size, registration and extraction
+    rs = np.random.RandomState(0)
+    cell_ipix, cell_lam = List(), List()
+    for _ in range(NROIS):
+        cell_ipix.append(rs.randint(0, Ly * Lx, 80).astype(np.int64))
+        cell_lam.append(np.full(80, 1 / 80, np.float32))
+
+    def extract(nimg):
+        data = mov[:nimg].reshape(nimg, -1).astype(np.float32)
+        return _time(lambda: matmul_traces(np.zeros((NROIS, nimg), np.float32), data, cell_ipix, cell_lam)) / nimg
+
+    times = {b: register(b, convolve_method=convolve_method, fft_workers=fft_workers) + extract(b) for b in batch_sizes}
+    batch_size = min(times, key=times.get)
+    return {'convolve_method': convolve_method, 'fft_workers': int(fft_workers), 'batch_size': int(batch_size),
+            'ms_per_frame': 1000 * times[batch_size]}
+
+
+def _read_cache(cache_file: str) -> dict:
+    if not os.path.isfile(cache_file):
+        return {}
+    try:
+        with open(cache_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        print('NOTE: tuning cache %s could not be read, recalibrating' % cache_file)
+        return {}
+
+
+def _write_cache(cache_file: str, key: str, settings: dict) -> None:
+    """adds settings to the cache, merged with the entries other processes wrote since it was read."""
+    folder = os.path.dirname(os.path.abspath(cache_file))
+    tmp_file = None
+    try:
+        os.makedirs(folder, exist_ok=True)
+        # a temporary file per process, so that processes tuning at the same time do not write into the same file
+        with tempfile.NamedTemporaryFile('w', dir=folder, prefix=os.path.basename(cache_file) + '.',
+                                         suffix='.tmp', delete=False) as f:
+            tmp_file = f.name
+            cache = _read_cache(cache_file)
+            cache[key] = settings
+            json.dump(cache, f, indent=1)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        print('NOTE: tuning cache %s could not be written' % cache_file)
+        if tmp_file and os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def auto_tune(ops):
+    """
+    Sets 'convolve_method', 'fft_workers' and 'batch_size' of ops to the fastest settings for its frame size
+    on this machine, from the cache 'tuning_cache' (default TUNING_CACHE) or else from benchmark (then cached).
+
+    Parameters
+    ----------
+    ops : dictionary
+        'Ly', 'Lx' and the registration options
+
+    Returns
+    -------
+    ops : dictionary
+        with the settings and 'tuning' (the cached entry)
+    """
+    cache_file = ops.get('tuning_cache') or TUNING_CACHE
+    key = tuning_key(ops)
+    cache = _read_cache(cache_file)
+    if key in cache:
+        settings = cache[key]
+        print('NOTE: using tuned registration settings of %s' % settings['date'])
+    else:
+        t0 = time.time()
+        settings = benchmark(ops)
+        settings['date'] = datetime.datetime.now().isoformat(timespec='seconds')
+        print('Tuned registration settings (%0.2f ms/frame), %0.2f sec.' % (settings['ms_per_frame'], time.time() - t0))
+        _write_cache(cache_file, key, settings)
+    print('convolve_method %s, fft_workers %d, batch_size %d' % (settings['convolve_method'], settings['fft_workers'],
+                                                                  settings['batch_size']))
+    ops.update({k: settings[k] for k in ['convolve_method', 'fft_workers', 'batch_size']})
+    ops['tuning'] = settings
+    return ops
@@ -5,7 +5,7 @@ from typing import Tuple
 import numpy as np
 from numba import vectorize, complex64
 from numpy.fft import ifftshift#, fft2, ifft2
-from scipy.fft import next_fast_len#, fft2, ifft2
+from scipy.fft import next_fast_len, rfft2, irfft2#, fft2, ifft2
 from scipy.ndimage import gaussian_filter1d
 from torch import from_numpy
 from torch.fft import fft2 as torch_fft2
@@ -30,6 +30,11 @@ def addmultiply(x, mul, add):
     return np.complex64(np.float32(x) * mul + add)
 
 
+@vectorize(['float32(int16, float32, float32)', 'float32(float32, float32, float32)'], nopython=True, target='parallel', cache=True)
+def addmultiply_real(x, mul, add):
+    return np.float32(x) * mul + add
+
+
 def combine_offsets_across_batches(offset_list, rigid):
     yoff, xoff, corr_xy = [], [], []
     for batch in offset_list:
@@ -232,6 +237,35 @@ def convolve_faster(mov: np.ndarray, img: np.ndarray) -> np.ndarray:
     normed_torch_cpu = torch_ifft2(normed_f_torch).cpu().numpy()
     return normed_torch_cpu
 
+def convolve_rfft(mov: np.ndarray, img: np.ndarray, workers: int = -1) -> np.ndarray:
+    """
+    Returns the real 3D (or 4D) array 'mov' convolved by 'img' (as convolve), with real-to-complex FFTs.
+
+    Only the non-negative frequencies along the last axis are transformed and normalized, 'img' (the
+    full spectrum of a real image, e.g. cfRefImg or cfRefImgNR, as returned by phasecorr_reference)
+    is used as a view of its first Lx // 2 + 1 columns. scipy.fft keeps the plans of the last
+    transform sizes, so batches of the same shape reuse them.
+
+    Parameters
+    ----------
+    mov: nImg x Ly x Lx (or nImg x nblocks x Ly x Lx), real
+        The frames to process
+    img: Ly x Lx (or nblocks x Ly x Lx), complex
+        The convolution kernel in the Fourier domain
+    workers: int
+        number of threads of each transform (-1: all cores)
+
+    Returns
+    -------
+    convolved_data: float32, same shape as mov
+    """
+    if np.iscomplexobj(mov):
+        mov = mov.real
+    Ly, Lx = mov.shape[-2:]
+    Y = rfft2(mov.astype(np.float32, copy=False), workers=workers)
+    apply_dotnorm(Y, img[..., :Lx // 2 + 1], out=Y)
+    return irfft2(Y, s=(Ly, Lx), workers=workers, overwrite_x=True)
+
 # def convolve_full_gpu(mov: np.ndarray, img: np.ndarray) -> np.ndarray:
 #     mov_torch = torch.from_numpy(mov).to('cuda').type(torch.complex64)
 #     ref_torch = torch.from_numpy(img).to('cuda')
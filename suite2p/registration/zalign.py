@@ -5,6 +5,7 @@ import numpy as np
 from scipy.signal import medfilt
 
 from . import nonrigid, rigid, utils
+from .. import io
 
 # This function doesn't work. Has a bunch of name errors. 
 def register_stack(Z, ops):
@@ -141,10 +142,10 @@ def compute_zpos(Zreg, ops):
     if Zreg.shape[1] > Ly or Zreg.shape[2] != Lx:
         Zreg = Zreg[:, ]
 
-    nbytes = os.path.getsize(ops['reg_file'])
+    nbytes = io.file_nbytes(ops['reg_file'])
     nFrames = int(nbytes/(2 * Ly * Lx))
 
-    reg_file = open(ops['reg_file'], 'rb')
+    reg_file = io.open_binary(ops['reg_file'], 'rb')
     refAndMasks = []
     for Z in Zreg:
         if ops['1Preg']:
@@ -191,7 +192,7 @@ def compute_zpos(Zreg, ops):
             cfRefImg = cfRefImg.squeeze()
 
             _, _, zcorr[z, inds] = rigid.phasecorr(
-                data=rigid.apply_masks(data=data, maskMul=maskMul, maskOffset=maskOffset),
+                data=rigid.apply_masks(data=data, maskMul=maskMul, maskOffset=maskOffset, real=True),
                 cfRefImg=cfRefImg,
                 maxregshift=ops['maxregshift'],
                 smooth_sigma_time=ops['smooth_sigma_time'],
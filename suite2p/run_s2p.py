@@ -1,6 +1,10 @@
+import contextlib
+import io as _io
+import multiprocessing
 import os
 import shutil
 import time
+import traceback
 from natsort import natsorted
 from datetime import datetime
 from getpass import getpass
@@ -44,6 +48,14 @@ def default_ops():
         'save_folder': [],
         'subfolders': [],
         'move_bin': False,  # if 1, and fast_disk is different than save_disk, binary file is moved to save_disk
+        'use_memmap': False,  # access binary files through np.memmap (int16 views, no per-batch copies)
+        'prefetch_batches': 0,  # number of batches read ahead on a background thread during registration and extraction
+        'write_behind': False,  # write registered batches on a background thread
+        'io_workers': 1,  # number of threads decoding input files during conversion to binary
+        'compression': '',  # write binary files as chunked compressed containers ('zstd', 'blosc' or 'zlib'), '' for raw int16
+        'resume_ingest': True,  # append to the binaries of an interrupted conversion (and files added later) using the ingest manifest
+        'virtual_tiff': False,  # index uncompressed tiffs instead of copying them to data_raw.bin (registration reads the tiffs directly)
+        'virtual_nwb': False,  # read the TwoPhotonSeries of a local nwb file during registration instead of copying it to data_raw.bin
 
         # main settings
         'nplanes' : 1,  # each tiff has these many planes in sequence
@@ -53,13 +65,17 @@ def default_ops():
         'fs': 10.,  # sampling rate (PER PLANE e.g. for 12 plane recordings it will be around 2.5)
         'force_sktiff': False, # whether or not to use scikit-image for tiff reading
         'frames_include': -1,
-        'multiplane_parallel': False, # whether or not to run on server
+        'multiplane_parallel': False, # whether or not to run planes in parallel (on the server if server settings are given, else in local worker processes)
+        'multiplane_workers': 0,  # number of planes run at once locally (0: as many as fit in available RAM and cores)
+        'threads_per_plane': 0,  # numba/BLAS/FFT threads of each local plane worker (0: cores / multiplane_workers)
         'ignore_flyback': [],
 
         # output settings
         'preclassify': 0.,  # apply classifier before signal extraction with probability 0.3
         'save_mat': False,  # whether to save output as matlab files
         'save_NWB': False,  # whether to save output as NWB file
+        'save_ops_npy': True,  # whether to also save ops as a pickled ops.npy at the end of each plane (ops.json plus array sidecars are always saved, see io.opsfile)
+        'save_results_h5': False,  # whether to also save the results of each plane in one lazily-loadable HDF5 store (see io.results)
         'combined': True,  # combine multiple planes into a single result /single canvas for GUI
         'aspect': 1.0,  # um/pixels in X / um/pixels in Y (for correct aspect ratio in GUI)
 
@@ -71,10 +87,15 @@ def default_ops():
         # registration settings
         'do_registration': 1,  # whether to register data (2 forces re-registration)
         'two_step_registration': False,
+        'fused_registration': False,  # register tiff frames while converting them, writing only the registered binary
+        'register_chan2_together': True,  # with two channels, shift the non-alignment channel in the same pass over the binaries (False: in a second pass)
+        'registration_shards': 1,  # number of worker processes registering contiguous ranges of frames of a plane (1: one process)
         'keep_movie_raw': False,
         'nimg_init': 300,  # subsampled frames for finding reference image
         'batch_size': 500,  # number of frames per batch
         'maxregshift': 0.1,  # max allowed registration shift, as a fraction of frame max(width and height)
+        'pyramid_levels': 0,  # rigid shifts estimated on frames downsampled 2**pyramid_levels times, then refined in a full-resolution window (0: full-resolution phase correlation)
+        'pyramid_crop': True,  # place the full-resolution window of pyramid_levels on the most textured part of the reference (False: centered)
         'align_by_chan' : 1,  # when multi-channel, you can align by non-functional channel (1-based)
         'reg_tif': False,  # whether to save registered tiffs
         'reg_tif_chan2': False,  # whether to save channel 2 registered tiffs
@@ -85,6 +106,10 @@ def default_ops():
         'norm_frames': True, # normalize frames when detecting shifts
         'force_refImg': False, # if True, use refImg stored in ops if available
         'pad_fft': False,
+        'convolve_method': 'rfft',  # FFTs of the phase correlations: 'rfft' (real-to-complex, scipy.fft), 'old' (mkl_fft) or 'fast_cpu' (torch)
+        'fft_workers': -1,  # number of threads of each registration FFT with convolve_method 'rfft' (-1: all cores)
+        'auto_tune': False,  # benchmark convolve_method, fft_workers and batch_size for the frame size before registration (cached per machine)
+        'tuning_cache': '',  # json file of the tuned settings ('': ~/.suite2p/tuning.json)
         
         # non rigid registration settings
         'nonrigid': True,  # whether to use nonrigid registration
@@ -199,28 +224,32 @@ def run_plane(ops, ops_path=None, stat=None):
         t11=time.time()
         print('----------- REGISTRATION')
         refImg = ops['refImg'] if 'refImg' in ops and ops.get('force_refImg', False) else None
+        if ops.get('auto_tune', False):
+            ops = registration.auto_tune(ops)
         ops = registration.register_binary(ops, refImg=refImg) # register binary
-        np.save(ops['ops_path'], ops)
+        io.save_ops(ops)
         plane_times['registration'] = time.time()-t11
         print('----------- Total %0.2f sec' % plane_times['registration'])
 
         if ops['two_step_registration'] and ops['keep_movie_raw']:
             print('----------- REGISTRATION STEP 2')
             print('(making mean image (excluding bad frames)')
-            with io.BinaryFile(Lx=ops['Lx'], Ly=ops['Ly'], read_filename=ops['reg_file']) as f:
+            with io.BinaryFile(Lx=ops['Lx'], Ly=ops['Ly'], read_filename=ops['reg_file'],
+                               use_memmap=ops.get('use_memmap', False)) as f:
                 refImg = f.sampled_mean()
             ops = registration.register_binary(ops, refImg, raw=False)
-            np.save(ops['ops_path'], ops)
+            io.save_ops(ops)
             plane_times['two_step_registration'] = time.time()-t11
             print('----------- Total %0.2f sec' % plane_times['two_step_registration'])
 
-        # compute metrics for registration
+    # compute metrics for registration (also if frames were registered during conversion)
+    if run_registration or ops.pop('registered_on_convert', False):
         if ops.get('do_regmetrics', True) and ops['nframes']>=1500:
             t0 = time.time()
             ops = registration.get_pc_metrics(ops)
             plane_times['registration_metrics'] = time.time()-t0
             print('Registration metrics, %0.2f sec.' % plane_times['registration_metrics'])
-            np.save(os.path.join(ops['save_path'], 'ops.npy'), ops)
+            io.save_ops(ops)
     
     if ops.get('roidetect', True):
 
@@ -251,9 +280,9 @@ def run_plane(ops, ops_path=None, stat=None):
         print('----------- EXTRACTION')
         ops, stat, F, Fneu, F_chan2, Fneu_chan2 = extraction.create_masks_and_extract(ops, stat)
         # save results
-        np.save(ops['ops_path'], ops)
+        io.save_ops(ops)
         fpath = ops['save_path']
-        np.save(os.path.join(fpath, 'stat.npy'), stat)
+        stat_table = io.save_stat(fpath, stat)
         np.save(os.path.join(fpath,'F.npy'), F)
         np.save(os.path.join(fpath,'Fneu.npy'), Fneu)
         # if second channel, save F_chan2 and Fneu_chan2
@@ -267,7 +296,7 @@ def run_plane(ops, ops_path=None, stat=None):
         t11=time.time()
         print('----------- CLASSIFICATION')
         if len(stat):
-            iscell = classification.classify(stat=stat, classfile=classfile)
+            iscell = classification.classify(stat=stat_table, classfile=classfile)
         else:
             iscell = np.zeros((0, 2))
         np.save(Path(ops['save_path']).joinpath('iscell.npy'), iscell)
@@ -296,9 +325,17 @@ def run_plane(ops, ops_path=None, stat=None):
             spks = np.zeros_like(F)
         np.save(os.path.join(ops['save_path'], 'spks.npy'), spks)
 
+        # save traces, ROIs and ops in one chunked store
+        if ops.get('save_results_h5'):
+            redcell_file = os.path.join(ops['save_path'], 'redcell.npy')
+            has_chan2 = 'meanImg_chan2' in ops
+            io.save_results(ops['save_path'], ops=ops, stat=stat_table, F=F, Fneu=Fneu, spks=spks,
+                            F_chan2=F_chan2 if has_chan2 else None, Fneu_chan2=Fneu_chan2 if has_chan2 else None,
+                            iscell=iscell, redcell=np.load(redcell_file) if os.path.isfile(redcell_file) else None)
+
         # save as matlab file
         if ops.get('save_mat'):
-            stat = np.load(os.path.join(ops['save_path'], 'stat.npy'), allow_pickle=True)
+            stat = io.load_stat(ops['save_path'])
             iscell = np.load(os.path.join(ops['save_path'], 'iscell.npy'))
             redcell = np.load(os.path.join(ops['save_path'], 'redcell.npy')) if ops['nchannels']==2 else []
             io.save_mat(ops, stat, F, Fneu, spks, iscell, redcell)
@@ -327,10 +364,136 @@ def run_plane(ops, ops_path=None, stat=None):
     ops['timing'] = plane_times.copy()
     plane_runtime = time.time()-t1
     ops['timing']['total_plane_runtime'] = plane_runtime
-    np.save(ops['ops_path'], ops)
+    io.save_ops(ops, save_npy=ops.get('save_ops_npy', True))
     return ops
 
 
+def plane_ops(ops, ops_path):
+    """ loads the ops of a plane and overwrites them with the settings in ops (except paths) """
+    op = io.load_ops(ops_path)
+    # make sure yrange and xrange are not overwritten
+    for key in default_ops().keys():
+        if key not in ['data_path', 'save_path0', 'fast_disk', 'save_folder', 'subfolders']:
+            if key in ops:
+                op[key] = ops[key]
+    return op
+
+
+def available_memory():
+    """ available RAM in bytes (None if unknown) """
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except (ImportError, AttributeError):
+        try:
+            return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (AttributeError, ValueError, OSError):
+            return None
+
+
+def plane_workers(ops, nplanes):
+    """ number of planes to run at once locally and number of threads of each
+
+    ops['multiplane_workers'] if set, else limited by the cores (at least 2 per plane) and by the
+    available RAM, estimated per plane from the registration batches and the binned movie of detection
+
+    Parameters
+    ----------
+    ops : :obj:`dict`
+        'Ly', 'Lx', 'batch_size', 'nbinned', 'multiplane_workers', 'threads_per_plane'
+    nplanes : int
+
+    Returns
+    -------
+    nworkers : int
+    nthreads : int
+    """
+    ncores = os.cpu_count() or 1
+    nworkers = ops.get('multiplane_workers', 0)
+    if nworkers <= 0:
+        nworkers = max(1, ncores // 2)
+        memory = available_memory()
+        if memory is not None:
+            plane_bytes = 4 * ops['Ly'] * ops['Lx'] * (8 * ops['batch_size'] + ops.get('nbinned', 5000))
+            nworkers = min(nworkers, max(1, int(0.8 * memory // plane_bytes)))
+    nworkers = max(1, min(nworkers, nplanes))
+    nthreads = ops.get('threads_per_plane', 0) or max(1, ncores // nworkers)
+    return nworkers, nthreads
+
+
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMBA_NUM_THREADS']
+
+
+def _init_plane_worker(nthreads):
+    try:
+        import torch
+        torch.set_num_threads(nthreads)
+    except ImportError:
+        pass
+
+
+def _run_plane_job(args):
+    """ runs one plane in a worker process, returns its printed output (and traceback if it failed) """
+    ipl, ops, ops_path, nthreads = args
+    log = _io.StringIO()
+    op, error = None, None
+    with contextlib.redirect_stdout(log):
+        try:
+            op = plane_ops(ops, ops_path)
+            if op.get('fft_workers', -1) == -1:
+                op['fft_workers'] = nthreads
+            print('>>>>>>>>>>>>>>>>>>>>> PLANE %d <<<<<<<<<<<<<<<<<<<<<<'%ipl)
+            op = run_plane(op, ops_path=ops_path)
+            print('Plane %d processed in %0.2f sec (can open in GUI).' % 
+                    (ipl, op['timing']['total_plane_runtime']))  
+        except Exception:
+            error = traceback.format_exc()
+    return ipl, log.getvalue(), error
+
+
+def run_planes_parallel(ops, planes):
+    """ runs run_plane for several planes at once in local worker processes
+
+    the number of workers and their threads are set by plane_workers; the output of each plane is
+    printed once it is done, in plane order
+
+    Parameters
+    ----------
+    ops : :obj:`dict`
+        settings that overwrite the ops of each plane (see plane_ops)
+    planes : list of (int, str)
+        plane index and ops path of each plane
+
+    Returns
+    -------
+    ops : :obj:`dict`
+        ops of the last plane
+    """
+    nworkers, nthreads = plane_workers({**ops, **io.load_ops(planes[0][1])}, len(planes))
+    print('running %d planes in %d local workers with %d threads each' % (len(planes), nworkers, nthreads))
+    # thread limits of numpy/numba in the workers are read from the environment when they start
+    env = {key: os.environ.get(key) for key in THREAD_ENV_VARS}
+    os.environ.update({key: str(nthreads) for key in THREAD_ENV_VARS})
+    try:
+        pool = multiprocessing.get_context('spawn').Pool(nworkers, initializer=_init_plane_worker, initargs=(nthreads,))
+    finally:
+        for key, val in env.items():
+            if val is None:
+                os.environ.pop(key)
+            else:
+                os.environ[key] = val
+    failed = []
+    with pool:
+        for ipl, log, error in pool.imap(_run_plane_job, [(ipl, ops, ops_path, nthreads) for ipl, ops_path in planes]):
+            print(log, end='')
+            if error is not None:
+                print(error)
+                failed.append(ipl)
+    if failed:
+        raise RuntimeError('planes %s failed, see errors above' % failed)
+    return io.load_ops(planes[-1][1])
+
+
 def run_s2p(ops={}, db={}, server={}):
     """ run suite2p pipeline
 
@@ -379,22 +542,30 @@ def run_s2p(ops={}, db={}, server={}):
         files_found_flag = ops_found_flag and binaries_found_flag
     else:
         files_found_flag = False
-    
+
+    if len(ops['h5py']):
+        ops['input_format'] = 'h5'
+    elif len(ops['nwb_file']):
+        ops['input_format'] = 'nwb'
+    elif ops.get('mesoscan'):
+        ops['input_format'] = 'mesoscan'
+    elif HAS_HAUS:
+        ops['input_format'] = 'haus'
+    elif not 'input_format' in ops:
+        ops['input_format'] = 'tif'
+
+    # files added to the data folders after conversion are appended to the binaries,
+    # unless the binaries were registered in place (or cannot be extended otherwise)
+    if files_found_flag and ops['resume_ingest'] and ops['input_format'] in ['tif', 'h5', 'sbx']:
+        fs, _ = io.utils.list_input_files(ops.copy())
+        if io.manifest.has_new_files(save_folder, fs) and io.manifest.can_append(io.utils.init_ops(ops.copy()), fs):
+            print('NOTE: found %d input files, more than converted, appending them to the binaries' % len(fs))
+            files_found_flag = False
+
     if files_found_flag:
         print(f'FOUND BINARIES AND OPS IN {ops_paths}')
     # if not set up files and copy tiffs/h5py to binary
     else:
-        if len(ops['h5py']):
-            ops['input_format'] = 'h5'
-        elif len(ops['nwb_file']):
-            ops['input_format'] = 'nwb'
-        elif ops.get('mesoscan'):
-            ops['input_format'] = 'mesoscan'
-        elif HAS_HAUS:
-            ops['input_format'] = 'haus'
-        elif not 'input_format' in ops:
-            ops['input_format'] = 'tif'
-
 
         # copy file format to a binary file
         convert_funs = {
@@ -405,11 +576,18 @@ def run_s2p(ops={}, db={}, server={}):
             'haus': lambda ops: haussio.load_haussio(ops['data_path'][0]).tosuite2p(ops.copy()),
             'bruker': io.ome_to_binary,
         }
-        if ops['input_format'] in convert_funs:
+        # virtual binaries read the input files during registration (None if not possible)
+        ops0 = None
+        if ops['do_registration'] and not ops.get('fused_registration'):
+            if ops['input_format'] == 'tif' and ops.get('virtual_tiff'):
+                ops0 = io.tiff_to_virtual(ops.copy())
+            elif ops['input_format'] == 'nwb' and ops.get('virtual_nwb'):
+                ops0 = io.nwb_to_virtual(ops.copy())
+        if ops0 is None and ops['input_format'] in convert_funs:
             ops0 = convert_funs[ops['input_format']](ops.copy())
             if isinstance(ops, list):
                 ops0 = ops0[0]
-        else:
+        elif ops0 is None:
             ops0 = io.tiff_to_binary(ops.copy())
         plane_folders = natsorted([ f.path for f in os.scandir(save_folder) if f.is_dir() and f.name[:5]=='plane'])
         ops_paths = [os.path.join(f, 'ops.npy') for f in plane_folders]
@@ -417,37 +595,34 @@ def run_s2p(ops={}, db={}, server={}):
                   time.time() - t0, ops0['nframes'], len(plane_folders)
             ))
 
-    if ops.get('multiplane_parallel'):
-        if server:
-            if 'fnc' in server.keys():
-                # Call custom function.
-                server['fnc'](save_folder, server)
-            else:
-                # if user puts in server settings
-                io.server.send_jobs(save_folder, host=server['host'], username=server['username'],
-                                    password=server['password'], server_root=server['server_root'],
-                                    local_root=server['local_root'], n_cores=server['n_cores'])
+    if ops.get('multiplane_parallel') and server:
+        if 'fnc' in server.keys():
+            # Call custom function.
+            server['fnc'](save_folder, server)
         else:
-            # otherwise use settings modified in io/server.py
-            io.server.send_jobs(save_folder)
+            # if user puts in server settings
+            io.server.send_jobs(save_folder, host=server['host'], username=server['username'],
+                                password=server['password'], server_root=server['server_root'],
+                                local_root=server['local_root'], n_cores=server['n_cores'])
         return None
     else:
+        planes = []
         for ipl, ops_path in enumerate(ops_paths):
             if ipl in ops['ignore_flyback']:
                 print('>>>> skipping flyback PLANE', ipl)
                 continue
-            op = np.load(ops_path, allow_pickle=True).item()
-            
-            # make sure yrange and xrange are not overwritten
-            for key in default_ops().keys():
-                if key not in ['data_path', 'save_path0', 'fast_disk', 'save_folder', 'subfolders']:
-                    if key in ops:
-                        op[key] = ops[key]
-            
-            print('>>>>>>>>>>>>>>>>>>>>> PLANE %d <<<<<<<<<<<<<<<<<<<<<<'%ipl)
-            op = run_plane(op, ops_path=ops_path)
-            print('Plane %d processed in %0.2f sec (can open in GUI).' % 
-                    (ipl, op['timing']['total_plane_runtime']))  
+            planes.append((ipl, ops_path))
+
+        if ops.get('multiplane_parallel') and len(planes) > 1:
+            # without server settings, planes run in local worker processes
+            op = run_planes_parallel(ops, planes)
+        else:
+            for ipl, ops_path in planes:
+                op = plane_ops(ops, ops_path)
+                print('>>>>>>>>>>>>>>>>>>>>> PLANE %d <<<<<<<<<<<<<<<<<<<<<<'%ipl)
+                op = run_plane(op, ops_path=ops_path)
+                print('Plane %d processed in %0.2f sec (can open in GUI).' % 
+                        (ipl, op['timing']['total_plane_runtime']))  
         run_time = time.time()-t0
         print('total = %0.2f sec.' % run_time)
 
@@ -7,6 +7,7 @@ from . import init_pass
 from . import utils as u3d 
 import psutil
 from suite2p.io import lbm as lbmio
+from suite2p.io import tiffmeta
 from multiprocessing import Pool
 from suite2p.suite3d.iter_step import fuse_and_save_reg_file
 
@@ -235,8 +236,7 @@ class Job:
             if tifsize in size_to_frames.keys():
                 nframes.append(size_to_frames[tifsize])
             else:
-                tf = tifffile.TiffFile(tif)
-                nf = len(tf.pages) // 30
+                nf = tiffmeta.tiff_metadata([tif])[0]['npages'] // 30
                 nframes.append(nf)
                 size_to_frames[tifsize] = nf
                 self.log(tif +  ' is %d frames and %d bytes' % (nf, tifsize))
@@ -1,3 +1,5 @@
+from pathlib import Path
+
 import suite2p
 
 
@@ -32,3 +34,23 @@ def test_do_registration_do_roi_detect_settings_check_timing(test_ops):
     det_dec_ops = suite2p.run_s2p(ops=test_ops)  # detection & deconvolution
     assert list(det_dec_ops['timing'].keys()) == ['detection', 'extraction', 'classification',
                                                      'deconvolution', 'total_plane_runtime']
+
+
+def test_multiplane_parallel_runs_planes_in_local_workers(test_ops):
+    """
+    Tests that planes run in local worker processes when multiplane_parallel is set without server settings.
+    """
+    test_ops.update({
+        'tiff_list': ['input.tif'],
+        'nplanes': 2,
+        'roidetect': False,
+        'batch_size': 100,
+        'multiplane_parallel': True,
+        'multiplane_workers': 2,
+        'threads_per_plane': 1,
+    })
+    suite2p.run_s2p(ops=test_ops)
+    for ipl in range(2):
+        ops = suite2p.io.load_ops(str(Path(test_ops['save_path0']) / 'suite2p' / f'plane{ipl}' / 'ops.npy'))
+        assert list(ops['timing'].keys()) == ['registration', 'total_plane_runtime']
+        assert len(ops['yoff']) == ops['nframes']
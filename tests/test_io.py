@@ -1,7 +1,10 @@
 """
 Tests for the Suite2p IO module
 """
+import datetime
+import os
 import re
+import time
 from pathlib import Path
 
 import numpy as np
@@ -9,6 +12,7 @@ import pytest
 from natsort import natsorted
 from pynwb import NWBHDF5IO
 
+import suite2p
 from suite2p import io
 from suite2p.io.nwb import save_nwb
 from suite2p.io.utils import get_suite2p_path
@@ -101,6 +105,403 @@ def test_that_binaryfile_data_is_repeatable(binfile1500):
     assert np.allclose(data1, data2)
 
 
+@pytest.fixture()
+def random_binfile(tmp_path):
+    frames = np.random.RandomState(0).randint(0, 2000, size=(37, 16, 24)).astype(np.int16)
+    bin_filename = str(tmp_path / 'data.bin')
+    frames.tofile(bin_filename)
+    return bin_filename, frames
+
+
+def test_memmap_binaryfile_matches_buffered_binaryfile(random_binfile):
+    bin_filename, frames = random_binfile
+    Ly, Lx = frames.shape[1:]
+    inds = np.array([0, 5, 6, 20, 36])
+    with io.BinaryFile(Ly=Ly, Lx=Lx, read_filename=bin_filename) as f, \
+         io.BinaryFile(Ly=Ly, Lx=Lx, read_filename=bin_filename, use_memmap=True) as fm:
+        assert fm.shape == f.shape == frames.shape
+        for (i0, d0), (i1, d1) in zip(f.iter_frames(batch_size=10), fm.iter_frames(batch_size=10)):
+            assert np.array_equal(i0, i1)
+            assert d0.dtype == d1.dtype == np.float32
+            assert np.array_equal(d0, d1)
+        assert np.array_equal(fm.ix(inds), f.ix(inds))
+        assert np.array_equal(fm[3:9, 2:10, 4:12], f[3:9, 2:10, 4:12])
+        assert np.allclose(fm.sampled_mean(), frames.astype(np.float32).mean(axis=0))
+
+
+def test_memmap_binaryfile_slices_are_views(random_binfile):
+    bin_filename, frames = random_binfile
+    Ly, Lx = frames.shape[1:]
+    with io.BinaryFile(Ly=Ly, Lx=Lx, read_filename=bin_filename, use_memmap=True) as f:
+        assert np.shares_memory(f[2:8, 1:5], f.data)
+        _, data = f.read(batch_size=5, dtype=None)
+        assert data.dtype == np.int16
+        assert np.shares_memory(data, f.data)
+
+
+def test_memmap_binaryfile_inplace_write(random_binfile):
+    bin_filename, frames = random_binfile
+    Ly, Lx = frames.shape[1:]
+    with io.BinaryFile(Ly=Ly, Lx=Lx, read_filename=bin_filename, write_filename=bin_filename,
+                       use_memmap=True) as f:
+        for _, data in f.iter_frames(batch_size=8):
+            f.write(data + 1)
+    assert np.array_equal(np.fromfile(bin_filename, np.int16).reshape(frames.shape), frames + 1)
+
+
+def test_memmap_binaryfile_writes_overlapping_views(random_binfile):
+    bin_filename, frames = random_binfile
+    Ly, Lx = frames.shape[1:]
+    with io.BinaryFile(Ly=Ly, Lx=Lx, read_filename=bin_filename, write_filename=bin_filename,
+                       use_memmap=True) as f:
+        _, data = f.read(batch_size=5, dtype=None)
+        # the exact view of the frames just read is written back as is
+        f.write(data)
+        f.read(batch_size=5, dtype=None)
+        # a view shifted by one frame overlaps the frames being written but is not them
+        f.write(f.data[6:11])
+    assert np.array_equal(np.fromfile(bin_filename, np.int16).reshape(frames.shape)[:10],
+                          np.concatenate((frames[:5], frames[6:11])))
+
+
+@pytest.mark.parametrize("use_memmap", [False, True])
+def test_sample_frames_returns_frames_in_requested_order(random_binfile, use_memmap):
+    bin_filename, frames = random_binfile
+    Ly, Lx = frames.shape[1:]
+    inds = np.array([30, 2, 3, 3, 36, 0, 14, 15, 16, 25])
+    with io.BinaryFile(Ly=Ly, Lx=Lx, read_filename=bin_filename, use_memmap=use_memmap) as f:
+        assert np.array_equal(f.sample_frames(inds, max_gap=2, n_workers=3), frames[inds])
+        assert np.array_equal(f.sample_frames(np.arange(0, 37, 4)), frames[::4])
+        _, data = f.read(batch_size=4)
+        assert np.array_equal(data, frames[:4])
+        with pytest.raises(IndexError):
+            f.sample_frames([37])
+
+
+def test_sample_frames_caps_request_bytes_and_resumes_short_reads(random_binfile, monkeypatch):
+    import os
+    bin_filename, frames = random_binfile
+    Ly, Lx = frames.shape[1:]
+    inds = np.array([30, 2, 3, 3, 36, 0, 14, 15, 16, 25])
+    preadv = os.preadv
+    requests = []
+    def short_preadv(fd, buffers, offset):
+        # return at most 100 bytes per call, as a large request does at the kernel's per-call limit
+        requests.append(sum(len(b) for b in buffers))
+        return preadv(fd, [memoryview(buffers[0])[:100]], offset)
+    monkeypatch.setattr(os, 'preadv', short_preadv)
+    with io.BinaryFile(Ly=Ly, Lx=Lx, read_filename=bin_filename) as f:
+        assert np.array_equal(f.sample_frames(inds, max_gap=8, max_run_nbytes=3 * f.nbytesread), frames[inds])
+    assert max(requests) <= 3 * Ly * Lx * 2
+
+
+@pytest.mark.parametrize("prefetch, write_behind", [(0, True), (2, False), (3, True)])
+def test_prefetch_and_write_behind_keep_inplace_order(random_binfile, prefetch, write_behind):
+    bin_filename, frames = random_binfile
+    Ly, Lx = frames.shape[1:]
+    with io.BinaryFile(Ly=Ly, Lx=Lx, read_filename=bin_filename, write_filename=bin_filename,
+                       write_behind=write_behind) as f:
+        n = 0
+        for indices, data in f.iter_frames(batch_size=5, prefetch=prefetch):
+            assert np.array_equal(data, frames[indices])
+            f.write(2 * data)
+            n += len(indices)
+        assert n == len(frames)
+    assert np.array_equal(np.fromfile(bin_filename, np.int16).reshape(frames.shape), 2 * frames)
+
+
+def test_write_behind_to_separate_file(random_binfile, tmp_path):
+    bin_filename, frames = random_binfile
+    Ly, Lx = frames.shape[1:]
+    out_filename = str(tmp_path / 'data_out.bin')
+    with io.BinaryFile(Ly=Ly, Lx=Lx, read_filename=bin_filename, write_filename=out_filename,
+                       write_behind=True) as f:
+        for _, data in f.iter_frames(batch_size=8, prefetch=2):
+            f.write(data - 1)
+    assert np.array_equal(np.fromfile(out_filename, np.int16).reshape(frames.shape), frames - 1)
+
+
+def test_parallel_tiff_to_binary_matches_sequential(tmp_path):
+    from tifffile import imwrite
+    rs = np.random.RandomState(0)
+    for k in range(5):
+        imwrite(str(tmp_path / ('file%d.tif' % k)), rs.randint(0, 3000, size=(7 + 3 * k, 12, 10)).astype(np.uint16))
+    outputs = []
+    for io_workers in [1, 3]:
+        ops = {**suite2p.default_ops(), 'data_path': [str(tmp_path)], 'save_path0': str(tmp_path / str(io_workers)),
+               'nplanes': 2, 'nchannels': 2, 'batch_size': 4, 'io_workers': io_workers}
+        ops = io.tiff_to_binary(ops)
+        outputs.append((ops, [np.fromfile(Path(ops['save_path0'], 'suite2p', 'plane%d' % j, fname), np.int16)
+                              for j in range(2) for fname in ['data.bin', 'data_chan2.bin']]))
+    (ops0, data0), (ops1, data1) = outputs
+    assert ops1['nframes'] == ops0['nframes'] == 17
+    assert np.array_equal(ops1['frames_per_file'], ops0['frames_per_file'])
+    assert np.array_equal(ops1['frames_per_folder'], ops0['frames_per_folder'])
+    assert np.allclose(ops1['meanImg'], ops0['meanImg'])
+    assert all(np.array_equal(d0, d1) for d0, d1 in zip(data0, data1))
+
+
+@pytest.mark.parametrize("layout, io_workers", [("3d", 1), ("5d", 1), ("5d", 2)])
+def test_chunked_h5_to_binary(tmp_path, layout, io_workers):
+    import h5py
+    nplanes, nchannels, nt = 2, 2, 23
+    # time x plane x channel x Ly x Lx
+    mov = np.random.RandomState(0).randint(0, 3000, size=(nt, nplanes, nchannels, 12, 10)).astype(np.uint16)
+    if layout == "3d":
+        data, chunks = mov.reshape(-1, 12, 10), (6, 12, 10)
+    else:
+        data, chunks = mov.transpose(2, 0, 1, 3, 4), (1, 5, 1, 12, 10)
+    h5_path = str(tmp_path / 'data.h5')
+    with h5py.File(h5_path, 'w') as f:
+        f.create_dataset('data', data=data, chunks=chunks, compression='gzip')
+    ops = {**suite2p.default_ops(), 'h5py': h5_path, 'h5py_key': 'data', 'data_path': [], 'input_format': 'h5',
+           'save_path0': str(tmp_path), 'nplanes': nplanes, 'nchannels': nchannels, 'batch_size': 10,
+           'io_workers': io_workers}
+    ops = io.h5py_to_binary(ops)
+    assert ops['nframes'] == nt
+    for j in range(nplanes):
+        for ichan, fname in enumerate(['data.bin', 'data_chan2.bin']):
+            out = np.fromfile(tmp_path / 'suite2p' / ('plane%d' % j) / fname, np.int16).reshape(nt, 12, 10)
+            assert np.array_equal(out, mov[:, j, ichan] // 2)
+
+
+def test_auto_chunked_h5_batches_stay_bounded(tmp_path):
+    import h5py
+    from suite2p.io.h5 import h5_layout, chunk_aligned_batch
+    nplanes, nchannels, nt = 2, 2, 150
+    mov = np.random.RandomState(0).randint(0, 3000, size=(nt * nplanes * nchannels, 64, 48)).astype(np.uint16)
+    h5_path = str(tmp_path / 'data.h5')
+    with h5py.File(h5_path, 'w') as f:
+        dset = f.create_dataset('data', data=mov, compression='gzip')
+        chunk_len = dset.chunks[0]
+        frame_nbytes = 64 * 48 * 2
+        _, nt_batch, cache_nbytes, parallel, _ = h5_layout(dset, nplanes, nchannels, 40)
+    assert parallel
+    assert nt_batch % (nplanes * nchannels) == 0 and nt_batch < mov.shape[0]
+    assert cache_nbytes <= (nt_batch + 2 * chunk_len) * frame_nbytes
+    # whole chunks when they fit in the byte cap, fewer whole chunks or unaligned batches when they don't
+    assert chunk_aligned_batch(40, 4, 30, 10) == 60
+    assert chunk_aligned_batch(40, 4, 6, 10, max_nbytes=100) == 36
+    assert chunk_aligned_batch(40, 4, 30, 10, max_nbytes=100) == 40
+
+    ops = {**suite2p.default_ops(), 'h5py': h5_path, 'h5py_key': 'data', 'data_path': [], 'input_format': 'h5',
+           'save_path0': str(tmp_path), 'nplanes': nplanes, 'nchannels': nchannels, 'batch_size': 40,
+           'io_workers': 2}
+    ops = io.h5py_to_binary(ops)
+    assert ops['nframes'] == nt
+    for j in range(nplanes):
+        for ichan, fname in enumerate(['data.bin', 'data_chan2.bin']):
+            out = np.fromfile(tmp_path / 'suite2p' / ('plane%d' % j) / fname, np.int16).reshape(nt, 64, 48)
+            assert np.array_equal(out, mov[nchannels * j + ichan::nplanes * nchannels] // 2)
+
+
+def test_parallel_sbx_to_binary_matches_sequential(tmp_path):
+    from scipy.io import savemat
+    rows, cols, nchannels, nplanes, nt = 12, 10, 2, 2, 23
+    info = {'chan': {'nchan': nchannels}, 'volscan': 1, 'otwave': np.arange(nplanes), 'sz': np.array([rows, cols]),
+            'config': {'magnification': 1, 'lines': 512, 'frames': nt, 'magnification_list': np.array([1.0, 2.0]),
+                       'coord_rel': np.zeros(4)},
+            'dycal': 1.0, 'dxcal': 1.0, 'scanmode': 1, 'resfreq': 8000, 'scanbox_version': 3, 'recordsPerBuffer': 256}
+    data_path = tmp_path / 'data'
+    data_path.mkdir()
+    savemat(str(data_path / 'file.mat'), {'info': info})
+    # stored column-major as channels x cols x rows x planes x frames
+    raw = np.random.RandomState(0).randint(0, 65535, size=(nt, nplanes, rows, cols, nchannels)).astype(np.uint16)
+    raw.tofile(str(data_path / 'file.sbx'))
+    outputs = []
+    for io_workers in [1, 3]:
+        ops = {**suite2p.default_ops(), 'data_path': [str(data_path)], 'save_path0': str(tmp_path / str(io_workers)),
+               'nplanes': nplanes, 'nchannels': nchannels, 'batch_size': 10, 'input_format': 'sbx',
+               'io_workers': io_workers}
+        ops = io.sbx_to_binary(ops)
+        outputs.append((ops, [np.fromfile(Path(ops['save_path0'], 'suite2p', 'plane%d' % j, fname), np.int16)
+                              for j in range(nplanes) for fname in ['data.bin', 'data_chan2.bin']]))
+    (ops0, data0), (ops1, data1) = outputs
+    assert ops1['nframes'] == ops0['nframes'] == nt
+    assert np.allclose(ops1['meanImg'], ops0['meanImg'])
+    assert np.allclose(ops1['meanImg_chan2'], ops0['meanImg_chan2'])
+    assert all(np.array_equal(d0, d1) for d0, d1 in zip(data0, data1))
+    expected = (65535 - raw[:, 1, :, :, 0]) // 2
+    assert np.array_equal(data0[2].reshape(nt, rows, cols), expected.astype(np.int16))
+
+
+def test_tiff_to_binary_resumes_from_manifest(tmp_path):
+    from tifffile import imwrite
+    rs = np.random.RandomState(0)
+    movies = [rs.randint(0, 3000, size=(7 + 3 * k, 12, 10)).astype(np.uint16) for k in range(5)]
+    full_path, data_path = tmp_path / 'full', tmp_path / 'data'
+    full_path.mkdir()
+    data_path.mkdir()
+    for k, mov in enumerate(movies):
+        imwrite(str(full_path / ('file%d.tif' % k)), mov, photometric='minisblack')
+    ops = {**suite2p.default_ops(), 'nplanes': 2, 'nchannels': 2, 'batch_size': 4}
+    ops_full = io.tiff_to_binary({**ops, 'data_path': [str(full_path)], 'save_path0': str(tmp_path / 'out_full')})
+
+    # convert the first files, then simulate a conversion interrupted while writing the next file
+    for k in range(3):
+        imwrite(str(data_path / ('file%d.tif' % k)), movies[k], photometric='minisblack')
+    ops = {**ops, 'data_path': [str(data_path)], 'save_path0': str(tmp_path / 'out')}
+    io.tiff_to_binary(ops.copy())
+    plane0 = tmp_path / 'out' / 'suite2p' / 'plane0'
+    with open(plane0 / 'data.bin', 'ab') as f:
+        f.write(b'\x01' * 1000)
+    manifest = io.load_manifest(str(tmp_path / 'out' / 'suite2p' / io.manifest.MANIFEST_NAME))
+    assert len(manifest['files']) == 3
+    for k in range(3, 5):
+        imwrite(str(data_path / ('file%d.tif' % k)), movies[k], photometric='minisblack')
+    assert io.manifest.has_new_files(str(tmp_path / 'out' / 'suite2p'), io.utils.get_tif_list(ops.copy())[0])
+
+    ops_resumed = io.tiff_to_binary(ops.copy())
+    assert ops_resumed['nframes'] == ops_full['nframes']
+    assert np.array_equal(ops_resumed['frames_per_file'], ops_full['frames_per_file'])
+    assert np.allclose(ops_resumed['meanImg'], ops_full['meanImg'])
+    for j in range(2):
+        for fname in ['data.bin', 'data_chan2.bin']:
+            expected = np.fromfile(tmp_path / 'out_full' / 'suite2p' / ('plane%d' % j) / fname, np.int16)
+            assert np.array_equal(np.fromfile(tmp_path / 'out' / 'suite2p' / ('plane%d' % j) / fname, np.int16), expected)
+
+
+def test_ingest_manifest_writes_are_throttled_and_registered_binaries_kept(tmp_path, monkeypatch):
+    from tifffile import imwrite
+    rs = np.random.RandomState(0)
+    data_path = tmp_path / 'data'
+    data_path.mkdir()
+    for k in range(4):
+        imwrite(str(data_path / ('file%d.tif' % k)), rs.randint(0, 3000, size=(8, 12, 10)).astype(np.uint16),
+                photometric='minisblack')
+    savez = np.savez
+    writes = []
+    def count_savez(file, *args, **kwargs):
+        if getattr(file, 'name', '').endswith(io.manifest.MANIFEST_NAME + '.tmp'):
+            writes.append(file.name)
+        savez(file, *args, **kwargs)
+    monkeypatch.setattr(np, 'savez', count_savez)
+    ops = {**suite2p.default_ops(), 'data_path': [str(data_path)], 'nplanes': 2, 'batch_size': 4}
+    io.tiff_to_binary({**ops, 'save_path0': str(tmp_path / 'out')})
+    assert len(writes) == 1
+    monkeypatch.setattr(io.manifest, 'CHECKPOINT_INTERVAL', 0.)
+    io.tiff_to_binary({**ops, 'save_path0': str(tmp_path / 'out2')})
+    assert len(writes) == 1 + 4
+    monkeypatch.undo()
+
+    # new files are appended to converted binaries, but not to binaries registered in place
+    imwrite(str(data_path / 'file4.tif'), rs.randint(0, 3000, size=(8, 12, 10)).astype(np.uint16),
+            photometric='minisblack')
+    ops = {**ops, 'save_path0': str(tmp_path / 'out'), 'save_folder': 'suite2p'}
+    fs = io.utils.get_tif_list(ops.copy())[0]
+    assert io.manifest.can_append(io.utils.init_ops(ops.copy()), fs)
+    plane0 = tmp_path / 'out' / 'suite2p' / 'plane0'
+    ops_plane0 = np.load(plane0 / 'ops.npy', allow_pickle=True).item()
+    np.save(plane0 / 'ops.npy', {**ops_plane0, 'yoff': np.zeros(16)})
+    assert io.manifest.has_new_files(str(tmp_path / 'out' / 'suite2p'), fs)
+    assert not io.manifest.can_append(io.utils.init_ops(ops.copy()), fs)
+
+
+@pytest.mark.parametrize("chunks", [(5, 12, 10), True])
+def test_multiplane_nwb_to_binary_and_virtual(tmp_path, chunks):
+    import datetime
+    from hdmf.backends.hdf5.h5_utils import H5DataIO
+    from pynwb import NWBFile
+    from pynwb.ophys import OpticalChannel, TwoPhotonSeries
+    nplanes, nchannels, nt = 2, 2, 23
+    mov = np.random.RandomState(0).randint(0, 3000, size=(nt * nplanes * nchannels, 12, 10)).astype(np.uint16)
+    nwbfile = NWBFile(session_description='test', identifier='test',
+                      session_start_time=datetime.datetime.now(datetime.timezone.utc))
+    device = nwbfile.create_device(name='microscope')
+    imaging_plane = nwbfile.create_imaging_plane(
+        name='plane', optical_channel=OpticalChannel(name='green', description='', emission_lambda=500.),
+        imaging_rate=30., description='', device=device, excitation_lambda=900., indicator='gcamp', location='v1')
+    nwbfile.add_acquisition(TwoPhotonSeries(name='TwoPhotonSeries', imaging_plane=imaging_plane, rate=30., unit='n',
+                                            data=H5DataIO(mov, chunks=chunks, compression='gzip')))
+    nwb_path = str(tmp_path / 'data.nwb')
+    with NWBHDF5IO(nwb_path, 'w') as fio:
+        fio.write(nwbfile)
+
+    ops = {**suite2p.default_ops(), 'nwb_file': nwb_path, 'input_format': 'nwb', 'nplanes': nplanes,
+           'nchannels': nchannels, 'batch_size': 6, 'io_workers': 2}
+    ops_bin = io.nwb_to_binary({**ops, 'save_path0': str(tmp_path / 'bin')})
+    ops_virt = io.nwb_to_virtual({**ops, 'save_path0': str(tmp_path / 'virt')})
+    assert ops_bin['nframes'] == ops_virt['nframes'] == nt
+    assert ops_virt['keep_movie_raw']
+    for j in range(nplanes):
+        for ichan, (fname, raw_fname) in enumerate([('data.bin', 'data_raw.bin'), ('data_chan2.bin', 'data_chan2_raw.bin')]):
+            expected = (mov[j * nchannels + ichan::nplanes * nchannels] // 2).astype(np.int16)
+            plane = Path('suite2p', 'plane%d' % j)
+            assert np.array_equal(np.fromfile(tmp_path / 'bin' / plane / fname, np.int16).reshape(expected.shape), expected)
+            with io.BinaryFile(Ly=12, Lx=10, read_filename=str(tmp_path / 'virt' / plane / raw_fname)) as f:
+                assert np.array_equal(f.data, expected)
+                assert np.array_equal(f.sample_frames([7, 0, 3]), expected[[7, 0, 3]])
+                for indices, data in f.iter_frames(batch_size=5, prefetch=2):
+                    assert np.array_equal(data, expected[indices])
+
+
+def test_virtual_tiff_matches_tiff_to_binary(tmp_path):
+    from tifffile import imwrite
+    rs = np.random.RandomState(0)
+    data_path = tmp_path / 'tiffs'
+    data_path.mkdir()
+    for k in range(3):
+        imwrite(str(data_path / ('file%d.tif' % k)), rs.randint(0, 3000, size=(8 + 4 * k, 12, 10)).astype(np.uint16),
+                photometric='minisblack')
+    ops = {**suite2p.default_ops(), 'data_path': [str(data_path)], 'nplanes': 2, 'nchannels': 2, 'batch_size': 4}
+    ops_bin = io.tiff_to_binary({**ops, 'save_path0': str(tmp_path / 'bin')})
+    for _ in range(2):  # second pass reads page offsets from the cache
+        ops_virt = io.tiff_to_virtual({**ops, 'save_path0': str(tmp_path / 'virt')})
+    assert (data_path / io.virtual.TIFF_INDEX_CACHE).exists()
+    assert ops_virt['nframes'] == ops_bin['nframes'] == 9
+    assert np.array_equal(ops_virt['frames_per_file'], ops_bin['frames_per_file'])
+    assert np.allclose(ops_virt['meanImg'], ops_bin['meanImg'])
+    for j in range(2):
+        for fname, raw_fname in [('data.bin', 'data_raw.bin'), ('data_chan2.bin', 'data_chan2_raw.bin')]:
+            expected = np.fromfile(tmp_path / 'bin' / 'suite2p' / ('plane%d' % j) / fname, np.int16).reshape(-1, 12, 10)
+            virt_filename = str(tmp_path / 'virt' / 'suite2p' / ('plane%d' % j) / raw_fname)
+            assert Path(virt_filename).stat().st_size < expected.nbytes
+            with io.BinaryFile(Ly=12, Lx=10, read_filename=virt_filename) as f:
+                assert f.shape == expected.shape
+                assert np.array_equal(f.data, expected)
+                assert np.array_equal(f.sample_frames([5, 0, 2]), expected[[5, 0, 2]])
+                for indices, data in f.iter_frames(batch_size=4, prefetch=2):
+                    assert np.array_equal(data, expected[indices])
+
+
+
+def test_compressed_binaryfile_roundtrip(random_binfile, tmp_path):
+    bin_filename, frames = random_binfile
+    Ly, Lx = frames.shape[1:]
+    smooth = np.cumsum(frames // 100, axis=2).astype(np.int16)
+    smooth.tofile(bin_filename)
+    comp_filename = str(tmp_path / 'data_comp.bin')
+    with io.BinaryFile(Ly=Ly, Lx=Lx, read_filename=bin_filename, write_filename=comp_filename,
+                       compression='zlib') as f:
+        for _, data in f.iter_frames(batch_size=10):
+            f.write(data)
+    assert io.file_nbytes(comp_filename) == smooth.nbytes
+    assert Path(comp_filename).stat().st_size < smooth.nbytes / 2
+
+    inds = np.array([36, 0, 17, 17, 5])
+    with io.BinaryFile(Ly=Ly, Lx=Lx, read_filename=comp_filename) as f:
+        assert f.shape == smooth.shape
+        assert np.array_equal(f.data, smooth)
+        assert np.array_equal(f.sample_frames(inds), smooth[inds])
+        assert np.array_equal(f[3:9, 2:10], smooth[3:9, 2:10])
+        for indices, data in f.iter_frames(batch_size=7, prefetch=2):
+            assert np.array_equal(data, smooth[indices])
+
+
+def test_compressed_binaryfile_inplace_write(tmp_path):
+    frames = np.random.RandomState(1).randint(-500, 500, size=(25, 8, 12)).astype(np.int16)
+    comp_filename = str(tmp_path / 'data.bin')
+    with io.open_binary(comp_filename, 'wb', compression='zlib', chunk_bytes=5 * frames[0].nbytes) as f:
+        f.write(bytearray(frames))
+    with io.BinaryFile(Ly=8, Lx=12, read_filename=comp_filename, write_filename=comp_filename) as f:
+        for k, (_, data) in enumerate(f.iter_frames(batch_size=4)):
+            f.write(data + 1)
+            if k == 2:
+                break
+    out = io.BinaryFile(Ly=8, Lx=12, read_filename=comp_filename).data
+    assert np.array_equal(out[:12], frames[:12] + 1)
+    assert np.array_equal(out[12:], frames[12:])
+
 @pytest.mark.parametrize(
     "data_folder",
     [
@@ -163,3 +564,231 @@ def test_get_suite2p_path(input_path, expected_path, success):
     else:
         with pytest.raises(FileNotFoundError):
             get_suite2p_path(Path(input_path))
+
+
+def test_tiff_metadata_is_cached_on_disk(tmp_path, monkeypatch):
+    from tifffile import imwrite, imread
+    mov = np.random.RandomState(0).randint(0, 3000, size=(6, 12, 10)).astype(np.uint16)
+    fname = str(tmp_path / 'file0.tif')
+    imwrite(fname, mov, photometric='minisblack')
+    meta = io.tiffmeta.tiff_metadata([fname])[0]
+    assert (meta['npages'], meta['Ly'], meta['Lx']) == (6, 12, 10)
+    assert np.array_equal(io.tiffmeta.read_pages(fname, meta, 4, 5), imread(fname)[4:])
+    # single-file lookups are saved later, lookups of several files when they finish
+    cache_file = tmp_path / io.tiffmeta.TIFF_INDEX_CACHE
+    assert not cache_file.exists()
+    for k in range(1, 4):
+        imwrite(str(tmp_path / ('file%d.tif' % k)), mov, photometric='minisblack')
+    metas = io.tiffmeta.tiff_metadata([str(tmp_path / ('file%d.tif' % k)) for k in range(4)], n_workers=2)
+    assert [m['npages'] for m in metas] == [6] * 4
+    assert cache_file.exists() and os.path.abspath(str(tmp_path)) not in io.tiffmeta._unsaved
+
+    # a new process reads the metadata from the cache file without parsing the tiff
+    io.tiffmeta._caches.clear()
+    def parse(file):
+        raise AssertionError('tiff parsed again')
+    monkeypatch.setattr(io.tiffmeta, 'read_tiff_metadata', parse)
+    assert io.tiffmeta.tiff_metadata([fname])[0]['npages'] == 6
+    monkeypatch.undo()
+
+    # changed files are parsed again
+    imwrite(fname, mov[:3], photometric='minisblack')
+    assert io.tiffmeta.tiff_metadata([fname])[0]['npages'] == 3
+
+
+def _write_scanimage_tiff(filename, mov, rois):
+    import json
+    from tifffile import imwrite
+    artist = json.dumps({'RoiGroups': {'imagingRoiGroup': {'rois': [{'scanfields': roi} for roi in rois]}}})
+    imwrite(filename, mov, photometric='minisblack', extratags=[(315, 's', 0, artist, True)])
+
+
+def test_lbm_shared_memory_loader_matches_imread_stitching(tmp_path):
+    # lbm needs the optional scikit-image and imreg_dft
+    pytest.importorskip('skimage')
+    pytest.importorskip('imreg_dft')
+    import gc
+    from multiprocessing import shared_memory
+    from tifffile import imread
+    from suite2p.io import lbm
+    # two 8 x 10 ROIs stacked in the tiff with 2 buffer lines, placed side by side when stitched
+    rois = [{'roiUuid': str(k), 'centerXY': [0.625 + 1.25 * k, 0.5], 'sizeXY': [1.25, 1.0],
+             'pixelResolutionXY': [10, 8]} for k in range(2)]
+    rs = np.random.RandomState(0)
+    paths = []
+    for k in range(2):
+        paths.append(str(tmp_path / ('file%d.tif' % k)))
+        _write_scanimage_tiff(paths[-1], rs.randint(0, 3000, size=(5, 3, 18, 10)).astype(np.int16), rois)
+    channels = [2, 0]
+
+    # stitching of the tiffs read with imread
+    si_rois = lbm.get_meso_rois(paths[0])
+    expected = []
+    for path in paths:
+        tif = imread(path)
+        expected.append(np.stack([lbm.stitch_rois_fast(lbm.split_rois_from_tif(tif, si_rois, ch_id=ch), si_rois)[0]
+                                  for ch in channels]))
+    assert expected[0].shape == (2, 5, 8, 20)
+    mov = lbm.load_and_stitch_tifs(paths, channels, verbose=False, n_proc=2, convert_plane_ids_to_channel_ids=False)
+    assert np.array_equal(mov, np.concatenate(expected, axis=1))
+
+    # ROI start pixels from the metadata match those of stitch_rois_fast
+    tif = imread(paths[0])
+    start_pix = lbm.stitch_rois_fast(lbm.split_rois_from_tif(tif[:2], si_rois), si_rois, get_roi_start_pix=True)
+    assert lbm.get_roi_start_pix_from_metadata(paths[0]) == start_pix
+    assert lbm.load_and_stitch_full_tif_mp(paths[0], channels, get_roi_start_pix=True) == start_pix
+
+    # the input buffer and the worker pool are reused across files
+    with lbm.SharedTifLoader(n_proc=2) as loader:
+        ims = []
+        for path in paths:
+            im, _, _ = lbm.load_and_stitch_full_tif_mp(path, channels, verbose=False, loader=loader)
+            ims.append(im)
+            if path == paths[0]:
+                buffer, pool = loader.buffer, loader.pool
+            assert loader.buffer is buffer and loader.pool is pool
+    assert loader.pool is None and loader.buffer is None
+    assert all(np.array_equal(im, e) for im, e in zip(ims, expected))
+
+    # shared memory is unlinked once the array and its views are collected
+    name = ims[0].shm.name
+    view = ims[0][1]
+    del ims, im
+    gc.collect()
+    shm = shared_memory.SharedMemory(name)
+    shm.close()
+    del view
+    gc.collect()
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name)
+
+
+def test_roi_table_matches_stat_dicts_and_combines_planes(tmp_path):
+    rs = np.random.RandomState(0)
+    Ly, Lx, nt = 20, 24, 5
+    for iplane in range(2):
+        stat = []
+        for n in range(4 + iplane):
+            npix = rs.randint(3, 9)
+            ypix, xpix = rs.randint(0, Ly, npix), rs.randint(0, Lx, npix)
+            stat.append({'ypix': ypix, 'xpix': xpix, 'lam': rs.rand(npix).astype(np.float32),
+                         'med': [ypix[0], xpix[0]], 'npix': npix, 'overlap': np.zeros(npix, bool)})
+        stat = np.array(stat)
+        plane = tmp_path / ('plane%d' % iplane)
+        plane.mkdir()
+        table = io.save_stat(str(plane), stat)
+        assert len(table) == len(stat)
+        assert np.array_equal(table.npix, [s['npix'] for s in stat])
+        sub = table[np.array([2, 0])]
+        assert np.array_equal(sub[0]['xpix'], stat[2]['xpix']) and np.array_equal(sub[1]['lam'], stat[0]['lam'])
+        for s, s2 in zip(stat, io.load_stat(str(plane))):
+            assert s.keys() == s2.keys()
+            assert all(np.array_equal(s[k], s2[k]) for k in s)
+        ops = {'Ly': Ly, 'Lx': Lx, 'nframes': nt, 'nchannels': 1, 'meanImg': np.zeros((Ly, Lx)),
+               'meanImgE': np.zeros((Ly, Lx)), 'Vcorr': np.zeros((Ly, Lx)), 'xrange': [0, Lx], 'yrange': [0, Ly],
+               'save_path0': str(tmp_path), 'save_folder': ''}
+        np.save(plane / 'ops.npy', ops)
+        for fname in ['F.npy', 'Fneu.npy', 'spks.npy']:
+            np.save(plane / fname, np.zeros((len(stat), nt), np.float32))
+        np.save(plane / 'iscell.npy', np.ones((len(stat), 2)))
+
+    stat = io.combined(str(tmp_path), save=False)[0]
+    stat_planes = [io.load_stat(str(tmp_path / ('plane%d' % iplane))) for iplane in range(2)]
+    assert len(stat) == 9
+    assert [s['iplane'] for s in stat] == [0] * 4 + [1] * 5
+    dy, dx = io.compute_dydx([np.load(tmp_path / 'plane0' / 'ops.npy', allow_pickle=True).item()] * 2)
+    for s, s0 in zip(stat, stat_planes[0].tolist() + stat_planes[1].tolist()):
+        assert np.array_equal(s['ypix'], s0['ypix'] + dy[s['iplane']])
+        assert np.array_equal(s['xpix'], s0['xpix'] + dx[s['iplane']])
+        assert np.array_equal(s['med'], np.array(s0['med']) + [dy[s['iplane']], dx[s['iplane']]])
+
+
+def test_results_store_reads_lazily_and_falls_back_to_npy(tmp_path):
+    rs = np.random.RandomState(0)
+    F, spks = rs.rand(10, 5000).astype(np.float32), rs.rand(10, 5000).astype(np.float32)
+    iscell = np.ones((10, 2))
+    stat = [{'ypix': np.arange(n), 'xpix': np.arange(n), 'lam': np.ones(n, np.float32), 'npix': n,
+             'med': [0, 0]} for n in range(1, 11)]
+    ops = {'Ly': 20, 'Lx': 24, 'meanImg': rs.rand(20, 24), 'save_path': str(tmp_path), 'tau': 1.}
+    io.save_results(str(tmp_path), ops=ops, stat=stat, F=F, spks=spks, iscell=iscell)
+    with io.load_results(str(tmp_path)) as results:
+        assert sorted(results.keys()) == ['F', 'iscell', 'spks']
+        assert results['F'].chunks[0] < F.shape[0] and results['F'].chunks[1] < F.shape[1]
+        assert np.array_equal(results['F'][3], F[3])
+        assert np.array_equal(results['spks'][:, 100:200], spks[:, 100:200])
+        assert np.array_equal(results.stat.npix, np.arange(1, 11))
+        assert np.array_equal(results.ops['meanImg'], ops['meanImg']) and results.ops['tau'] == 1.
+
+    npy_path = tmp_path / 'npy'
+    npy_path.mkdir()
+    np.save(npy_path / 'F.npy', F)
+    np.save(npy_path / 'ops.npy', ops)
+    io.save_stat(str(npy_path), stat)
+    with io.load_results(str(npy_path)) as results:
+        assert results.keys() == ['F']
+        assert isinstance(results['F'], np.memmap)
+        assert np.array_equal(results['F'][:, -7:], F[:, -7:])
+        assert len(results.stat) == 10 and results.ops['Ly'] == 20
+
+
+def test_ops_sidecars_are_rewritten_only_when_changed(tmp_path):
+    rs = np.random.RandomState(0)
+    ops_path = str(tmp_path / 'ops.npy')
+    ops = {'Ly': 20, 'Lx': 24, 'ops_path': ops_path, 'refImg': rs.rand(20, 24).astype(np.float32),
+           'Vmap': [rs.rand(20, 24), rs.rand(10, 12)], 'yrange': np.array([0, 20]), 'nframes': np.int64(100),
+           'timing': {'registration': 1.5}, 'date_proc': datetime.datetime.now()}
+    io.save_ops(ops)
+    sidecars = sorted(os.listdir(tmp_path / 'ops_arrays'))
+    assert len(sidecars) == 3
+    mtimes = {f: os.path.getmtime(tmp_path / 'ops_arrays' / f) for f in sidecars}
+
+    ops['meanImg'] = rs.rand(20, 24)
+    io.save_ops(ops)
+    assert len(os.listdir(tmp_path / 'ops_arrays')) == 4
+    assert all(os.path.getmtime(tmp_path / 'ops_arrays' / f) == t for f, t in mtimes.items())
+
+    ops_loaded = io.load_ops(ops_path)
+    assert isinstance(ops_loaded['refImg'], np.memmap)
+    assert ops_loaded['Ly'] == 20 and ops_loaded['nframes'] == 100 and ops_loaded['timing'] == ops['timing']
+    assert ops_loaded['date_proc'] == ops['date_proc']
+    assert np.array_equal(ops_loaded['yrange'], ops['yrange']) and ops_loaded['yrange'].dtype == ops['yrange'].dtype
+    for key in ['refImg', 'meanImg']:
+        assert np.array_equal(ops_loaded[key], ops[key])
+    assert all(np.array_equal(v1, v2) for v1, v2 in zip(ops_loaded['Vmap'], ops['Vmap']))
+    ops_loaded['refImg'][0] = 0  # copy-on-write
+    assert np.array_equal(io.load_ops(ops_path)['refImg'], ops['refImg'])
+
+    # sidecars of changed arrays are replaced, ops.npy is used if it is newer
+    ops['refImg'] = ops['refImg'] + 1
+    io.save_ops(ops)
+    assert len(os.listdir(tmp_path / 'ops_arrays')) == 4
+    time.sleep(0.01)
+    np.save(ops_path, {'Ly': 30})
+    assert io.load_ops(ops_path) == {'Ly': 30}
+
+
+def test_ops_json_round_trips_values_without_loss(tmp_path):
+    ops_path = str(tmp_path / 'ops.npy')
+    big = np.arange(2000.)
+    changed = big.copy()
+    changed[1000] = -1
+    ops = {'ops_path': ops_path, 'shape': (3, 4), 'counts': {0: 1, 2: 3}, 'dtype': np.dtype('float32'),
+           'obj': np.array([big], dtype=object)}
+    io.save_ops(ops)
+    ops_loaded = io.load_ops(ops_path)
+    assert ops_loaded['shape'] == (3, 4) and ops_loaded['counts'] == {0: 1, 2: 3}
+    assert ops_loaded['dtype'] == np.dtype('float32')
+    assert np.array_equal(ops_loaded['obj'][0], big)
+
+    # object arrays differing only in elements hidden by the numpy repr get their own sidecar
+    ops['obj'] = np.array([changed], dtype=object)
+    io.save_ops(ops)
+    assert np.array_equal(io.load_ops(ops_path)['obj'][0], changed)
+
+    # ops.npy saved with save_npy is the exact pickle and preferred by load_ops
+    ops['refImg'] = np.zeros((20, 24), np.float32)
+    io.save_ops(ops)
+    assert isinstance(io.load_ops(ops_path)['refImg'], np.memmap)
+    io.save_ops(ops, save_npy=True)
+    ops_loaded = io.load_ops(ops_path)
+    assert not isinstance(ops_loaded['refImg'], np.memmap) and ops_loaded['shape'] == (3, 4)
@@ -1,4 +1,7 @@
+import json
+
 import numpy as np
+import pytest
 from suite2p.registration import bidiphase, utils
 
 
@@ -55,4 +58,235 @@ def test_negative_bidiphase_shift_shifts_every_other_line():
 
     shifted = orig.copy()
     bidiphase.shift(shifted, -2)
-    assert np.allclose(shifted, expected)
\ No newline at end of file
+    assert np.allclose(shifted, expected)
+
+def _shifted_movie(nframes=240, Ly=64, Lx=72, seed=0):
+    rs = np.random.RandomState(seed)
+    yy, xx = np.meshgrid(np.arange(Ly + 20), np.arange(Lx + 20), indexing='ij')
+    base = np.zeros((Ly + 20, Lx + 20), np.float32)
+    for cy, cx in rs.rand(40, 2) * [Ly + 20, Lx + 20]:
+        base += 1000 * np.exp(-((yy - cy)**2 + (xx - cx)**2) / 8)
+    shifts = rs.randint(-4, 5, size=(nframes, 2))
+    mov = np.stack([base[10 + dy:10 + dy + Ly, 10 + dx:10 + dx + Lx] for dy, dx in shifts])
+    return (mov + 50 * rs.rand(nframes, Ly, Lx)).astype(np.int16), shifts
+
+
+def test_fused_registration_during_tiff_conversion(tmp_path):
+    from tifffile import imwrite
+    import suite2p
+    from suite2p import io, registration
+
+    mov, shifts = _shifted_movie()
+    for k in range(3):
+        imwrite(str(tmp_path / ('file%d.tif' % k)), mov[80 * k: 80 * (k + 1)])
+    ops = {**suite2p.default_ops(), 'data_path': [str(tmp_path)], 'save_path0': str(tmp_path),
+           'batch_size': 50, 'nimg_init': 100, 'block_size': [32, 32], 'fused_registration': True}
+    ops = io.tiff_to_binary(ops)
+
+    assert ops['nframes'] == len(mov) and len(ops['yoff']) == len(mov) and ops['yoff1'].shape[0] == len(mov)
+    # offsets undo the simulated shifts (up to the position of the reference)
+    assert np.ptp(ops['yoff'] + shifts[:, 0]) <= 1 and np.ptp(ops['xoff'] + shifts[:, 1]) <= 1
+    reg = np.fromfile(ops['reg_file'], np.int16).reshape(mov.shape)
+    assert reg[:, 10:-10, 10:-10].std(axis=0).mean() < 0.2 * mov[:, 10:-10, 10:-10].std(axis=0).mean()
+    assert 'badframes' in ops and 'meanImgE' in ops
+
+
+def test_rfft_phasecorr_matches_complex_fft():
+    from suite2p.registration import rigid, nonrigid
+
+    mov, shifts = _shifted_movie(nframes=40)
+    mov = mov.astype(np.float32)
+    refImg = mov[:20].mean(axis=0)
+    maskMul, maskOffset = rigid.compute_masks(refImg, 3.45)
+    cfRefImg = rigid.phasecorr_reference(refImg, 1.15)
+    old = rigid.phasecorr(rigid.apply_masks(mov, maskMul, maskOffset), cfRefImg, 0.1, 0, convolve_method='old')
+    new = rigid.phasecorr(rigid.apply_masks(mov, maskMul, maskOffset, real=True), cfRefImg, 0.1, 0,
+                          convolve_method='rfft', workers=2)
+    assert np.array_equal(old[0], new[0]) and np.array_equal(old[1], new[1]) and np.allclose(old[2], new[2])
+
+    yblock, xblock, _, _, NRsm = nonrigid.make_blocks(*refImg.shape, block_size=(32, 32))
+    maskMulNR, maskOffsetNR, cfRefImgNR = nonrigid.phasecorr_reference(refImg, 3.45, 1.15, yblock, xblock)
+    kwargs = dict(data=mov, maskMul=maskMulNR.squeeze(), maskOffset=maskOffsetNR.squeeze(), cfRefImg=cfRefImgNR.squeeze(),
+                  snr_thresh=1.2, NRsm=NRsm, xblock=xblock, yblock=yblock, maxregshiftNR=5)
+    old = nonrigid.phasecorr(convolve_method='old', **kwargs)
+    new = nonrigid.phasecorr(convolve_method='rfft', **kwargs)
+    assert all(np.allclose(o, n, atol=1e-5) for o, n in zip(old, new))
+
+
+def test_nonrigid_phasecorr_finds_block_shifts_with_snr_smoothing():
+    from suite2p.registration import nonrigid
+
+    mov, shifts = _shifted_movie(nframes=30)
+    refImg = mov[0].astype(np.float32)
+    yblock, xblock, _, _, NRsm = nonrigid.make_blocks(*refImg.shape, block_size=(32, 32))
+    maskMulNR, maskOffsetNR, cfRefImgNR = nonrigid.phasecorr_reference(refImg, 3.45, 1.15, yblock, xblock)
+    # a high threshold sends every block through the smoothing over neighboring blocks
+    for snr_thresh in [1.2, 100.]:
+        ymax1, xmax1, cmax1 = nonrigid.phasecorr(mov, maskMulNR.squeeze(), maskOffsetNR.squeeze(), cfRefImgNR.squeeze(),
+                                                 snr_thresh, NRsm, xblock, yblock, maxregshiftNR=10)
+        assert ymax1.shape == xmax1.shape == cmax1.shape == (len(mov), len(yblock))
+        assert ymax1.dtype == np.float32
+        assert np.abs(np.round(ymax1) + (shifts[:, :1] - shifts[0, 0])).max() <= 1
+        assert np.abs(np.round(xmax1) + (shifts[:, 1:] - shifts[0, 1])).max() <= 1
+
+
+def test_roll_frames_shifts_in_place_like_shift_frame():
+    from suite2p.registration import rigid
+
+    rs = np.random.RandomState(0)
+    for dtype in [np.int16, np.float32]:
+        frames = (100 * rs.rand(10, 30, 41)).astype(dtype)
+        ymax, xmax = rs.randint(-50, 50, 10).astype(np.int32), rs.randint(-50, 50, 10)
+        ymax[0], xmax[0] = 0, 0
+        # vertical shifts with several row cycles, and purely horizontal ones
+        ymax[1:5], xmax[1:5] = [15, -10, 6, 0], [0, 3, -41, 7]
+        shifted = frames.copy()
+        rigid.roll_frames(shifted, ymax, xmax)
+        for frame, frame_shifted, dy, dx in zip(frames, shifted, ymax, xmax):
+            assert np.array_equal(frame_shifted, rigid.shift_frame(frame, dy, dx))
+
+
+def test_two_channel_registration_in_one_pass_matches_two_passes(tmp_path):
+    import suite2p
+    from suite2p import registration
+
+    mov, _ = _shifted_movie(nframes=120)
+    mov_chan2 = (mov // 2 + 7).astype(np.int16)
+    results = []
+    for together in [True, False]:
+        folder = tmp_path / str(together)
+        folder.mkdir()
+        ops = {**suite2p.default_ops(), 'Ly': mov.shape[1], 'Lx': mov.shape[2], 'nchannels': 2, 'batch_size': 50,
+               'nimg_init': 60, 'block_size': [32, 32], 'save_path': str(folder), 'register_chan2_together': together,
+               'reg_file': str(folder / 'data.bin'), 'reg_file_chan2': str(folder / 'data_chan2.bin')}
+        mov.tofile(ops['reg_file'])
+        mov_chan2.tofile(ops['reg_file_chan2'])
+        ops = registration.register_binary(ops)
+        results.append((ops, np.fromfile(ops['reg_file'], np.int16), np.fromfile(ops['reg_file_chan2'], np.int16)))
+    (ops1, reg1, reg1_chan2), (ops2, reg2, reg2_chan2) = results
+    assert np.array_equal(reg1, reg2) and np.array_equal(reg1_chan2, reg2_chan2)
+    assert np.array_equal(ops1['yoff1'], ops2['yoff1'])
+    assert np.allclose(ops1['meanImg_chan2'], reg1_chan2.reshape(mov.shape).mean(axis=0), atol=1)
+
+
+def test_two_channel_registration_rejects_binaries_of_different_length(tmp_path):
+    import suite2p
+    from suite2p import registration
+
+    mov, _ = _shifted_movie(nframes=120)
+    ops = {**suite2p.default_ops(), 'Ly': mov.shape[1], 'Lx': mov.shape[2], 'nchannels': 2, 'batch_size': 50,
+           'nimg_init': 60, 'block_size': [32, 32], 'save_path': str(tmp_path),
+           'reg_file': str(tmp_path / 'data.bin'), 'reg_file_chan2': str(tmp_path / 'data_chan2.bin')}
+    mov.tofile(ops['reg_file'])
+    mov[:100].tofile(ops['reg_file_chan2'])
+    with pytest.raises(ValueError, match='100 frames'):
+        registration.register_binary(ops)
+
+
+def test_pyramid_rigid_shifts_match_full_resolution():
+    import suite2p
+    from suite2p.registration import register
+
+    mov, shifts = _shifted_movie(nframes=60, Ly=192, Lx=160)
+    offsets = []
+    for levels in [0, 2]:
+        ops = {**suite2p.default_ops(), 'Ly': mov.shape[1], 'Lx': mov.shape[2], 'nonrigid': False,
+               'norm_frames': False, 'pyramid_levels': levels}
+        refAndMasks = register.compute_reference_masks(mov[0].astype(np.float32), ops)
+        assert len(refAndMasks) == (7 if levels else 6)
+        _, ymax, xmax, _, _, _, _ = register.register_frames(refAndMasks, mov.copy(), ops)
+        offsets.append((ymax, xmax))
+    assert np.array_equal(offsets[0][0], offsets[1][0]) and np.array_equal(offsets[0][1], offsets[1][1])
+    assert np.array_equal(offsets[1][0], shifts[0, 0] - shifts[:, 0])
+
+
+def test_sharded_registration_matches_one_process(tmp_path):
+    import suite2p
+    from suite2p import registration
+
+    mov, _ = _shifted_movie(nframes=130)
+    mov_chan2 = (mov // 2 + 7).astype(np.int16)
+    results = []
+    for nshards in [1, 3]:
+        folder = tmp_path / str(nshards)
+        folder.mkdir()
+        ops = {**suite2p.default_ops(), 'Ly': mov.shape[1], 'Lx': mov.shape[2], 'nchannels': 2, 'batch_size': 20,
+               'nimg_init': 60, 'block_size': [32, 32], 'save_path': str(folder), 'registration_shards': nshards,
+               'keep_movie_raw': True, 'raw_file': str(folder / 'data_raw.bin'),
+               'raw_file_chan2': str(folder / 'data_chan2_raw.bin'),
+               'reg_file': str(folder / 'data.bin'), 'reg_file_chan2': str(folder / 'data_chan2.bin')}
+        mov.tofile(ops['raw_file'])
+        mov_chan2.tofile(ops['raw_file_chan2'])
+        ops = registration.register_binary(ops)
+        results.append((ops, np.fromfile(ops['reg_file'], np.int16), np.fromfile(ops['reg_file_chan2'], np.int16)))
+    (ops1, reg1, reg1_chan2), (ops2, reg2, reg2_chan2) = results
+    assert np.array_equal(reg1, reg2) and np.array_equal(reg1_chan2, reg2_chan2)
+    for key in ['yoff', 'xoff', 'corrXY', 'yoff1', 'xoff1', 'corrXY1']:
+        assert np.array_equal(ops1[key], ops2[key])
+    assert np.allclose(ops1['meanImg'], ops2['meanImg']) and np.allclose(ops1['meanImg_chan2'], ops2['meanImg_chan2'])
+
+
+def test_online_pipeline_registers_and_extracts_streamed_frames(tmp_path):
+    import suite2p
+    from suite2p.extraction.extract import extract_traces_from_masks
+    from suite2p.extraction.masks import create_masks
+
+    mov, shifts = _shifted_movie(nframes=150)
+    ops = {**suite2p.default_ops(), 'nimg_init': 40, 'block_size': [32, 32]}
+    stat = []
+    for cy, cx in [(20, 20), (40, 50)]:
+        ypix, xpix = [a.ravel() for a in np.meshgrid(np.arange(cy - 3, cy + 4), np.arange(cx - 3, cx + 4), indexing='ij')]
+        stat.append({'ypix': ypix, 'xpix': xpix, 'lam': np.ones(len(ypix), np.float32), 'radius': 3.5,
+                     'npix': len(ypix), 'med': [cy, cx], 'overlap': np.zeros(len(ypix), bool)})
+    nbatches = []
+    pipeline = suite2p.OnlinePipeline(ops, stat=stat, save_path=str(tmp_path),
+                                      callback=lambda frames, F, Fneu: nbatches.append(F.shape[1]))
+    ops = pipeline.run(mov[i:i + 10] for i in range(0, len(mov), 10))
+
+    metrics = ops['online_metrics']
+    assert metrics['nframes'] == len(mov) and metrics['dropped'] == 0 and sum(nbatches) == len(mov)
+    assert metrics['nbatches'] == len(nbatches) == 1 + (len(mov) - 40) // 10
+    # offsets undo the simulated shifts (up to the position of the reference)
+    assert np.ptp(ops['yoff'] + shifts[:, 0]) <= 1 and np.ptp(ops['xoff'] + shifts[:, 1]) <= 1
+    assert (tmp_path / 'data.bin').stat().st_size == mov.nbytes
+    # traces of the streamed frames are the traces of the registered binary
+    F, Fneu, _, _, _ = extract_traces_from_masks(ops, *create_masks(ops, stat))
+    assert np.allclose(np.load(tmp_path / 'F.npy'), F, rtol=1e-5) and np.allclose(np.load(tmp_path / 'Fneu.npy'), Fneu, rtol=1e-5)
+    assert suite2p.io.load_ops(ops['ops_path'])['nframes'] == len(mov)
+
+
+def test_auto_tune_benchmarks_once_per_frame_size(tmp_path, monkeypatch):
+    import suite2p
+    from suite2p.registration import tuning
+
+    ops = {**suite2p.default_ops(), 'Ly': 64, 'Lx': 72, 'block_size': [32, 32],
+           'tuning_cache': str(tmp_path / 'tuning.json')}
+    ops = tuning.auto_tune(ops)
+    assert ops['convolve_method'] in tuning.CONVOLVE_METHODS and ops['batch_size'] in tuning.BATCH_SIZES
+    assert ops['fft_workers'] >= 1 or ops['convolve_method'] != 'rfft'
+
+    # cached settings are reused without benchmarking, other frame sizes are benchmarked
+    calls = []
+    monkeypatch.setattr(tuning, 'benchmark', lambda ops: calls.append(ops['Ly']) or dict(ops['tuning'], date='now'))
+    assert tuning.auto_tune({**ops, 'batch_size': 1})['batch_size'] == ops['batch_size']
+    assert calls == []
+    tuning.auto_tune({**ops, 'Ly': 80})
+    assert calls == [80] and len(json.load(open(tmp_path / 'tuning.json'))) == 2
+
+
+def test_auto_tune_keeps_entries_cached_by_other_processes(tmp_path, monkeypatch):
+    import suite2p
+    from suite2p.registration import tuning
+
+    cache_file = tmp_path / 'tuning.json'
+    settings = {'convolve_method': 'rfft', 'fft_workers': 1, 'batch_size': 100, 'ms_per_frame': 1.}
+
+    def benchmark(ops):
+        # another process caches its frame size while this one benchmarks
+        json.dump({'other': dict(settings, date='now')}, open(cache_file, 'w'))
+        return dict(settings)
+
+    monkeypatch.setattr(tuning, 'benchmark', benchmark)
+    tuning.auto_tune({**suite2p.default_ops(), 'Ly': 64, 'Lx': 72, 'tuning_cache': str(cache_file)})
+    assert len(json.load(open(cache_file))) == 2
+    assert [p.name for p in tmp_path.iterdir()] == ['tuning.json']